@@ -1,8 +1,17 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR
 from django.utils.html import format_html
 from django.urls import reverse
 from django.utils.safestring import mark_safe
-from .models import Relatorio, ImagemRelatorio
+from django.db import models
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.template.defaultfilters import filesizeformat
+from django.urls import path
+from .forms import ImagemValidadaField
+from .models import Relatorio, ImagemRelatorio, Tarefa, PerfilRequisicao, FuncaoPerfil
+from . import busca, perfis, tarefas
 
 class ImagemRelatorioInline(admin.TabularInline):
     """Inline para gerenciar imagens dentro do relatório"""
@@ -10,6 +19,7 @@ class ImagemRelatorioInline(admin.TabularInline):
     extra = 1
     fields = ['imagem', 'legenda', 'ordem']
     readonly_fields = ['data_upload']
+    formfield_overrides = {models.ImageField: {'form_class': ImagemValidadaField}}
 
 @admin.register(Relatorio)
 class RelatorioAdmin(admin.ModelAdmin):
@@ -37,10 +47,22 @@ class RelatorioAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('usuario')
     
+    def get_search_results(self, request, queryset, search_term):
+        """Usa o índice de busca textual no lugar dos filtros icontains"""
+        if not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        resultados = busca.buscar(queryset, search_term)
+        if 'relevancia' not in resultados.query.annotations or request.GET.get(ORDER_VAR):
+            # Sem termos válidos ou com uma coluna escolhida: a ordem que a ChangeList aplicou antes da busca
+            return resultados.order_by(*queryset.query.order_by), False
+        # Sem coluna escolhida, os mais relevantes primeiro; o pk desempata como na ChangeList
+        return resultados.order_by(*busca.ORDEM_RELEVANCIA, '-pk'), False
+    
     def get_imagens_count(self, obj):
         """Retorna o número de imagens do relatório"""
-        return obj.imagens.count()
+        return obj.num_imagens
     get_imagens_count.short_description = 'Imagens'
+    get_imagens_count.admin_order_field = 'num_imagens'
     
     def get_location_status(self, obj):
         """Retorna o status da localização do relatório"""
@@ -118,11 +140,147 @@ class RelatorioAdmin(admin.ModelAdmin):
 
 @admin.register(ImagemRelatorio)
 class ImagemRelatorioAdmin(admin.ModelAdmin):
-    list_display = ['relatorio', 'imagem', 'legenda', 'ordem', 'data_upload']
+    list_display = ['relatorio', 'imagem', 'legenda', 'ordem', 'data_upload', 'get_economia']
     list_filter = ['data_upload', 'relatorio__usuario']
     search_fields = ['relatorio__titulo', 'legenda']
-    readonly_fields = ['data_upload']
+    readonly_fields = ['data_upload', 'tamanho_enviado', 'tamanho', 'get_economia']
     ordering = ['relatorio', 'ordem', 'data_upload']
+    formfield_overrides = {models.ImageField: {'form_class': ImagemValidadaField}}
     
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('relatorio')
+    
+    def get_economia(self, obj):
+        """Bytes economizados pela normalização do upload (core/normalizacao.py)"""
+        if obj.tamanho_enviado is None or obj.tamanho is None:
+            return '-'
+        economia = obj.tamanho_enviado - obj.tamanho
+        percentual = economia * 100 / obj.tamanho_enviado if obj.tamanho_enviado else 0
+        return f'{filesizeformat(obj.tamanho_enviado)} → {filesizeformat(obj.tamanho)} ({percentual:.0f}% menor)'
+    get_economia.short_description = 'Normalização'
+
+@admin.register(Tarefa)
+class TarefaAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'tipo', 'get_status', 'tentativas', 'executar_em', 'criada_em', 'concluida_em']
+    list_filter = ['status', 'tipo']
+    search_fields = ['tipo', 'erro']
+    readonly_fields = [
+        'tipo', 'dados', 'status', 'tentativas', 'max_tentativas', 'erro',
+        'executar_em', 'criada_em', 'iniciada_em', 'concluida_em',
+    ]
+    ordering = ['-criada_em']
+    actions = ['reexecutar']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def get_status(self, obj):
+        """Retorna o status da tarefa destacado por cor"""
+        cores = {
+            Tarefa.PENDENTE: '#666',
+            Tarefa.EXECUTANDO: 'blue',
+            Tarefa.CONCLUIDA: 'green',
+            Tarefa.FALHOU: 'red',
+        }
+        return format_html(
+            '<span style="color: {};">{}</span>',
+            cores.get(obj.status, '#666'),
+            obj.get_status_display()
+        )
+    get_status.short_description = 'Status'
+    get_status.admin_order_field = 'status'
+    
+    @admin.action(description='Executar novamente as tarefas selecionadas')
+    def reexecutar(self, request, queryset):
+        quantidade = tarefas.reenfileirar(queryset)
+        self.message_user(request, f'{quantidade} tarefa(s) devolvida(s) à fila.')
+
+class FuncaoPerfilInline(admin.TabularInline):
+    """Funções mais caras do perfil, da maior para a menor em tempo próprio"""
+    model = FuncaoPerfil
+    fields = ['funcao', 'chamadas', 'tempo_proprio_ms', 'tempo_acumulado_ms']
+    readonly_fields = fields
+    ordering = ['-tempo_proprio_ms']
+    extra = 0
+    can_delete = False
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
+@admin.register(PerfilRequisicao)
+class PerfilRequisicaoAdmin(admin.ModelAdmin):
+    list_display = [
+        'criado_em', 'view', 'metodo', 'status', 'duracao_ms', 'consultas',
+        'tempo_banco_ms', 'funcao_principal', 'motivo', 'usuario',
+    ]
+    list_filter = ['view', 'motivo', 'metodo', 'status']
+    search_fields = ['caminho', 'view', 'funcao_principal']
+    fields = [
+        'view', 'caminho', 'metodo', 'status', 'motivo', 'usuario', 'criado_em',
+        'duracao_ms', 'consultas', 'tempo_banco_ms', 'funcao_principal', 'get_download', 'get_sql',
+    ]
+    readonly_fields = fields
+    ordering = ['-criado_em']
+    inlines = [FuncaoPerfilInline]
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def get_queryset(self, request):
+        # O perfil e o SQL comprimidos só são lidos na página do perfil
+        return super().get_queryset(request).select_related('usuario').defer('perfil', 'sql')
+    
+    def get_urls(self):
+        return [
+            path(
+                '<int:pk>/baixar/',
+                self.admin_site.admin_view(self.baixar_perfil),
+                name='core_perfilrequisicao_baixar',
+            ),
+        ] + super().get_urls()
+    
+    def baixar_perfil(self, request, pk):
+        """Arquivo no formato do pstats (python -m pstats, snakeviz)"""
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        registro = get_object_or_404(PerfilRequisicao, pk=pk)
+        response = HttpResponse(perfis.descomprimir(registro.perfil), content_type='application/octet-stream')
+        response['Content-Disposition'] = f'attachment; filename="perfil-{pk}.prof"'
+        return response
+    
+    def get_download(self, obj):
+        """Link para baixar o perfil completo"""
+        return format_html(
+            '<a href="{}">perfil-{}.prof</a>',
+            reverse('admin:core_perfilrequisicao_baixar', args=[obj.pk]),
+            obj.pk
+        )
+    get_download.short_description = 'Perfil completo'
+    
+    def get_sql(self, obj):
+        """Consultas executadas na requisição, com o tempo de cada uma"""
+        consultas = perfis.consultas_do_perfil(obj)
+        if not consultas:
+            return 'Nenhuma consulta'
+        return format_html(
+            '<pre style="white-space: pre-wrap; max-height: 600px; overflow: auto;">{}</pre>',
+            '\n\n'.join(f"[{consulta['tempo_ms']:.1f} ms] {consulta['sql']}" for consulta in consultas)
+        )
+    get_sql.short_description = 'SQL'
+
+@admin.register(FuncaoPerfil)
+class FuncaoPerfilAdmin(admin.ModelAdmin):
+    """Funções mais caras de todos os perfis, para comparar entre requisições"""
+    list_display = ['funcao', 'perfil', 'chamadas', 'tempo_proprio_ms', 'tempo_acumulado_ms']
+    list_filter = ['perfil__view']
+    search_fields = ['funcao']
+    ordering = ['-tempo_proprio_ms']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('perfil').defer('perfil__perfil', 'perfil__sql')
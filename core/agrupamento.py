@@ -0,0 +1,199 @@
+"""
+Agrupamento (clustering) dos relatórios no mapa do painel administrativo.
+
+Os relatórios são agregados em células de uma grade Web Mercator para cada
+nível de zoom. Cada célula guarda a quantidade de relatórios e a soma das
+coordenadas, o que permite obter o centróide e manter os agregados de forma
+incremental quando um relatório é salvo ou removido.
+
+A atualização incremental roda depois do commit da alteração, numa transação
+própria e curta (``registrar_apos_commit``): todo relatório atualiza as mesmas
+células dos zooms baixos (no zoom 0, uma célula para o mundo todo), e fazê-lo
+dentro da transação da requisição serializaria os envios simultâneos até o
+fim de cada uma. As células são bloqueadas sempre na mesma ordem, para que
+atualizações simultâneas esperem umas pelas outras sem deadlock, e conflitos
+com outra transação são repetidos. Se o processo cair entre o commit e a
+atualização, os agregados ficam defasados até o comando
+recalcular_agregados_mapa.
+"""
+import math
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, transaction
+from django.db.models import F, Q, Sum
+
+from .models import AgregadoMapa, Relatorio
+
+
+LATITUDE_MAXIMA_MERCATOR = 85.05112878
+
+# SQLSTATE de deadlock e de falha de serialização: a transação pode ser repetida
+CONFLITOS_DE_TRANSACAO = {'40P01', '40001'}
+
+
+def celulas_por_eixo(zoom):
+    """Quantidade de células em cada eixo da grade no nível de zoom"""
+    return 2 ** zoom * 256 // settings.MAPA_TAMANHO_CELULA
+
+
+def celula(latitude, longitude, zoom):
+    """Retorna as coordenadas (x, y) da célula que contém o ponto"""
+    n = celulas_por_eixo(zoom)
+    latitude = max(-LATITUDE_MAXIMA_MERCATOR, min(LATITUDE_MAXIMA_MERCATOR, latitude))
+    radianos = math.radians(latitude)
+    x = int((longitude + 180) / 360 * n)
+    y = int((1 - math.log(math.tan(radianos) + 1 / math.cos(radianos)) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def celulas_do_ponto(latitude, longitude):
+    """Lista (zoom, x, y) das células do ponto em todos os níveis agregados"""
+    return [
+        (zoom, *celula(latitude, longitude, zoom))
+        for zoom in range(settings.MAPA_ZOOM_MAXIMO_AGRUPAMENTO + 1)
+    ]
+
+
+def _filtro_celulas(celulas):
+    filtro = Q()
+    for zoom, x, y in celulas:
+        filtro |= Q(zoom=zoom, celula_x=x, celula_y=y)
+    return filtro
+
+
+def _conflito(erro):
+    """Erro causado por outra transação simultânea, que vale repetir"""
+    if isinstance(erro, IntegrityError):
+        return True
+    causa = erro.__cause__
+    return (getattr(causa, 'pgcode', None) or getattr(causa, 'sqlstate', None)) in CONFLITOS_DE_TRANSACAO
+
+
+def registrar(latitude, longitude, sinal, tentativas=3):
+    """
+    Soma (sinal=1) ou subtrai (sinal=-1) um relatório das células do ponto.
+    Células novas são criadas e células que ficam vazias são removidas.
+    """
+    latitude, longitude = float(latitude), float(longitude)
+    celulas = celulas_do_ponto(latitude, longitude)
+    filtro = _filtro_celulas(celulas)
+
+    for tentativa in range(tentativas):
+        try:
+            with transaction.atomic():
+                # O UPDATE trava as linhas na ordem em que as encontra; antes, todas são
+                # travadas na ordem da chave, a mesma em qualquer transação
+                list(
+                    AgregadoMapa.objects.select_for_update().filter(filtro)
+                    .order_by('zoom', 'celula_x', 'celula_y').values_list('pk', flat=True)
+                )
+                atualizadas = AgregadoMapa.objects.filter(filtro).update(
+                    quantidade=F('quantidade') + sinal,
+                    soma_latitude=F('soma_latitude') + sinal * latitude,
+                    soma_longitude=F('soma_longitude') + sinal * longitude,
+                )
+                if sinal > 0 and atualizadas < len(celulas):
+                    existentes = set(
+                        AgregadoMapa.objects.filter(filtro).values_list('zoom', 'celula_x', 'celula_y')
+                    )
+                    AgregadoMapa.objects.bulk_create([
+                        AgregadoMapa(
+                            zoom=zoom, celula_x=x, celula_y=y, quantidade=1,
+                            soma_latitude=latitude, soma_longitude=longitude
+                        )
+                        for zoom, x, y in celulas if (zoom, x, y) not in existentes
+                    ])
+                elif sinal < 0:
+                    AgregadoMapa.objects.filter(filtro, quantidade__lte=0).delete()
+            return
+        except (IntegrityError, OperationalError) as erro:
+            # Outra requisição criou a mesma célula ao mesmo tempo ou a transação
+            # foi escolhida para desfazer um deadlock; tenta novamente
+            if not _conflito(erro) or tentativa == tentativas - 1:
+                raise
+
+
+def registrar_apos_commit(latitude, longitude, sinal):
+    """Agenda ``registrar`` para depois do commit da transação atual"""
+    latitude, longitude = float(latitude), float(longitude)
+    # robust: uma falha aqui não pode virar erro de uma requisição já gravada
+    transaction.on_commit(lambda: registrar(latitude, longitude, sinal), robust=True)
+
+
+def recalcular(lote=2000):
+    """Reconstrói todos os agregados a partir da tabela de relatórios"""
+    acumulado = defaultdict(lambda: [0, 0.0, 0.0])
+    coordenadas = (
+        Relatorio.objects.filter(latitude__isnull=False, longitude__isnull=False)
+        .order_by()
+        .values_list('latitude', 'longitude')
+        .iterator(chunk_size=lote)
+    )
+    for latitude, longitude in coordenadas:
+        latitude, longitude = float(latitude), float(longitude)
+        for chave in celulas_do_ponto(latitude, longitude):
+            valores = acumulado[chave]
+            valores[0] += 1
+            valores[1] += latitude
+            valores[2] += longitude
+
+    with transaction.atomic():
+        AgregadoMapa.objects.all().delete()
+        AgregadoMapa.objects.bulk_create(
+            (
+                AgregadoMapa(
+                    zoom=zoom, celula_x=x, celula_y=y, quantidade=quantidade,
+                    soma_latitude=soma_latitude, soma_longitude=soma_longitude
+                )
+                for (zoom, x, y), (quantidade, soma_latitude, soma_longitude) in acumulado.items()
+            ),
+            batch_size=lote,
+        )
+    return len(acumulado)
+
+
+def _filtro_bbox(bbox, zoom):
+    """Filtro das células do nível de zoom que intersectam o bbox"""
+    oeste, sul, leste, norte = bbox
+    x_oeste, y_norte = celula(norte, oeste, zoom)
+    x_leste, y_sul = celula(sul, leste, zoom)
+    filtro = Q(zoom=zoom, celula_y__range=(y_norte, y_sul))
+    if oeste <= leste:
+        return filtro & Q(celula_x__range=(x_oeste, x_leste))
+    return filtro & (Q(celula_x__gte=x_oeste) | Q(celula_x__lte=x_leste))
+
+
+def total_no_bbox(bbox):
+    """Quantidade de relatórios no bbox usando o nível de zoom mais detalhado"""
+    zoom = settings.MAPA_ZOOM_MAXIMO_AGRUPAMENTO
+    total = AgregadoMapa.objects.filter(_filtro_bbox(bbox, zoom)).aggregate(total=Sum('quantidade'))['total']
+    return total or 0
+
+
+def agrupamentos(bbox, zoom):
+    """Retorna (latitude, longitude, quantidade) dos agrupamentos pré-calculados no bbox"""
+    zoom = min(zoom, settings.MAPA_ZOOM_MAXIMO_AGRUPAMENTO)
+    celulas = AgregadoMapa.objects.filter(_filtro_bbox(bbox, zoom)).values_list(
+        'quantidade', 'soma_latitude', 'soma_longitude'
+    )
+    return [
+        (soma_latitude / quantidade, soma_longitude / quantidade, quantidade)
+        for quantidade, soma_latitude, soma_longitude in celulas
+    ]
+
+
+def agrupar(relatorios, zoom, lote=2000):
+    """Agrupa em memória um queryset filtrado, percorrido em blocos"""
+    acumulado = defaultdict(lambda: [0, 0.0, 0.0])
+    coordenadas = relatorios.order_by().values_list('latitude', 'longitude').iterator(chunk_size=lote)
+    for latitude, longitude in coordenadas:
+        latitude, longitude = float(latitude), float(longitude)
+        valores = acumulado[celula(latitude, longitude, zoom)]
+        valores[0] += 1
+        valores[1] += latitude
+        valores[2] += longitude
+    return [
+        (soma_latitude / quantidade, soma_longitude / quantidade, quantidade)
+        for quantidade, soma_latitude, soma_longitude in acumulado.values()
+    ]
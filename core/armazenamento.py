@@ -0,0 +1,260 @@
+"""
+Armazenamento das imagens dos relatórios endereçado pelo conteúdo.
+
+Cada arquivo é gravado uma única vez em ``conteudo/<aa>/<bb>/<sha256>.<ext>``;
+a mesma foto enviada em vários relatórios aponta para o mesmo arquivo (e
+para os mesmos derivados, gerados ao lado dele). ``ConteudoImagem`` guarda
+quantas ``ImagemRelatorio`` referenciam cada arquivo; os sinais de
+ImagemRelatorio (ver core/signals.py) atualizam a contagem e o arquivo só é
+removido, após o commit, quando a última referência deixa de existir.
+
+A linha de ``ConteudoImagem`` também serve de trava entre a gravação e a
+remoção do mesmo arquivo: ``save`` a bloqueia (criando-a com zero
+referências, se preciso) antes de reaproveitar ou gravar o arquivo, e a
+remoção bloqueia as linhas zeradas antes de apagar os arquivos. Sem
+referências a linha é mantida até a remoção, para que um reenvio
+simultâneo espere por ela. Por isso a referência deve ser criada na mesma
+transação do ``save``, como faz ImagemRelatorio.save; a importação em
+massa, que grava os arquivos em outros processos, soma as referências na
+transação de cada lote e confere se os arquivos ainda existem (ver
+core/management/commands/importar_relatorios.py).
+
+Exclusões em massa e em cascata disparam um sinal por imagem; dentro de
+``liberacoes_em_lote`` as liberações são acumuladas e aplicadas de uma vez
+ao final do bloco, e os arquivos sem referências são removidos em lotes.
+Arquivos que escapem da contagem (operações sem sinais, falhas entre o
+commit e a remoção) são encontrados pelo comando ``remover_arquivos_orfaos``.
+"""
+import hashlib
+import os
+import posixpath
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from .imagens import DERIVADOS, caminho_derivado
+
+
+PREFIXO = 'conteudo'
+TAMANHO_BLOCO = 1024 * 1024
+# Arquivos por consulta nas liberações e remoções em lote
+TAMANHO_LOTE = 1000
+
+_lote = threading.local()
+
+
+def calcular_hash(arquivo):
+    """SHA-256 do conteúdo de um File, lido em blocos"""
+    sha256 = hashlib.sha256()
+    for parte in arquivo.chunks(TAMANHO_BLOCO):
+        sha256.update(parte)
+    return sha256.hexdigest()
+
+
+def caminho_conteudo(sha256, extensao):
+    """Caminho do arquivo no storage, distribuído em dois níveis de subpastas"""
+    return posixpath.join(PREFIXO, sha256[:2], sha256[2:4], sha256 + extensao.lower())
+
+
+class _ConteudoExistente(Exception):
+    pass
+
+
+def _marcar_reenvio(caminho):
+    """
+    Renova o ctime do arquivo reenviado, de onde conta a carência do
+    remover_arquivos_orfaos. O mtime é mantido: é a base do ETag e do
+    Last-Modified das respostas imutáveis (ver core/midia.py)
+    """
+    try:
+        estado = os.stat(caminho)
+        # Qualquer alteração dos metadados atualiza o ctime
+        os.utime(caminho, ns=(time.time_ns(), estado.st_mtime_ns))
+    except OSError:
+        pass
+
+
+class ArmazenamentoPorConteudo(FileSystemStorage):
+    """FileSystemStorage que nomeia os arquivos pelo hash e não grava conteúdo repetido"""
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        # Uploads recebidos pelo ImagemUploadHandler já trazem o hash (core/uploads.py)
+        sha256 = getattr(content, 'sha256', None) or calcular_hash(content)
+        nome = caminho_conteudo(sha256, posixpath.splitext(name)[1])
+        with transaction.atomic():
+            # Espera uma remoção em andamento do mesmo arquivo e impede as seguintes até o commit
+            _travar(nome)
+            if self.exists(nome):
+                _marcar_reenvio(self.path(nome))
+                return nome
+            try:
+                return self._save(nome, content)
+            except _ConteudoExistente:
+                # Outro processo gravou o mesmo conteúdo ao mesmo tempo
+                return nome
+
+    def get_available_name(self, name, max_length=None):
+        # Chamado por _save apenas quando o arquivo já existe: o conteúdo é o mesmo
+        raise _ConteudoExistente
+
+
+armazenamento = ArmazenamentoPorConteudo()
+
+
+def _travar(nome):
+    """Bloqueia a linha de ConteudoImagem do arquivo até o fim da transação, criando-a se preciso"""
+    from .models import ConteudoImagem
+
+    ConteudoImagem.objects.select_for_update().get_or_create(arquivo=nome)
+
+
+def remover_sem_referencias(nomes):
+    """Remove os arquivos (e os derivados) que continuam sem referências"""
+    from .models import ConteudoImagem
+
+    for inicio in range(0, len(nomes), TAMANHO_LOTE):
+        parte = nomes[inicio:inicio + TAMANHO_LOTE]
+        with transaction.atomic():
+            # Podem ter voltado a ser referenciados entre a liberação e o commit; os que
+            # continuam sem referências ficam bloqueados para um reenvio esperar a remoção
+            sem_referencias = list(
+                ConteudoImagem.objects.select_for_update()
+                .filter(arquivo__in=parte, referencias__lte=0)
+                .order_by('arquivo').values_list('arquivo', flat=True)
+            )
+            for nome in sem_referencias:
+                arquivos = [nome] + [
+                    caminho_derivado(nome, sufixo, formato)
+                    for sufixo, _, formato in DERIVADOS.values()
+                ]
+                for arquivo in arquivos:
+                    try:
+                        os.remove(armazenamento.path(arquivo))
+                    except FileNotFoundError:
+                        pass
+            ConteudoImagem.objects.filter(arquivo__in=sem_referencias).delete()
+
+
+def referenciar(nome, tentativas=3):
+    """Soma uma referência ao arquivo"""
+    from .models import ConteudoImagem
+
+    for tentativa in range(tentativas):
+        try:
+            with transaction.atomic():
+                if not ConteudoImagem.objects.filter(arquivo=nome).update(referencias=F('referencias') + 1):
+                    ConteudoImagem.objects.create(arquivo=nome, referencias=1)
+            return
+        except IntegrityError:
+            # Outra requisição criou a linha do mesmo arquivo ao mesmo tempo
+            if tentativa == tentativas - 1:
+                raise
+
+
+def liberar(nome):
+    """Subtrai uma referência; sem referências, o arquivo e os derivados são removidos após o commit"""
+    from .models import ConteudoImagem
+
+    pendentes = getattr(_lote, 'pendentes', None)
+    if pendentes is not None:
+        pendentes[nome] += 1
+        return
+    with transaction.atomic():
+        ConteudoImagem.objects.filter(arquivo=nome).update(referencias=F('referencias') - 1)
+        if ConteudoImagem.objects.filter(arquivo=nome, referencias__lte=0).exists():
+            transaction.on_commit(lambda: remover_sem_referencias([nome]))
+
+
+def _somar(contagens, sinal):
+    """Soma (sinal=1) ou subtrai (sinal=-1) as quantidades (nome -> quantidade), uma consulta por quantidade"""
+    from .models import ConteudoImagem
+
+    por_quantidade = defaultdict(list)
+    for nome, quantidade in contagens.items():
+        por_quantidade[quantidade].append(nome)
+    for quantidade, nomes in por_quantidade.items():
+        # Ordem fixa das linhas travadas pelos UPDATEs de transações simultâneas
+        nomes.sort()
+        for inicio in range(0, len(nomes), TAMANHO_LOTE):
+            ConteudoImagem.objects.filter(arquivo__in=nomes[inicio:inicio + TAMANHO_LOTE]).update(
+                referencias=F('referencias') + sinal * quantidade
+            )
+
+
+def referenciar_varios(contagens):
+    """
+    Soma as referências acumuladas (nome -> quantidade) com poucas consultas.
+    Usado pela importação em massa, cujo bulk_create não dispara os sinais.
+    """
+    from .models import ConteudoImagem
+
+    nomes = sorted(contagens)
+    for inicio in range(0, len(nomes), TAMANHO_LOTE):
+        ConteudoImagem.objects.bulk_create(
+            [ConteudoImagem(arquivo=nome) for nome in nomes[inicio:inicio + TAMANHO_LOTE]],
+            ignore_conflicts=True,
+        )
+    _somar(contagens, 1)
+
+
+def _liberar_varios(pendentes):
+    """Subtrai as referências acumuladas (nome -> quantidade) com poucas consultas"""
+    from .models import ConteudoImagem
+
+    _somar(pendentes, -1)
+    nomes = list(pendentes)
+    sem_referencias = []
+    for inicio in range(0, len(nomes), TAMANHO_LOTE):
+        sem_referencias += ConteudoImagem.objects.filter(
+            arquivo__in=nomes[inicio:inicio + TAMANHO_LOTE], referencias__lte=0
+        ).values_list('arquivo', flat=True)
+    if sem_referencias:
+        transaction.on_commit(lambda: remover_sem_referencias(sem_referencias))
+
+
+@contextmanager
+def liberacoes_em_lote():
+    """
+    Acumula as liberações feitas no bloco (uma por imagem nas exclusões em
+    massa e em cascata) e as aplica juntas ao final, na mesma transação.
+    """
+    if getattr(_lote, 'pendentes', None) is not None:
+        # Bloco aninhado: as liberações ficam para o bloco externo
+        yield
+        return
+    _lote.pendentes = Counter()
+    try:
+        with transaction.atomic():
+            yield
+            pendentes, _lote.pendentes = _lote.pendentes, None
+            _liberar_varios(pendentes)
+    finally:
+        _lote.pendentes = None
+
+
+def reconciliar():
+    """Recalcula as referências a partir de ImagemRelatorio. Retorna o número de arquivos"""
+    from .models import ConteudoImagem, ImagemRelatorio
+
+    with transaction.atomic():
+        ConteudoImagem.objects.all().delete()
+        contagens = (
+            ImagemRelatorio.objects.exclude(imagem='').order_by()
+            .values('imagem').annotate(referencias=Count('pk'))
+        )
+        criados = ConteudoImagem.objects.bulk_create(
+            [ConteudoImagem(arquivo=linha['imagem'], referencias=linha['referencias']) for linha in contagens],
+            batch_size=1000,
+        )
+    return len(criados)
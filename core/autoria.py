@@ -0,0 +1,77 @@
+"""
+Autoria dos relatórios criados por visitantes anônimos.
+
+Cada visitante anônimo que cria um relatório recebe um token (UUID) num
+cookie assinado, e o token é gravado em ``Relatorio.token_anonimo``
+(coluna indexada). "Meus relatórios" e a página de detalhes consultam por
+igualdade nessa coluna, e a sessão não guarda mais a lista de relatórios
+criados, mantendo tamanho constante.
+
+Sessões antigas que ainda têm a lista ``relatorios_criados`` são convertidas
+no primeiro acesso: os relatórios recebem o token e a lista é descartada.
+"""
+import uuid
+
+from django.conf import settings
+
+from .models import Relatorio
+
+
+SALT = 'core.autoria'
+CHAVE_SESSAO_ANTIGA = 'relatorios_criados'
+
+
+def _ler_cookie(request):
+    valor = request.get_signed_cookie(settings.ANONIMO_COOKIE_NOME, default=None, salt=SALT)
+    try:
+        return uuid.UUID(valor) if valor else None
+    except ValueError:
+        return None
+
+
+def _converter_sessao_antiga(request, token):
+    ids = request.session.pop(CHAVE_SESSAO_ANTIGA, None)
+    if not ids:
+        return token
+    token = token or uuid.uuid4()
+    Relatorio.objects.filter(
+        pk__in=ids, usuario__isnull=True, token_anonimo__isnull=True
+    ).update(token_anonimo=token)
+    request._token_anonimo_novo = token
+    return token
+
+
+def token(request, criar=False):
+    """
+    Token do visitante anônimo, ou None se ele ainda não criou relatórios.
+    Com ``criar=True`` um novo token é gerado; o cookie é gravado na resposta
+    pelo TokenAnonimoMiddleware.
+    """
+    if not hasattr(request, '_token_anonimo'):
+        atual = _ler_cookie(request)
+        request._token_anonimo = _converter_sessao_antiga(request, atual)
+    if request._token_anonimo is None and criar:
+        request._token_anonimo = request._token_anonimo_novo = uuid.uuid4()
+    return request._token_anonimo
+
+
+class TokenAnonimoMiddleware:
+    """Grava o cookie assinado com o token gerado durante a requisição"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        novo = getattr(request, '_token_anonimo_novo', None)
+        if novo is not None:
+            response.set_signed_cookie(
+                settings.ANONIMO_COOKIE_NOME,
+                str(novo),
+                salt=SALT,
+                max_age=settings.ANONIMO_COOKIE_IDADE,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite='Lax',
+            )
+        return response
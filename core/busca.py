@@ -0,0 +1,64 @@
+"""
+Busca textual dos relatórios com o full-text search do PostgreSQL.
+
+O vetor de busca (coluna ``Relatorio.busca``) é mantido por um trigger no
+banco (ver migração 0007) usando a configuração ``portugues_sem_acento``,
+que remove acentos antes do stemming em português.
+"""
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F, Q
+
+
+CONFIGURACAO = 'portugues_sem_acento'
+
+# Palavras, e-mails e nomes de usuário; descarta operadores do tsquery
+_TERMO = re.compile(r"\w[\w@.+-]*\w|\w")
+
+ORDEM_RELEVANCIA = ('-relevancia', '-data_criacao')
+
+
+def consulta(texto):
+    """
+    Converte o texto digitado em uma consulta em que todos os termos devem
+    aparecer, cada um como prefixo (busca conforme o usuário digita).
+    """
+    termos = _TERMO.findall(texto)
+    if not termos:
+        return None
+    return SearchQuery(
+        ' & '.join(f"'{termo}':*" for termo in termos),
+        config=CONFIGURACAO,
+        search_type='raw',
+    )
+
+
+def buscar(relatorios, texto):
+    """
+    Filtra o queryset pela busca textual e ordena pela relevância. Textos com
+    ``@`` também procuram o trecho no email_usuario: o e-mail inteiro é um
+    único termo do vetor, e partes dele (``@dominio.com``) não o encontrariam.
+    """
+    query = consulta(texto)
+    if query is None:
+        return relatorios
+    filtro = Q(busca=query)
+    if '@' in texto:
+        filtro |= Q(email_usuario__icontains=texto.strip())
+    return (
+        relatorios.filter(filtro)
+        .annotate(relevancia=SearchRank(F('busca'), query))
+        .order_by(*ORDEM_RELEVANCIA)
+    )
+
+
+def buscar_icontains(relatorios, texto):
+    """Implementação anterior com ILIKE, mantida para o benchmark_busca"""
+    return relatorios.filter(
+        Q(titulo__icontains=texto) |
+        Q(conteudo__icontains=texto) |
+        Q(usuario__username__icontains=texto) |
+        Q(nome_usuario__icontains=texto) |
+        Q(email_usuario__icontains=texto)
+    )
@@ -0,0 +1,100 @@
+"""
+Cache das páginas estáticas e dos fragmentos das páginas de detalhes.
+
+As páginas home, sobre e contato são guardadas inteiras, mas apenas para
+visitantes anônimos sem mensagens pendentes do framework de mensagens; o
+token CSRF do formulário é trocado por um marcador ao guardar e pelo token
+do visitante ao servir. Para usuários autenticados a view é executada
+normalmente.
+
+O corpo das páginas de detalhes dos relatórios é guardado com a tag
+``{% cache %}`` sob uma chave que inclui as versões do relatório, do seu
+autor e uma versão geral. As versões são marcas de tempo trocadas pelos
+sinais (ver core/signals.py) quando o relatório, suas imagens ou o usuário
+mudam; comandos que alteram muitas imagens de uma vez trocam a versão geral.
+Por serem marcas de tempo, uma versão perdida pelo cache nunca volta a
+coincidir com a de um fragmento antigo.
+"""
+import re
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+
+MARCADOR_CSRF = '__token_csrf__'
+_CAMPO_CSRF = re.compile(r'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+
+
+def _versao(chave):
+    versao = cache.get(chave)
+    if versao is None:
+        cache.add(chave, time.time_ns(), timeout=None)
+        versao = cache.get(chave)
+    return versao
+
+
+def _trocar_versao(chave):
+    cache.set(chave, time.time_ns(), timeout=None)
+
+
+def invalidar_relatorio(relatorio_id):
+    _trocar_versao(f'cache:relatorio:{relatorio_id}')
+
+
+def invalidar_usuario(usuario_id):
+    _trocar_versao(f'cache:usuario:{usuario_id}')
+
+
+def invalidar_tudo():
+    """Descarta todos os fragmentos dos relatórios (ex.: após alterações em massa)"""
+    _trocar_versao('cache:geral')
+
+
+def chave_relatorio(relatorio):
+    """Identifica a versão atual do corpo da página de detalhes do relatório"""
+    partes = [relatorio.pk, _versao('cache:geral'), _versao(f'cache:relatorio:{relatorio.pk}')]
+    if relatorio.usuario_id:
+        partes.append(_versao(f'cache:usuario:{relatorio.usuario_id}'))
+    return ':'.join(str(parte) for parte in partes)
+
+
+def _cacheavel(request):
+    return (
+        request.method in ('GET', 'HEAD')
+        and not request.user.is_authenticated
+        # len() carrega as mensagens sem marcá-las como exibidas
+        and not len(get_messages(request))
+    )
+
+
+def cache_para_anonimos(view):
+    """
+    Guarda a resposta da view para visitantes anônimos por
+    CACHE_PAGINAS_TIMEOUT segundos. A chave é só o caminho: a view não pode
+    depender da query string, que qualquer um pode variar (?x=1, ?x=2, ...)
+    para encher o cache
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not _cacheavel(request):
+            return view(request, *args, **kwargs)
+
+        chave = f'cache:pagina:{request.path}'
+        guardada = cache.get(chave)
+        if guardada is not None:
+            conteudo, content_type = guardada
+            return HttpResponse(conteudo.replace(MARCADOR_CSRF, get_token(request)), content_type=content_type)
+
+        response = view(request, *args, **kwargs)
+        if response.status_code == 200 and not response.streaming and not response.cookies:
+            conteudo = _CAMPO_CSRF.sub(rf'\g<1>{MARCADOR_CSRF}\g<2>', response.content.decode(response.charset))
+            cache.set(chave, (conteudo, response['Content-Type']), timeout=settings.CACHE_PAGINAS_TIMEOUT)
+        return response
+
+    return wrapper
@@ -0,0 +1,182 @@
+"""
+Contadores desnormalizados dos relatórios.
+
+``Relatorio.num_imagens``, os totais gerais em ``EstatisticasRelatorios`` e
+``ContagemAutor`` são atualizados pelos sinais de ``Relatorio`` e
+``ImagemRelatorio`` (ver core/signals.py), na mesma transação da alteração.
+Operações que não disparam sinais (``update()``, ``bulk_create``) podem
+deixar os contadores defasados; ``reconciliar_contadores`` os recalcula.
+
+Os totais gerais são divididos em até FATIAS linhas, somadas na leitura:
+cada alteração soma o seu delta a uma fatia sorteada, então envios
+simultâneos raramente disputam o bloqueio da mesma linha até o fim das
+suas transações. Uma fatia que ainda não existe é criada com o delta.
+"""
+import random
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import ContagemAutor, EstatisticasRelatorios, ImagemRelatorio, Relatorio
+
+
+FATIAS = 16
+CAMPOS_ESTATISTICAS = ('total_relatorios', 'total_com_localizacao', 'total_imagens')
+
+
+def _atualizar_estatisticas(tentativas=3, **deltas):
+    alteracoes = {campo: F(campo) + delta for campo, delta in deltas.items() if delta}
+    if not alteracoes:
+        return
+    fatia = random.randint(1, FATIAS)
+    for tentativa in range(tentativas):
+        try:
+            with transaction.atomic():
+                if not EstatisticasRelatorios.objects.filter(pk=fatia).update(**alteracoes):
+                    EstatisticasRelatorios.objects.create(pk=fatia, **deltas)
+            return
+        except IntegrityError:
+            # Outra transação criou a mesma fatia ao mesmo tempo
+            if tentativa == tentativas - 1:
+                raise
+
+
+def _filtro_autor(autor):
+    usuario_id, nome_usuario = autor
+    if usuario_id:
+        return {'usuario_id': usuario_id}
+    return {'usuario__isnull': True, 'nome_usuario': nome_usuario}
+
+
+def autor_do_relatorio(usuario_id, nome_usuario):
+    """Chave do autor usada em ContagemAutor, ou None para relatórios sem autor identificado"""
+    if usuario_id:
+        return (usuario_id, '')
+    if nome_usuario:
+        return (None, nome_usuario)
+    return None
+
+
+def _atualizar_autor(autor, delta, tentativas=3):
+    filtro = _filtro_autor(autor)
+    for tentativa in range(tentativas):
+        try:
+            with transaction.atomic():
+                if not ContagemAutor.objects.filter(**filtro).update(quantidade=F('quantidade') + delta):
+                    if delta > 0:
+                        ContagemAutor.objects.create(usuario_id=autor[0], nome_usuario=autor[1], quantidade=delta)
+                elif delta < 0:
+                    ContagemAutor.objects.filter(**filtro, quantidade__lte=0).delete()
+            return
+        except IntegrityError:
+            # Outra requisição criou a contagem do mesmo autor ao mesmo tempo
+            if tentativa == tentativas - 1:
+                raise
+
+
+def registrar_relatorio(autor, localizado, sinal):
+    """Soma (sinal=1) ou subtrai (sinal=-1) um relatório dos totais"""
+    with transaction.atomic():
+        _atualizar_estatisticas(
+            total_relatorios=sinal,
+            total_com_localizacao=sinal if localizado else 0,
+        )
+        if autor:
+            _atualizar_autor(autor, sinal)
+
+
+def alterar_relatorio(autor_anterior, autor_atual, localizado_antes, localizado_agora):
+    """Ajusta os totais quando o autor ou a localização de um relatório mudam"""
+    with transaction.atomic():
+        if localizado_antes != localizado_agora:
+            _atualizar_estatisticas(total_com_localizacao=1 if localizado_agora else -1)
+        if autor_anterior != autor_atual:
+            if autor_anterior:
+                _atualizar_autor(autor_anterior, -1)
+            if autor_atual:
+                _atualizar_autor(autor_atual, 1)
+
+
+def registrar_imagem(relatorio_id, sinal):
+    """Soma ou subtrai uma imagem do relatório e do total geral"""
+    with transaction.atomic():
+        Relatorio.objects.filter(pk=relatorio_id).update(num_imagens=F('num_imagens') + sinal)
+        _atualizar_estatisticas(total_imagens=sinal)
+
+
+def reconciliar_estatisticas():
+    """Recalcula os totais gerais a partir das tabelas, reunidos na fatia 1"""
+    with transaction.atomic():
+        EstatisticasRelatorios.objects.all().delete()
+        EstatisticasRelatorios.objects.create(
+            pk=1,
+            total_relatorios=Relatorio.objects.count(),
+            total_com_localizacao=Relatorio.objects.filter(
+                latitude__isnull=False, longitude__isnull=False
+            ).count(),
+            total_imagens=ImagemRelatorio.objects.count(),
+        )
+
+
+def reconciliar():
+    """Recalcula todos os contadores. Retorna o número de relatórios corrigidos"""
+    with transaction.atomic():
+        contagem_imagens = Coalesce(
+            Subquery(
+                ImagemRelatorio.objects.filter(relatorio=OuterRef('pk'))
+                .order_by()
+                .values('relatorio')
+                .annotate(total=Count('pk'))
+                .values('total')
+            ),
+            Value(0),
+        )
+        corrigidos = (
+            Relatorio.objects.annotate(contagem=contagem_imagens)
+            .exclude(num_imagens=F('contagem'))
+            .values_list('pk', flat=True)
+        )
+        corrigidos = list(corrigidos)
+        Relatorio.objects.filter(pk__in=corrigidos).update(num_imagens=contagem_imagens)
+
+        reconciliar_estatisticas()
+
+        ContagemAutor.objects.all().delete()
+        registrados = (
+            Relatorio.objects.filter(usuario__isnull=False).order_by()
+            .values('usuario').annotate(quantidade=Count('pk'))
+        )
+        nao_registrados = (
+            Relatorio.objects.filter(usuario__isnull=True).exclude(nome_usuario='').order_by()
+            .values('nome_usuario').annotate(quantidade=Count('pk'))
+        )
+        ContagemAutor.objects.bulk_create(
+            [ContagemAutor(usuario_id=linha['usuario'], quantidade=linha['quantidade']) for linha in registrados]
+            + [
+                ContagemAutor(nome_usuario=linha['nome_usuario'], quantidade=linha['quantidade'])
+                for linha in nao_registrados
+            ],
+            batch_size=1000,
+        )
+    return len(corrigidos)
+
+
+def estatisticas():
+    """Totais gerais (soma das fatias) sem consultar as tabelas de relatórios"""
+    totais = EstatisticasRelatorios.objects.aggregate(
+        **{campo: Coalesce(Sum(campo), 0) for campo in CAMPOS_ESTATISTICAS}
+    )
+    return EstatisticasRelatorios(**totais)
+
+
+def total_do_autor(usuario_id=None, nome_usuario=''):
+    """Quantidade de relatórios do autor a partir de ContagemAutor"""
+    autor = autor_do_relatorio(usuario_id, nome_usuario)
+    if autor is None:
+        return 0
+    return (
+        ContagemAutor.objects.filter(**_filtro_autor(autor))
+        .values_list('quantidade', flat=True)
+        .first()
+    ) or 0
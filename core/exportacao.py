@@ -0,0 +1,135 @@
+"""
+Exportação dos relatórios em CSV, GeoJSON ou NDJSON, gerada em streaming.
+
+Os relatórios são lidos com ``.iterator(chunk_size=...)`` e as URLs das
+imagens de cada lote vêm de uma única consulta, de modo que a memória usada
+não cresce com o tamanho da base. Usado pela view ``exportar_relatorios``
+e pelo comando ``exportar_relatorios``.
+"""
+import csv
+import json
+import zlib
+from itertools import islice
+from urllib.parse import urljoin
+
+from .armazenamento import armazenamento
+from .models import ImagemRelatorio
+
+
+FORMATOS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'geojson': ('application/geo+json', 'geojson'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+CAMPOS = [
+    'id', 'titulo', 'conteudo', 'autor', 'data_criacao',
+    'endereco', 'latitude', 'longitude', 'imagens',
+]
+
+
+def _lotes(relatorios, tamanho):
+    valores = relatorios.order_by('pk').values(
+        'id', 'titulo', 'conteudo', 'usuario__username', 'nome_usuario',
+        'data_criacao', 'endereco', 'latitude', 'longitude',
+    ).iterator(chunk_size=tamanho)
+    while True:
+        lote = list(islice(valores, tamanho))
+        if not lote:
+            return
+        yield lote
+
+
+def registros(relatorios, url_base='', tamanho_lote=2000):
+    """
+    Gera um dicionário por relatório com os campos de CAMPOS. As URLs das
+    imagens são relativas a ``url_base`` (ex.: https://servidor/).
+    """
+    for lote in _lotes(relatorios, tamanho_lote):
+        imagens = {}
+        arquivos = (
+            ImagemRelatorio.objects.filter(relatorio_id__in=[linha['id'] for linha in lote])
+            .order_by('relatorio_id', 'ordem', 'data_upload')
+            .values_list('relatorio_id', 'imagem')
+        )
+        for relatorio_id, nome in arquivos:
+            imagens.setdefault(relatorio_id, []).append(urljoin(url_base, armazenamento.url(nome)))
+
+        for linha in lote:
+            yield {
+                'id': linha['id'],
+                'titulo': linha['titulo'],
+                'conteudo': linha['conteudo'],
+                'autor': linha['usuario__username'] or linha['nome_usuario'] or 'Anônimo',
+                'data_criacao': linha['data_criacao'].isoformat(),
+                'endereco': linha['endereco'] or '',
+                'latitude': float(linha['latitude']) if linha['latitude'] is not None else None,
+                'longitude': float(linha['longitude']) if linha['longitude'] is not None else None,
+                'imagens': imagens.get(linha['id'], []),
+            }
+
+
+class _Eco:
+    """Objeto com write() que apenas devolve o texto, para o csv.writer"""
+
+    def write(self, valor):
+        return valor
+
+
+def _csv(itens):
+    escritor = csv.writer(_Eco())
+    yield escritor.writerow(CAMPOS)
+    for item in itens:
+        item = dict(item, imagens=' '.join(item['imagens']))
+        yield escritor.writerow(['' if item[campo] is None else item[campo] for campo in CAMPOS])
+
+
+def _ndjson(itens):
+    for item in itens:
+        yield json.dumps(item, ensure_ascii=False) + '\n'
+
+
+def _geojson(itens):
+    yield '{"type": "FeatureCollection", "features": [\n'
+    separador = ''
+    for item in itens:
+        geometria = None
+        if item['latitude'] is not None and item['longitude'] is not None:
+            geometria = {'type': 'Point', 'coordinates': [item['longitude'], item['latitude']]}
+        propriedades = {campo: item[campo] for campo in CAMPOS if campo not in ('latitude', 'longitude')}
+        feature = {'type': 'Feature', 'id': item['id'], 'geometry': geometria, 'properties': propriedades}
+        yield separador + json.dumps(feature, ensure_ascii=False)
+        separador = ',\n'
+    yield '\n]}\n'
+
+
+def _agrupar(partes, tamanho=64 * 1024):
+    """Junta as partes pequenas em blocos maiores antes de enviar"""
+    buffer = []
+    acumulado = 0
+    for parte in partes:
+        buffer.append(parte)
+        acumulado += len(parte)
+        if acumulado >= tamanho:
+            yield b''.join(buffer)
+            buffer = []
+            acumulado = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def _gzip(blocos):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+    for bloco in blocos:
+        comprimido = compressor.compress(bloco)
+        if comprimido:
+            yield comprimido
+    yield compressor.flush()
+
+
+def exportar(relatorios, formato, url_base='', comprimir=False, tamanho_lote=2000):
+    """Gera os bytes do arquivo exportado no formato informado (ver FORMATOS)"""
+    geradores = {'csv': _csv, 'geojson': _geojson, 'ndjson': _ndjson}
+    textos = geradores[formato](registros(relatorios, url_base, tamanho_lote))
+    blocos = _agrupar(texto.encode('utf-8') for texto in textos)
+    return _gzip(blocos) if comprimir else blocos
@@ -0,0 +1,82 @@
+"""
+Facetas do filtro de autores do painel administrativo, servidas pelo cache.
+
+As listas vêm de ``ContagemAutor`` (ver core/contadores.py) e ficam no
+cache do Django sob uma versão. Criar, alterar ou remover relatórios
+incrementa a versão, o que invalida de uma vez todas as chaves de facetas,
+inclusive as do autocomplete.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from .models import ContagemAutor
+
+
+CHAVE_VERSAO = 'facetas:versao'
+
+
+def _versao():
+    versao = cache.get(CHAVE_VERSAO)
+    if versao is None:
+        versao = 1
+        cache.add(CHAVE_VERSAO, versao, timeout=None)
+    return versao
+
+
+def invalidar():
+    """Invalida todas as facetas em cache"""
+    try:
+        cache.incr(CHAVE_VERSAO)
+    except ValueError:
+        cache.set(CHAVE_VERSAO, 2, timeout=None)
+
+
+def _serializar(contagens):
+    return [
+        {
+            'valor': contagem.usuario.username if contagem.usuario_id else contagem.nome_usuario,
+            'nome_completo': contagem.usuario.get_full_name() if contagem.usuario_id else '',
+            'registrado': bool(contagem.usuario_id),
+            'quantidade': contagem.quantidade,
+        }
+        for contagem in contagens
+    ]
+
+
+def _consultar(termo, limite):
+    contagens = ContagemAutor.objects.select_related('usuario').order_by('-quantidade', 'pk')
+    if termo:
+        contagens = contagens.filter(
+            Q(usuario__username__istartswith=termo) | Q(nome_usuario__istartswith=termo)
+        )
+    return _serializar(contagens[:limite])
+
+
+def autores(limite=None):
+    """Autores com mais relatórios, com as respectivas quantidades"""
+    limite = limite or settings.FACETAS_LIMITE_AUTORES
+    chave = f'facetas:autores:{limite}'
+    return cache.get_or_set(
+        chave,
+        lambda: _consultar('', limite),
+        timeout=settings.FACETAS_CACHE_TIMEOUT,
+        version=_versao(),
+    )
+
+
+def buscar_autores(termo, limite=20):
+    """Autores cujo nome começa com o termo (autocomplete do filtro)"""
+    termo = termo.strip().lower()
+    if not termo:
+        return autores(limite)
+    # O termo entra na chave como hash para evitar caracteres inválidos no memcached/Redis
+    chave = f'facetas:busca:{limite}:{hashlib.md5(termo.encode()).hexdigest()}'
+    return cache.get_or_set(
+        chave,
+        lambda: _consultar(termo, limite),
+        timeout=settings.FACETAS_CACHE_TIMEOUT,
+        version=_versao(),
+    )
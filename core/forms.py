@@ -3,6 +3,7 @@ from django.contrib.auth.models import User
 from django.contrib.auth.forms import UserCreationForm
 from django.forms import modelformset_factory
 from .models import Relatorio, ImagemRelatorio
+from .uploads import UploadImagem
 import os
 
 class MultipleFileInput(forms.ClearableFileInput):
@@ -20,10 +21,24 @@ class MultipleFileField(forms.FileField):
         if isinstance(data, list):
             result = []
             for file in data:
-                result.append(super().clean(file, initial))
+                result.append(self.clean(file, initial))
             return result
+        # Arquivo interrompido pelo handler de upload (core/uploads.py)
+        if getattr(data, 'erro_upload', None):
+            raise forms.ValidationError(data.erro_upload)
         return super().clean(data, initial)
 
+class ImagemValidadaField(forms.ImageField):
+    """ImageField que aproveita a validação do ImagemUploadHandler, quando o upload passou por ele (core/uploads.py)"""
+    
+    def to_python(self, data):
+        if getattr(data, 'erro_upload', None):
+            raise forms.ValidationError(data.erro_upload)
+        if isinstance(data, UploadImagem):
+            # Tamanho e assinatura já verificados no upload: não relê o arquivo com o Pillow
+            return forms.FileField.to_python(self, data)
+        return super().to_python(data)
+
 class RelatorioForm(forms.ModelForm):
     """Formulário para criação de relatórios"""
     
@@ -118,6 +133,9 @@ class ImagemRelatorioForm(forms.ModelForm):
             'imagem': 'Imagem',
             'legenda': 'Legenda'
         }
+        field_classes = {
+            'imagem': ImagemValidadaField
+        }
     
     def clean_imagem(self):
         """Validação personalizada para o campo imagem"""
@@ -171,11 +189,19 @@ class MultipleImageUploadForm(forms.Form):
         required=False
     )
     
+    def __init__(self, *args, erro_upload=None, **kwargs):
+        # Upload interrompido pelo handler antes do fim da requisição (core/uploads.py)
+        self.erro_upload = erro_upload
+        super().__init__(*args, **kwargs)
+    
     def clean_imagens(self):
         """Validação para múltiplas imagens"""
         from django.conf import settings
         import os
         
+        if self.erro_upload:
+            raise forms.ValidationError(self.erro_upload)
+        
         images = self.files.getlist('imagens')
         
         if images:
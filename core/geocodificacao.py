@@ -0,0 +1,220 @@
+"""
+Geocodificação reversa (coordenadas -> endereço) feita pelo servidor.
+
+As coordenadas são arredondadas para GEOCODIFICACAO_CASAS_DECIMAIS casas
+(4 casas ~ 11 m), de modo que cliques próximos no mapa compartilham o mesmo
+resultado. A consulta passa por três níveis: o cache do Django, a tabela
+``EnderecoGeocodificado`` (persistente) e, por fim, o provedor configurado
+em GEOCODIFICACAO_PROVEDOR. Consultas simultâneas à mesma coordenada são
+agrupadas em uma só, e as chamadas ao provedor respeitam o intervalo mínimo
+GEOCODIFICACAO_INTERVALO entre todos os processos (a política de uso do
+Nominatim permite uma requisição por segundo).
+
+O endpoint é público, então ninguém espera pela vez: sem janela livre a
+consulta devolve None na hora (o formulário usa as coordenadas), e cada
+cliente pode levar ao provedor no máximo GEOCODIFICACAO_LIMITE_POR_CLIENTE
+coordenadas novas por minuto, para que um só cliente não esgote a cota de
+todos os outros.
+"""
+import json
+import logging
+import threading
+import time
+from decimal import ROUND_HALF_UP, Decimal
+from urllib.error import URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from .models import EnderecoGeocodificado
+
+logger = logging.getLogger(__name__)
+
+
+class ErroGeocodificacao(Exception):
+    """Falha de comunicação com o provedor de geocodificação"""
+
+
+class LimiteExcedido(Exception):
+    """O cliente já consultou o provedor GEOCODIFICACAO_LIMITE_POR_CLIENTE vezes no último minuto"""
+
+
+class ProvedorNominatim:
+    """Provedor HTTP usando a API reversa do Nominatim (OpenStreetMap)"""
+
+    def endereco(self, latitude, longitude):
+        parametros = urlencode({
+            'format': 'json',
+            'lat': latitude,
+            'lon': longitude,
+            'zoom': 18,
+            'addressdetails': 0,
+        })
+        requisicao = Request(
+            f'{settings.GEOCODIFICACAO_URL}?{parametros}',
+            headers={
+                # Exigido pela política de uso do Nominatim
+                'User-Agent': settings.GEOCODIFICACAO_USER_AGENT,
+                'Accept-Language': 'pt-BR,pt',
+            },
+        )
+        try:
+            with urlopen(requisicao, timeout=settings.GEOCODIFICACAO_TIMEOUT) as resposta:
+                dados = json.load(resposta)
+        except (URLError, OSError, ValueError) as erro:
+            raise ErroGeocodificacao(str(erro)) from erro
+        return dados.get('display_name') or None
+
+
+class ProvedorFixture:
+    """
+    Provedor local para testes e desenvolvimento sem acesso à rede. Lê um
+    JSON (GEOCODIFICACAO_FIXTURE) com chaves "latitude,longitude" já
+    arredondadas e o endereço como valor.
+    """
+
+    def __init__(self):
+        self.enderecos = {}
+        if settings.GEOCODIFICACAO_FIXTURE:
+            with open(settings.GEOCODIFICACAO_FIXTURE, encoding='utf-8') as arquivo:
+                self.enderecos = json.load(arquivo)
+
+    def endereco(self, latitude, longitude):
+        return self.enderecos.get(f'{latitude},{longitude}')
+
+
+_provedor = None
+
+
+def provedor():
+    """Instância do provedor configurado em GEOCODIFICACAO_PROVEDOR"""
+    global _provedor
+    if _provedor is None:
+        _provedor = import_string(settings.GEOCODIFICACAO_PROVEDOR)()
+    return _provedor
+
+
+def arredondar(valor):
+    """Arredonda uma coordenada para a precisão usada como chave do cache"""
+    casas = Decimal(1).scaleb(-settings.GEOCODIFICACAO_CASAS_DECIMAIS)
+    return Decimal(str(valor)).quantize(casas, rounding=ROUND_HALF_UP)
+
+
+def _chave(latitude, longitude):
+    return f'geocodificacao:{latitude}:{longitude}'
+
+
+def _reservar_vez():
+    """
+    Reserva a janela atual de GEOCODIFICACAO_INTERVALO segundos para chamar
+    o provedor, compartilhada entre processos pelo cache. Não espera: retorna
+    False se a janela já foi usada.
+    """
+    intervalo = settings.GEOCODIFICACAO_INTERVALO
+    janela = int(time.time() / intervalo)
+    return cache.add(f'geocodificacao:janela:{janela}', 1, timeout=max(1, int(intervalo * 2)))
+
+
+def _dentro_do_limite(cliente):
+    """Conta uma consulta ao provedor do cliente no minuto atual; False acima do limite"""
+    chave = f'geocodificacao:cliente:{cliente}:{int(time.time() // 60)}'
+    cache.add(chave, 0, timeout=120)
+    try:
+        return cache.incr(chave) <= settings.GEOCODIFICACAO_LIMITE_POR_CLIENTE
+    except ValueError:
+        # Expirou entre o add e o incr
+        return True
+
+
+def _consultar_provedor(latitude, longitude):
+    """Consulta o provedor e grava o resultado; None se não houver endereço ou vez"""
+    if not _reservar_vez():
+        logger.info('Geocodificação de %s,%s ignorada: limite de requisições', latitude, longitude)
+        return None
+    try:
+        endereco = provedor().endereco(latitude, longitude)
+    except ErroGeocodificacao:
+        logger.warning('Falha na geocodificação de %s,%s', latitude, longitude, exc_info=True)
+        return None
+
+    EnderecoGeocodificado.objects.update_or_create(
+        latitude=latitude, longitude=longitude, defaults={'endereco': endereco or ''}
+    )
+    cache.set(_chave(latitude, longitude), endereco or '', timeout=settings.GEOCODIFICACAO_CACHE_TIMEOUT)
+    return endereco
+
+
+# Consultas em andamento neste processo: chave -> (evento, resultado)
+_em_andamento = {}
+_trava = threading.Lock()
+
+
+def _consulta_unica(latitude, longitude):
+    """
+    Garante uma única consulta ao provedor por coordenada: threads deste
+    processo esperam pelo resultado da primeira, e outros processos são
+    coordenados por uma trava no cache.
+    """
+    chave = _chave(latitude, longitude)
+    with _trava:
+        andamento = _em_andamento.get(chave)
+        dono = andamento is None
+        if dono:
+            andamento = _em_andamento[chave] = (threading.Event(), {})
+    evento, resultado = andamento
+
+    if not dono:
+        evento.wait(settings.GEOCODIFICACAO_TIMEOUT)
+        return resultado.get('endereco')
+
+    try:
+        trava = f'{chave}:trava'
+        if cache.add(trava, 1, timeout=settings.GEOCODIFICACAO_TIMEOUT + 1):
+            try:
+                resultado['endereco'] = _consultar_provedor(latitude, longitude)
+            finally:
+                cache.delete(trava)
+        else:
+            # Outro processo está consultando a mesma coordenada: aguarda o cache
+            limite = time.time() + settings.GEOCODIFICACAO_TIMEOUT
+            while time.time() < limite:
+                time.sleep(0.1)
+                endereco = cache.get(chave)
+                if endereco is not None:
+                    resultado['endereco'] = endereco or None
+                    break
+        return resultado.get('endereco')
+    finally:
+        evento.set()
+        with _trava:
+            _em_andamento.pop(chave, None)
+
+
+def endereco(latitude, longitude, cliente=None):
+    """
+    Retorna (endereço, latitude, longitude) com as coordenadas arredondadas
+    usadas na consulta. O endereço é None quando o provedor não o conhece
+    ou não está disponível no momento. Com ``cliente`` (ex.: o IP), levanta
+    LimiteExcedido se a coordenada precisaria do provedor e o cliente já
+    passou do limite por minuto.
+    """
+    latitude, longitude = arredondar(latitude), arredondar(longitude)
+    chave = _chave(latitude, longitude)
+
+    resultado = cache.get(chave)
+    if resultado is None:
+        salvo = (
+            EnderecoGeocodificado.objects.filter(latitude=latitude, longitude=longitude)
+            .values_list('endereco', flat=True).first()
+        )
+        if salvo is not None:
+            resultado = salvo
+            cache.set(chave, salvo, timeout=settings.GEOCODIFICACAO_CACHE_TIMEOUT)
+    if resultado is None:
+        if cliente is not None and not _dentro_do_limite(cliente):
+            raise LimiteExcedido(cliente)
+        resultado = _consulta_unica(latitude, longitude)
+    return resultado or None, latitude, longitude
@@ -0,0 +1,103 @@
+"""Geração das versões reduzidas (derivados) das imagens dos relatórios"""
+import posixpath
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from PIL import Image, ImageOps
+
+from .uploads import EXTENSOES as EXTENSOES_ORIGINAIS
+
+
+# Campo do modelo -> (sufixo do arquivo, configuração de largura, formato)
+DERIVADOS = {
+    'miniatura': ('miniatura', 'IMAGEM_MINIATURA_LARGURA', 'JPEG'),
+    'imagem_media': ('media', 'IMAGEM_MEDIA_LARGURA', 'JPEG'),
+    'miniatura_webp': ('miniatura', 'IMAGEM_MINIATURA_LARGURA', 'WEBP'),
+    'imagem_media_webp': ('media', 'IMAGEM_MEDIA_LARGURA', 'WEBP'),
+}
+
+EXTENSOES = {'JPEG': 'jpg', 'WEBP': 'webp'}
+
+
+def caminho_derivado(nome_original, sufixo, formato):
+    """Retorna o caminho do derivado ao lado da imagem original"""
+    diretorio, arquivo = posixpath.split(nome_original)
+    base = posixpath.splitext(arquivo)[0]
+    return posixpath.join(diretorio, 'derivados', f'{base}_{sufixo}.{EXTENSOES[formato]}')
+
+
+def filtro_do_arquivo(nome):
+    """
+    Filtro das ImagemRelatorio que usam o arquivo, como imagem original ou
+    como um dos derivados, ou None se o nome não segue nenhum dos padrões
+    """
+    diretorio, arquivo = posixpath.split(nome)
+    if posixpath.basename(diretorio) == 'derivados':
+        base, extensao = posixpath.splitext(arquivo)
+        for campo, (sufixo, _, formato) in DERIVADOS.items():
+            if extensao == f'.{EXTENSOES[formato]}' and base.endswith(f'_{sufixo}'):
+                # Localizado pela original, o que usa o índice de ``imagem``
+                original = posixpath.join(posixpath.dirname(diretorio), base[:-len(sufixo) - 1])
+                return Q(imagem__in=[original + ext for ext in EXTENSOES_ORIGINAIS], **{campo: nome})
+        return None
+    return Q(imagem=nome)
+
+
+def _para_rgb(imagem):
+    """Converte a imagem para RGB, aplicando fundo branco em áreas transparentes"""
+    if imagem.mode in ('RGBA', 'LA') or (imagem.mode == 'P' and 'transparency' in imagem.info):
+        imagem = imagem.convert('RGBA')
+        fundo = Image.new('RGB', imagem.size, (255, 255, 255))
+        fundo.paste(imagem, mask=imagem.getchannel('A'))
+        return fundo
+    return imagem.convert('RGB')
+
+
+def _redimensionar(imagem, largura):
+    """Reduz a imagem para a largura informada mantendo a proporção (nunca amplia)"""
+    if imagem.width <= largura:
+        return imagem
+    altura = max(1, round(imagem.height * largura / imagem.width))
+    return imagem.resize((largura, altura), Image.Resampling.LANCZOS)
+
+
+def _salvar(imagem, nome, formato, storage):
+    """Codifica a imagem e grava no storage, substituindo um derivado anterior"""
+    buffer = BytesIO()
+    opcoes = {'quality': settings.IMAGEM_DERIVADOS_QUALIDADE}
+    if formato == 'JPEG':
+        opcoes.update(optimize=True, progressive=True)
+    imagem.save(buffer, formato, **opcoes)
+    if storage.exists(nome):
+        storage.delete(nome)
+    return storage.save(nome, ContentFile(buffer.getvalue()))
+
+
+def gerar_derivados(nome_original, storage=None):
+    """
+    Gera miniatura, tamanho de exibição e, se habilitado, as versões WebP
+    de uma imagem já armazenada. Retorna um dicionário campo -> nome salvo.
+    """
+    storage = storage or default_storage
+
+    with storage.open(nome_original, 'rb') as arquivo:
+        with Image.open(arquivo) as original:
+            # Corrige a orientação da câmera; em GIFs animados usa o primeiro quadro
+            imagem = _para_rgb(ImageOps.exif_transpose(original))
+
+    versoes = {}
+    derivados = {}
+    for campo, (sufixo, configuracao, formato) in DERIVADOS.items():
+        if formato == 'WEBP' and not settings.IMAGEM_GERAR_WEBP:
+            derivados[campo] = ''
+            continue
+        largura = getattr(settings, configuracao)
+        if largura not in versoes:
+            versoes[largura] = _redimensionar(imagem, largura)
+        nome = caminho_derivado(nome_original, sufixo, formato)
+        derivados[campo] = _salvar(versoes[largura], nome, formato, storage)
+
+    return derivados
@@ -0,0 +1,124 @@
+"""
+Importação em massa de relatórios a partir de CSV ou NDJSON.
+
+Cada registro é validado pelas mesmas regras do ``RelatorioForm`` e os
+relatórios válidos são inseridos em lotes com ``bulk_create`` pelo comando
+``importar_relatorios``. Como o ``bulk_create`` não dispara os sinais, o
+comando soma as referências dos arquivos na transação de cada lote e
+recalcula ao final os contadores e os agregados do mapa (ver
+core/armazenamento.py, core/contadores.py e core/agrupamento.py). O vetor de
+busca é preenchido pelo trigger do banco.
+
+As imagens são gravadas antes da transação do lote. As de um registro
+recusado por causa de outra imagem são removidas após o commit, se nenhum
+relatório as usa; as de um lote interrompido (o progresso salvo não o
+inclui) ficam sem referência até o comando ``remover_arquivos_orfaos``.
+
+Colunas reconhecidas: titulo, conteudo, usuario (username de um usuário
+registrado), nome_usuario, email_usuario, latitude, longitude, endereco,
+data_criacao (ISO 8601) e imagens (caminhos relativos à pasta de imagens,
+separados por espaço no CSV ou em lista no NDJSON).
+"""
+import csv
+import json
+import os
+
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .armazenamento import armazenamento
+from .forms import RelatorioForm
+from .uploads import EXTENSOES, TAMANHO_ASSINATURA, tipo_pela_assinatura
+
+
+FORMATOS = ('csv', 'ndjson')
+
+
+def formato_do_arquivo(caminho):
+    """Formato deduzido pela extensão do arquivo"""
+    return 'ndjson' if caminho.lower().endswith(('.ndjson', '.jsonl')) else 'csv'
+
+
+def ler(arquivo, formato):
+    """Gera um dicionário por registro do arquivo aberto, sem carregá-lo inteiro"""
+    if formato == 'csv':
+        for linha in csv.DictReader(arquivo):
+            imagens = linha.get('imagens') or ''
+            yield dict(linha, imagens=imagens.split())
+        return
+    for linha in arquivo:
+        if linha.strip():
+            yield json.loads(linha)
+
+
+def _texto(valor):
+    return '' if valor is None else str(valor).strip()
+
+
+def validar(dados, usuarios, pasta_imagens=None):
+    """
+    Valida um registro com o RelatorioForm. Retorna (relatorio, imagens, erros):
+    o relatório ainda não salvo e os caminhos absolutos das imagens, ou os erros.
+    ``usuarios`` mapeia username -> User para os registros de usuários registrados.
+    """
+    erros = []
+    username = _texto(dados.get('usuario'))
+    usuario = usuarios.get(username) if username else None
+    if username and usuario is None:
+        erros.append(f'usuário {username} não encontrado')
+
+    form = RelatorioForm(
+        data={campo: _texto(dados.get(campo)) for campo in RelatorioForm.base_fields},
+        user=usuario,
+    )
+    if not form.is_valid():
+        erros.extend(
+            f'{campo}: {" ".join(mensagens)}' for campo, mensagens in form.errors.items()
+        )
+
+    data_criacao = timezone.now()
+    if _texto(dados.get('data_criacao')):
+        data_criacao = parse_datetime(_texto(dados['data_criacao']))
+        if data_criacao is None:
+            erros.append(f'data_criacao: data inválida ({dados["data_criacao"]})')
+        elif timezone.is_naive(data_criacao):
+            data_criacao = timezone.make_aware(data_criacao)
+
+    imagens = []
+    for nome in dados.get('imagens') or []:
+        if pasta_imagens is None:
+            erros.append('imagens informadas sem a pasta de imagens')
+            break
+        caminho = os.path.realpath(os.path.join(pasta_imagens, nome))
+        if not caminho.startswith(os.path.realpath(pasta_imagens) + os.sep):
+            erros.append(f'imagem fora da pasta de imagens: {nome}')
+        elif os.path.splitext(caminho)[1].lower() not in EXTENSOES:
+            erros.append(f'extensão de {nome} não suportada')
+        else:
+            imagens.append(caminho)
+
+    if erros:
+        return None, [], erros
+
+    relatorio = form.save(commit=False)
+    relatorio.usuario = usuario
+    relatorio.data_criacao = data_criacao
+    return relatorio, imagens, []
+
+
+def gravar_imagem(caminho):
+    """
+    Executado nos processos do comando de importação: verifica a imagem e a
+    grava no armazenamento por conteúdo. Retorna (caminho, nome no storage, erro).
+    """
+    try:
+        if os.path.getsize(caminho) > settings.MAX_UPLOAD_SIZE:
+            return caminho, None, f'{caminho}: arquivo maior que o tamanho máximo'
+        with open(caminho, 'rb') as arquivo:
+            if tipo_pela_assinatura(arquivo.read(TAMANHO_ASSINATURA)) is None:
+                return caminho, None, f'{caminho}: não é uma imagem JPG, PNG ou GIF válida'
+            return caminho, armazenamento.save(os.path.basename(caminho), File(arquivo)), None
+    except OSError as erro:
+        return caminho, None, f'{caminho}: {erro}'
@@ -0,0 +1,75 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import busca
+from core.models import Relatorio
+
+
+class Command(BaseCommand):
+    help = (
+        'Compara o tempo da busca do painel administrativo usando o índice de '
+        'busca textual com a implementação anterior baseada em icontains'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'termos',
+            nargs='*',
+            default=['buraco', 'iluminação pública', 'calçada quebrada', 'lixo'],
+            help='Termos de busca a medir',
+        )
+        parser.add_argument(
+            '--repeticoes',
+            type=int,
+            default=20,
+            help='Quantidade de execuções por termo e implementação',
+        )
+        parser.add_argument(
+            '--por-pagina',
+            type=int,
+            default=15,
+            help='Tamanho da página carregada em cada execução (como em admin_relatorios)',
+        )
+        parser.add_argument(
+            '--explain',
+            action='store_true',
+            help='Mostra o plano de execução de cada consulta',
+        )
+
+    def _medir(self, relatorios, repeticoes, por_pagina):
+        """Executa a contagem e a primeira página, como faz a view, e retorna os tempos em ms"""
+        tempos = []
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            relatorios.count()
+            list(relatorios.select_related('usuario')[:por_pagina])
+            tempos.append((time.perf_counter() - inicio) * 1000)
+        return tempos
+
+    def handle(self, *args, **options):
+        base = Relatorio.objects.all()
+        self.stdout.write(f'{base.count()} relatório(s) na base; {options["repeticoes"]} repetições por termo\n')
+
+        implementacoes = [
+            ('icontains', busca.buscar_icontains),
+            ('full-text', busca.buscar),
+        ]
+        cabecalho = f'{"termo":<25} {"implementação":<14} {"resultados":>10} {"mediana ms":>11} {"p95 ms":>9}'
+        self.stdout.write(cabecalho)
+        self.stdout.write('-' * len(cabecalho))
+
+        for termo in options['termos']:
+            for nome, funcao in implementacoes:
+                relatorios = funcao(base, termo)
+                # Aquecimento: descarta o efeito do cache frio na primeira execução
+                total = relatorios.count()
+                tempos = sorted(self._medir(relatorios, options['repeticoes'], options['por_pagina']))
+                p95 = tempos[min(len(tempos) - 1, int(len(tempos) * 0.95))]
+                self.stdout.write(
+                    f'{termo:<25} {nome:<14} {total:>10} {statistics.median(tempos):>11.2f} {p95:>9.2f}'
+                )
+                if options['explain']:
+                    plano = relatorios.select_related('usuario')[:options['por_pagina']].explain(analyze=True)
+                    self.stdout.write(self.style.NOTICE(plano))
@@ -0,0 +1,167 @@
+import math
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import proximidade
+from core.models import Relatorio
+
+
+def _haversine(latitude1, longitude1, latitude2, longitude2):
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * proximidade.RAIO_TERRA * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def _varredura(latitude, longitude, metros=None, k=None):
+    """Implementação sem índice: lê todas as coordenadas e calcula as distâncias no Python"""
+    distancias = []
+    coordenadas = Relatorio.objects.filter(latitude__isnull=False).values_list('pk', 'latitude', 'longitude')
+    for pk, lat, lng in coordenadas.iterator(chunk_size=10000):
+        distancia = _haversine(latitude, longitude, float(lat), float(lng))
+        if metros is None or distancia <= metros:
+            distancias.append((distancia, pk))
+    distancias.sort()
+    return [pk for _, pk in distancias[:k]] if k else [pk for _, pk in distancias]
+
+
+class Command(BaseCommand):
+    help = (
+        'Compara o tempo das consultas por proximidade (relatórios num raio e os k mais '
+        'próximos) de core/proximidade.py com a varredura de todas as coordenadas no Python'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--raios',
+            type=float,
+            nargs='+',
+            default=[300, 1000, 5000],
+            help='Raios medidos, em metros',
+        )
+        parser.add_argument(
+            '--k',
+            type=int,
+            default=proximidade.K_PADRAO,
+            help='Quantidade de vizinhos na consulta dos mais próximos',
+        )
+        parser.add_argument(
+            '--pontos',
+            type=int,
+            default=20,
+            help='Pontos de consulta, sorteados perto de relatórios existentes',
+        )
+        parser.add_argument(
+            '--varredura',
+            type=int,
+            default=3,
+            help='Pontos medidos também com a varredura no Python (lenta em bases grandes; 0 para pular)',
+        )
+        parser.add_argument(
+            '--semente',
+            type=int,
+            default=1,
+            help='Semente do sorteio dos pontos',
+        )
+        parser.add_argument(
+            '--explain',
+            action='store_true',
+            help='Mostra o plano de execução da consulta no raio para o primeiro ponto',
+        )
+
+    def _pontos(self, quantidade, semente):
+        """Pontos a até ~500 m de relatórios sorteados: consultas onde há relatórios, como as das equipes"""
+        aleatorio = random.Random(semente)
+        localizados = Relatorio.objects.filter(latitude__isnull=False)
+        maximo = localizados.order_by('-pk').values_list('pk', flat=True).first() or 0
+        pontos = []
+        for _ in range(quantidade * 10):
+            if len(pontos) == quantidade or not maximo:
+                break
+            linha = (
+                localizados.filter(pk__gte=aleatorio.randint(1, maximo))
+                .order_by('pk').values_list('latitude', 'longitude').first()
+            )
+            if linha:
+                deslocamento = 500 / proximidade.METROS_POR_GRAU
+                pontos.append((
+                    float(linha[0]) + aleatorio.uniform(-deslocamento, deslocamento),
+                    float(linha[1]) + aleatorio.uniform(-deslocamento, deslocamento),
+                ))
+        return pontos
+
+    def _medir(self, nome, implementacao, pontos, consulta):
+        tempos, resultados = [], []
+        for latitude, longitude in pontos:
+            inicio = time.perf_counter()
+            resultados.append(consulta(latitude, longitude))
+            tempos.append((time.perf_counter() - inicio) * 1000)
+        tempos.sort()
+        p95 = tempos[min(len(tempos) - 1, int(len(tempos) * 0.95))]
+        media = statistics.mean(len(resultado) for resultado in resultados)
+        self.stdout.write(
+            f'{nome:<18} {implementacao:<12} {len(pontos):>6} {media:>11.1f} '
+            f'{statistics.median(tempos):>11.2f} {p95:>9.2f}'
+        )
+        return resultados
+
+    def handle(self, *args, **options):
+        total = Relatorio.objects.filter(latitude__isnull=False).count()
+        pontos = self._pontos(options['pontos'], options['semente'])
+        if not pontos:
+            self.stdout.write('Nenhum relatório com localização na base')
+            return
+        varredura = pontos[:options['varredura']]
+        self.stdout.write(f'{total} relatório(s) com localização; {len(pontos)} ponto(s) de consulta\n')
+
+        cabecalho = (
+            f'{"consulta":<18} {"implementação":<12} {"pontos":>6} {"resultados":>11} '
+            f'{"mediana ms":>11} {"p95 ms":>9}'
+        )
+        self.stdout.write(cabecalho)
+        self.stdout.write('-' * len(cabecalho))
+
+        base = Relatorio.objects.all()
+        # Aquecimento: descarta o efeito do cache frio na primeira execução
+        list(proximidade.no_raio(base, *pontos[0], options['raios'][0]).values_list('pk', flat=True))
+
+        consultas = [
+            (
+                f'raio {metros:g} m',
+                lambda latitude, longitude, metros=metros: list(
+                    proximidade.no_raio(base, latitude, longitude, metros).values_list('pk', flat=True)
+                ),
+                lambda latitude, longitude, metros=metros: _varredura(latitude, longitude, metros=metros),
+            )
+            for metros in options['raios']
+        ]
+        consultas.append((
+            f'{options["k"]} mais próximos',
+            lambda latitude, longitude: [
+                relatorio.pk for relatorio in proximidade.mais_proximos(
+                    base.only('pk'), latitude, longitude, options['k']
+                )
+            ],
+            lambda latitude, longitude: _varredura(latitude, longitude, k=options['k']),
+        ))
+
+        divergencias = 0
+        for nome, indexada, sem_indice in consultas:
+            resultados = self._medir(nome, 'índice', pontos, indexada)
+            if varredura:
+                esperados = self._medir(nome, 'varredura', varredura, sem_indice)
+                # Mesmos relatórios (empates na distância podem trocar a ordem)
+                divergencias += sum(
+                    set(obtido) != set(esperado) for obtido, esperado in zip(resultados, esperados)
+                )
+
+        if options['explain']:
+            plano = proximidade.no_raio(base, *pontos[0], options['raios'][0]).explain(analyze=True)
+            self.stdout.write(self.style.NOTICE(plano))
+        if divergencias:
+            self.stdout.write(self.style.ERROR(f'{divergencias} consulta(s) com resultado diferente da varredura'))
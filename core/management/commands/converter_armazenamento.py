@@ -0,0 +1,162 @@
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from core import cache_respostas
+from core.armazenamento import PREFIXO, armazenamento, calcular_hash, caminho_conteudo, reconciliar
+from core.imagens import DERIVADOS, caminho_derivado
+from core.models import ImagemRelatorio
+
+
+def _inicializar_processo():
+    """Garante o Django configurado em processos iniciados via spawn"""
+    django.setup()
+
+
+def _vincular(origem, destino):
+    """
+    Cria o destino como hard link da origem (cópia entre sistemas de arquivos
+    diferentes). Retorna False se o destino já existia (conteúdo repetido),
+    inclusive quando outro processo o criou ao mesmo tempo.
+    """
+    if os.path.exists(destino):
+        return False
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    try:
+        os.link(origem, destino)
+    except FileExistsError:
+        return False
+    except OSError:
+        shutil.copy2(origem, destino)
+    return True
+
+
+def _remover(caminho):
+    try:
+        os.remove(caminho)
+    except FileNotFoundError:
+        pass
+    # Remove as pastas relatorios/<id>/derivados e relatorios/<id> que ficaram vazias
+    for pasta in (os.path.dirname(caminho), os.path.dirname(os.path.dirname(caminho))):
+        try:
+            os.rmdir(pasta)
+        except OSError:
+            pass
+
+
+def _converter(linha):
+    """
+    Executado nos processos filhos: calcula o hash da imagem e a vincula, com
+    os derivados, nos caminhos por conteúdo. Retorna (pk, campos, bytes
+    liberados por conteúdo repetido, erro).
+    """
+    pk, nome = linha[0], linha[1]
+    origem = armazenamento.path(nome)
+    try:
+        with open(origem, 'rb') as arquivo:
+            sha256 = calcular_hash(File(arquivo))
+        novo = caminho_conteudo(sha256, os.path.splitext(nome)[1])
+        liberados = 0 if _vincular(origem, armazenamento.path(novo)) else os.path.getsize(origem)
+    except OSError as erro:
+        return pk, None, 0, f'{nome}: {erro}'
+
+    campos = {'imagem': novo}
+    for (campo, (sufixo, _, formato)), derivado in zip(DERIVADOS.items(), linha[2:]):
+        campos[campo] = ''
+        if not derivado:
+            continue
+        novo_derivado = caminho_derivado(novo, sufixo, formato)
+        origem, destino = armazenamento.path(derivado), armazenamento.path(novo_derivado)
+        if os.path.exists(origem):
+            _vincular(origem, destino)
+        if os.path.exists(destino):
+            campos[campo] = novo_derivado
+    return pk, campos, liberados, None
+
+
+class Command(BaseCommand):
+    help = (
+        'Converte as imagens gravadas em media/relatorios/<id>/ para o armazenamento '
+        'por conteúdo (conteudo/<aa>/<bb>/<sha256>), unificando arquivos repetidos. '
+        'Pode ser interrompido e executado de novo: continua pelas imagens ainda não convertidas'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processos',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Número de processos que leem, vinculam e removem os arquivos',
+        )
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=500,
+            help='Quantidade de imagens convertidas e atualizadas no banco por vez',
+        )
+
+    def handle(self, *args, **options):
+        imagens = ImagemRelatorio.objects.exclude(imagem='').exclude(
+            imagem__startswith=PREFIXO + '/'
+        )
+        total = imagens.count()
+        self.stdout.write(f'{total} imagem(ns) para converter com {options["processos"]} processo(s)')
+
+        # Conexões abertas não podem ser compartilhadas com os processos filhos
+        connections.close_all()
+
+        campos = ['imagem'] + list(DERIVADOS)
+        convertidas = repetidas = falhas = bytes_liberados = 0
+        ultimo_pk = 0
+        with ProcessPoolExecutor(max_workers=options['processos'], initializer=_inicializar_processo) as executor:
+            while True:
+                # Paginação por chave primária: as imagens convertidas saem do filtro
+                lote = list(
+                    imagens.filter(pk__gt=ultimo_pk)
+                    .order_by('pk')
+                    .values_list('pk', *campos)[:options['lote']]
+                )
+                if not lote:
+                    break
+                ultimo_pk = lote[-1][0]
+
+                atualizadas = []
+                antigos = set()
+                for linha, (pk, campos_novos, liberados, erro) in zip(
+                    lote, executor.map(_converter, lote, chunksize=8)
+                ):
+                    if erro:
+                        self.stderr.write(f'Falha ao converter {erro}')
+                        falhas += 1
+                        continue
+                    atualizadas.append(ImagemRelatorio(pk=pk, **campos_novos))
+                    antigos.update(nome for nome in linha[1:] if nome)
+                    if liberados:
+                        repetidas += 1
+                        bytes_liberados += liberados
+
+                with transaction.atomic():
+                    ImagemRelatorio.objects.bulk_update(atualizadas, campos)
+
+                # Só remove os arquivos antigos que nenhuma outra imagem ainda usa
+                ainda_usados = set(
+                    ImagemRelatorio.objects.filter(imagem__in=antigos).values_list('imagem', flat=True)
+                )
+                caminhos = [armazenamento.path(nome) for nome in antigos - ainda_usados]
+                list(executor.map(_remover, caminhos, chunksize=16))
+
+                convertidas += len(atualizadas)
+                self.stdout.write(f'{convertidas + falhas}/{total} imagens processadas')
+
+        arquivos = reconciliar()
+        cache_respostas.invalidar_tudo()
+        self.stdout.write(self.style.SUCCESS(
+            f'{convertidas} imagem(ns) convertida(s), {repetidas} com conteúdo repetido '
+            f'({bytes_liberados / 1024 / 1024:.1f} MB liberados), {falhas} falha(s); '
+            f'{arquivos} arquivo(s) distintos referenciados'
+        ))
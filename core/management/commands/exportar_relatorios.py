@@ -0,0 +1,71 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from core import exportacao
+from core.models import Relatorio
+from core.views import filtrar_relatorios
+
+
+class Command(BaseCommand):
+    help = 'Exporta os relatórios em CSV, GeoJSON ou NDJSON, lendo a base em lotes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--formato',
+            choices=sorted(exportacao.FORMATOS),
+            default='csv',
+            help='Formato do arquivo exportado',
+        )
+        parser.add_argument(
+            '--saida',
+            default='-',
+            help='Arquivo de saída (padrão: saída padrão)',
+        )
+        parser.add_argument(
+            '--gzip',
+            action='store_true',
+            help='Compacta a saída com gzip',
+        )
+        parser.add_argument(
+            '--search',
+            default='',
+            help='Exporta apenas os relatórios encontrados pela busca',
+        )
+        parser.add_argument(
+            '--usuario',
+            default='',
+            help='Exporta apenas os relatórios do usuário informado',
+        )
+        parser.add_argument(
+            '--url-base',
+            default='',
+            help='Endereço do site usado nas URLs das imagens (ex.: https://servidor/)',
+        )
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=2000,
+            help='Quantidade de relatórios lidos do banco por vez',
+        )
+
+    def handle(self, *args, **options):
+        relatorios = filtrar_relatorios(Relatorio.objects.all(), options['search'], options['usuario'])
+        blocos = exportacao.exportar(
+            relatorios,
+            options['formato'],
+            url_base=options['url_base'],
+            comprimir=options['gzip'],
+            tamanho_lote=options['lote'],
+        )
+
+        if options['saida'] == '-':
+            for bloco in blocos:
+                sys.stdout.buffer.write(bloco)
+            sys.stdout.buffer.flush()
+            return
+
+        with open(options['saida'], 'wb') as arquivo:
+            for bloco in blocos:
+                arquivo.write(bloco)
+        self.stdout.write(self.style.SUCCESS(f'Relatórios exportados para {options["saida"]}'))
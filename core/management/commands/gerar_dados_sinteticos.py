@@ -0,0 +1,276 @@
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time
+from decimal import Decimal
+from functools import lru_cache
+from itertools import accumulate
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from core import agrupamento, armazenamento, cache_respostas, contadores, facetas, sinteticos
+from core.imagens import gerar_derivados
+from core.models import ImagemRelatorio, Relatorio
+
+
+PREFIXO_USUARIOS = 'sintetico'
+
+# Quantidade de imagens por relatório e a frequência de cada uma
+IMAGENS_POR_RELATORIO = (0, 1, 2, 3, 4)
+FREQUENCIA_IMAGENS = (45, 30, 15, 7, 3)
+
+
+def _inicializar_processo():
+    """Garante o Django configurado em processos iniciados via spawn"""
+    django.setup()
+
+
+@lru_cache(maxsize=None)
+def _pesos_zipf(quantidade):
+    # Poucos autores frequentes e muitos ocasionais
+    return list(accumulate(1 / posicao for posicao in range(1, quantidade + 1)))
+
+
+@lru_cache(maxsize=100000)
+def _anonimo(semente, numero):
+    """(nome, email, token) do visitante anônimo ``numero``, igual em todos os lotes e processos"""
+    aleatorio = random.Random(f'{semente}-anonimo-{numero}')
+    return (*sinteticos.pessoa(aleatorio), sinteticos.token(aleatorio))
+
+
+def _gravar_imagem(indice, semente, largura, altura):
+    """Executado nos processos: gera e grava uma imagem e seus derivados"""
+    aleatorio = random.Random(f'{semente}-imagem-{indice}')
+    conteudo = sinteticos.jpeg(aleatorio, largura, altura, qualidade=80)
+    nome = armazenamento.armazenamento.save(f'sintetico_{indice}.jpg', ContentFile(conteudo))
+    return {'imagem': nome, **gerar_derivados(nome)}
+
+
+def _gerar_lote(indice, quantidade, parametros):
+    """
+    Executado nos processos: gera e insere um lote de relatórios. A semente do
+    lote depende só da semente geral e do índice, então o resultado não muda
+    com o número de processos.
+    """
+    aleatorio = random.Random(f'{parametros["semente"]}-lote-{indice}')
+    usuarios = parametros['usuarios']
+    relatorios, imagens = [], []
+    for _ in range(quantidade):
+        cidade, latitude, longitude = sinteticos.ponto(aleatorio, parametros['focos'])
+        titulo, conteudo, endereco = sinteticos.texto(aleatorio, cidade)
+        relatorio = Relatorio(
+            titulo=titulo,
+            conteudo=conteudo,
+            endereco=endereco,
+            latitude=Decimal(f'{latitude:.6f}'),
+            longitude=Decimal(f'{longitude:.6f}'),
+            data_criacao=sinteticos.data_criacao(
+                aleatorio, parametros['fim'], parametros['dias'], parametros['tempestades']
+            ),
+        )
+        if not usuarios or aleatorio.random() < parametros['fracao_anonimos']:
+            numero = aleatorio.choices(
+                range(parametros['anonimos']), cum_weights=_pesos_zipf(parametros['anonimos'])
+            )[0]
+            relatorio.nome_usuario, relatorio.email_usuario, relatorio.token_anonimo = _anonimo(
+                parametros['semente'], numero
+            )
+        else:
+            relatorio.usuario_id = aleatorio.choices(usuarios, cum_weights=_pesos_zipf(len(usuarios)))[0]
+
+        escolhidas = []
+        if parametros['imagens']:
+            quantidade_imagens = aleatorio.choices(IMAGENS_POR_RELATORIO, weights=FREQUENCIA_IMAGENS)[0]
+            escolhidas = [aleatorio.choice(parametros['imagens']) for _ in range(quantidade_imagens)]
+        # Já com o valor final: a reconciliação dos contadores não precisa corrigir nada
+        relatorio.num_imagens = len(escolhidas)
+        relatorios.append(relatorio)
+        imagens.append(escolhidas)
+
+    with transaction.atomic():
+        Relatorio.objects.bulk_create(relatorios, batch_size=1000)
+        ImagemRelatorio.objects.bulk_create(
+            [
+                ImagemRelatorio(relatorio=relatorio, ordem=ordem, **arquivos)
+                for relatorio, escolhidas in zip(relatorios, imagens)
+                for ordem, arquivos in enumerate(escolhidas)
+            ],
+            batch_size=1000,
+        )
+    return len(relatorios), sum(map(len, imagens))
+
+
+class Command(BaseCommand):
+    help = (
+        'Gera uma base sintética de relatórios para testes de escala: concentrados em focos '
+        'nas maiores cidades, com texto em português, autores registrados e anônimos, datas '
+        'concentradas nos últimos meses e após tempestades, e imagens pequenas. A mesma '
+        'semente gera os mesmos dados (ver core/sinteticos.py)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--relatorios',
+            type=int,
+            default=100000,
+            help='Quantidade de relatórios a gerar',
+        )
+        parser.add_argument(
+            '--usuarios',
+            type=int,
+            default=2000,
+            help=f'Usuários registrados autores dos relatórios ({PREFIXO_USUARIOS}NNNNNN, criados se preciso)',
+        )
+        parser.add_argument(
+            '--anonimos',
+            type=int,
+            default=20000,
+            help='Visitantes anônimos distintos (cada um com nome, email e token próprios)',
+        )
+        parser.add_argument(
+            '--fracao-anonimos',
+            type=float,
+            default=0.6,
+            help='Fração dos relatórios criados por visitantes anônimos',
+        )
+        parser.add_argument(
+            '--imagens-distintas',
+            type=int,
+            default=200,
+            help='Imagens distintas gravadas e compartilhadas entre os relatórios (0 para nenhuma)',
+        )
+        parser.add_argument(
+            '--tamanho-imagem',
+            default='640x480',
+            help='Largura x altura das imagens geradas',
+        )
+        parser.add_argument(
+            '--dias',
+            type=int,
+            default=730,
+            help='Período coberto pelas datas de criação, em dias',
+        )
+        parser.add_argument(
+            '--tempestades',
+            type=int,
+            default=12,
+            help='Quantidade de tempestades no período (picos de relatórios)',
+        )
+        parser.add_argument(
+            '--data-final',
+            help='Data mais recente dos relatórios, AAAA-MM-DD (padrão: hoje)',
+        )
+        parser.add_argument(
+            '--semente',
+            type=int,
+            default=42,
+            help='Semente dos dados gerados',
+        )
+        parser.add_argument(
+            '--processos',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Número de processos que geram e inserem os lotes',
+        )
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=5000,
+            help='Relatórios gerados e inseridos por vez (mantenha o valor para repetir os mesmos dados)',
+        )
+
+    def _tamanho_imagem(self, valor):
+        try:
+            largura, altura = (int(parte) for parte in valor.lower().split('x'))
+        except ValueError:
+            raise CommandError(f'Tamanho de imagem inválido: {valor} (use LARGURAxALTURA)')
+        return largura, altura
+
+    def _usuarios(self, quantidade):
+        """IDs dos usuários sintéticos, criando os que faltarem"""
+        usernames = [f'{PREFIXO_USUARIOS}{numero:06d}' for numero in range(1, quantidade + 1)]
+        existentes = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+        # Sem senha utilizável: não é possível entrar com esses usuários
+        senha = make_password(None)
+        User.objects.bulk_create(
+            [
+                User(username=username, email=f'{username}@{sinteticos.DOMINIO_EMAIL}', password=senha)
+                for username in usernames if username not in existentes
+            ],
+            batch_size=1000,
+        )
+        ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'pk'))
+        return [ids[username] for username in usernames]
+
+    def handle(self, *args, **options):
+        largura, altura = self._tamanho_imagem(options['tamanho_imagem'])
+        if not 0 <= options['fracao_anonimos'] <= 1:
+            raise CommandError('--fracao-anonimos deve estar entre 0 e 1')
+        if options['anonimos'] < 1:
+            raise CommandError('--anonimos deve ser ao menos 1')
+        data_final = timezone.localdate()
+        if options['data_final']:
+            data_final = parse_date(options['data_final'])
+            if data_final is None:
+                raise CommandError(f'Data inválida: {options["data_final"]}')
+
+        aleatorio = random.Random(options['semente'])
+        fim = timezone.make_aware(datetime.combine(data_final, time(23, 59, 59)))
+        parametros = {
+            'semente': options['semente'],
+            'focos': sinteticos.focos(aleatorio),
+            'tempestades': sinteticos.tempestades(aleatorio, fim, options['dias'], options['tempestades']),
+            'fim': fim,
+            'dias': options['dias'],
+            'fracao_anonimos': options['fracao_anonimos'],
+            'anonimos': options['anonimos'],
+            'usuarios': self._usuarios(options['usuarios']),
+        }
+
+        # Conexões abertas não podem ser compartilhadas com os processos filhos
+        connections.close_all()
+
+        with ProcessPoolExecutor(max_workers=options['processos'], initializer=_inicializar_processo) as executor:
+            self.stdout.write(f'Gerando {options["imagens_distintas"]} imagem(ns) de {largura}x{altura}...')
+            parametros['imagens'] = list(executor.map(
+                _gravar_imagem,
+                range(options['imagens_distintas']),
+                [options['semente']] * options['imagens_distintas'],
+                [largura] * options['imagens_distintas'],
+                [altura] * options['imagens_distintas'],
+            ))
+
+            lotes = [
+                (indice, min(options['lote'], options['relatorios'] - inicio))
+                for indice, inicio in enumerate(range(0, options['relatorios'], options['lote']))
+            ]
+            gerados = imagens = 0
+            resultados = executor.map(
+                _gerar_lote,
+                [indice for indice, _ in lotes],
+                [quantidade for _, quantidade in lotes],
+                [parametros] * len(lotes),
+            )
+            for relatorios_lote, imagens_lote in resultados:
+                gerados += relatorios_lote
+                imagens += imagens_lote
+                self.stdout.write(f'{gerados} de {options["relatorios"]} relatórios gerados')
+
+        # O bulk_create não dispara os sinais: recalcula o que eles manteriam
+        self.stdout.write('Recalculando contadores, agregados do mapa e referências das imagens...')
+        contadores.reconciliar()
+        agrupamento.recalcular()
+        armazenamento.reconciliar()
+        facetas.invalidar()
+        cache_respostas.invalidar_tudo()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{gerados} relatório(s) e {imagens} imagem(ns) de relatório gerados'
+        ))
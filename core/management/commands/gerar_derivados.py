@@ -0,0 +1,92 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from PIL import Image
+
+from core import cache_respostas
+from core.imagens import gerar_derivados
+from core.models import ImagemRelatorio
+
+
+def _inicializar_processo():
+    """Garante o Django configurado em processos iniciados via spawn"""
+    django.setup()
+
+
+def _processar(item):
+    """Executado nos processos filhos: gera os derivados de uma imagem"""
+    pk, nome = item
+    try:
+        return pk, gerar_derivados(nome), None
+    except (OSError, Image.DecompressionBombError) as erro:
+        return pk, None, f'{nome}: {erro}'
+
+
+class Command(BaseCommand):
+    help = 'Gera (ou regenera) as miniaturas e versões de exibição das imagens dos relatórios em paralelo'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--todas',
+            action='store_true',
+            help='Regenera os derivados também das imagens que já os possuem',
+        )
+        parser.add_argument(
+            '--processos',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Número de processos para o processamento das imagens',
+        )
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=500,
+            help='Quantidade de imagens lidas e atualizadas no banco por vez',
+        )
+
+    def handle(self, *args, **options):
+        imagens = ImagemRelatorio.objects.exclude(imagem='')
+        if not options['todas']:
+            imagens = imagens.filter(miniatura='')
+
+        total = imagens.count()
+        self.stdout.write(f'{total} imagem(ns) para processar com {options["processos"]} processo(s)')
+
+        # Conexões abertas não podem ser compartilhadas com os processos filhos
+        connections.close_all()
+
+        processadas = falhas = 0
+        ultimo_pk = 0
+        with ProcessPoolExecutor(max_workers=options['processos'], initializer=_inicializar_processo) as executor:
+            while True:
+                # Paginação por chave primária para não manter um cursor aberto
+                lote = list(
+                    imagens.filter(pk__gt=ultimo_pk)
+                    .order_by('pk')
+                    .values_list('pk', 'imagem')[:options['lote']]
+                )
+                if not lote:
+                    break
+                ultimo_pk = lote[-1][0]
+
+                atualizadas = []
+                for pk, derivados, erro in executor.map(_processar, lote, chunksize=8):
+                    if erro:
+                        falhas += 1
+                        self.stderr.write(f'Falha na imagem {pk}: {erro}')
+                        continue
+                    atualizadas.append(ImagemRelatorio(pk=pk, **derivados))
+
+                if atualizadas:
+                    ImagemRelatorio.objects.bulk_update(atualizadas, ImagemRelatorio.CAMPOS_DERIVADOS)
+                processadas += len(atualizadas)
+                self.stdout.write(f'{processadas + falhas}/{total} imagens processadas')
+
+        # As páginas de detalhes em cache ainda apontam para as imagens originais
+        cache_respostas.invalidar_tudo()
+        self.stdout.write(self.style.SUCCESS(
+            f'Derivados gerados para {processadas} imagem(ns); {falhas} falha(s)'
+        ))
@@ -0,0 +1,179 @@
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from core import agrupamento, armazenamento, contadores, facetas, importacao
+from core.models import ImagemRelatorio, ProgressoImportacao, Relatorio
+
+
+def _inicializar_processo():
+    """Garante o Django configurado em processos iniciados via spawn"""
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = (
+        'Importa relatórios em massa de um arquivo CSV ou NDJSON, validando cada registro '
+        'com as regras do formulário e inserindo em lotes (ver core/importacao.py)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('arquivo', help='Arquivo CSV ou NDJSON com os relatórios')
+        parser.add_argument(
+            '--formato',
+            choices=importacao.FORMATOS,
+            help='Formato do arquivo (padrão: deduzido pela extensão)',
+        )
+        parser.add_argument(
+            '--imagens',
+            help='Pasta base dos caminhos informados na coluna imagens',
+        )
+        parser.add_argument(
+            '--reiniciar',
+            action='store_true',
+            help='Ignora o progresso salvo de uma importação anterior e importa desde o primeiro registro',
+        )
+        parser.add_argument(
+            '--processos',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Número de processos para a gravação das imagens',
+        )
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=1000,
+            help='Quantidade de registros validados e inseridos por vez',
+        )
+        parser.add_argument(
+            '--sem-derivados',
+            action='store_true',
+            help='Não gera as miniaturas ao final (use depois o comando gerar_derivados)',
+        )
+
+    def _carregar_progresso(self, options, arquivo):
+        """Progresso salvo da importação do arquivo (ver ProgressoImportacao), ou um novo"""
+        tamanho = os.path.getsize(arquivo)
+        progresso, criado = ProgressoImportacao.objects.get_or_create(
+            arquivo=arquivo, defaults={'tamanho': tamanho}
+        )
+        if criado or options['reiniciar']:
+            progresso.tamanho = tamanho
+            progresso.registros = progresso.importados = progresso.rejeitados = 0
+            progresso.save()
+        elif progresso.tamanho != tamanho:
+            raise CommandError(
+                f'O arquivo {arquivo} mudou desde a importação interrompida; use --reiniciar para ignorá-la'
+            )
+        return progresso
+
+    def _gravar_imagens(self, executor, validos):
+        """Grava as imagens do lote em paralelo; retorna {caminho: nome no storage} e os erros"""
+        caminhos = {caminho for _, _, imagens in validos for caminho in imagens}
+        gravadas, erros = {}, {}
+        for caminho, nome, erro in executor.map(importacao.gravar_imagem, caminhos, chunksize=8):
+            if erro:
+                erros[caminho] = erro
+            else:
+                gravadas[caminho] = nome
+        return gravadas, erros
+
+    def _regravar_removidas(self, gravadas, usadas):
+        """
+        Grava de novo os arquivos removidos por uma liberação simultânea entre a
+        gravação nos processos e a trava das referências do lote
+        """
+        origens = {nome: caminho for caminho, nome in gravadas.items()}
+        for nome in usadas:
+            if not armazenamento.armazenamento.exists(nome):
+                _, _, erro = importacao.gravar_imagem(origens[nome])
+                if erro:
+                    raise CommandError(erro)
+
+    def handle(self, *args, **options):
+        arquivo = os.path.abspath(options['arquivo'])
+        formato = options['formato'] or importacao.formato_do_arquivo(arquivo)
+        pasta_imagens = options['imagens'] and os.path.abspath(options['imagens'])
+        progresso = self._carregar_progresso(options, arquivo)
+        if progresso.registros:
+            self.stdout.write(f'Retomando a importação após o registro {progresso.registros}')
+
+        # Conexões abertas não podem ser compartilhadas com os processos filhos
+        connections.close_all()
+
+        with open(arquivo, encoding='utf-8-sig', newline='') as entrada, \
+                ProcessPoolExecutor(max_workers=options['processos'], initializer=_inicializar_processo) as executor:
+            registros = islice(importacao.ler(entrada, formato), progresso.registros, None)
+            while True:
+                lote = list(islice(registros, options['lote']))
+                if not lote:
+                    break
+                numero = progresso.registros
+
+                usernames = {str(dados['usuario']).strip() for dados in lote if dados.get('usuario')}
+                usuarios = {usuario.username: usuario for usuario in User.objects.filter(username__in=usernames)}
+
+                validos = []
+                for indice, dados in enumerate(lote, start=numero + 1):
+                    relatorio, imagens, erros = importacao.validar(dados, usuarios, pasta_imagens)
+                    if erros:
+                        progresso.rejeitados += 1
+                        self.stderr.write(f'Registro {indice} rejeitado: {"; ".join(erros)}')
+                    else:
+                        validos.append((indice, relatorio, imagens))
+
+                gravadas, erros_imagens = self._gravar_imagens(executor, validos)
+                relatorios, imagens_por_relatorio, descartadas = [], [], set()
+                for indice, relatorio, imagens in validos:
+                    erros = [erros_imagens[caminho] for caminho in imagens if caminho in erros_imagens]
+                    if erros:
+                        progresso.rejeitados += 1
+                        self.stderr.write(f'Registro {indice} rejeitado: {"; ".join(erros)}')
+                        # As outras imagens do registro já foram gravadas
+                        descartadas.update(gravadas[caminho] for caminho in imagens if caminho in gravadas)
+                        continue
+                    relatorios.append(relatorio)
+                    imagens_por_relatorio.append(imagens)
+                usadas = Counter(gravadas[caminho] for imagens in imagens_por_relatorio for caminho in imagens)
+
+                with transaction.atomic():
+                    # As referências travam os arquivos até o commit (ver core/armazenamento.py)
+                    armazenamento.referenciar_varios(usadas)
+                    self._regravar_removidas(gravadas, usadas)
+                    Relatorio.objects.bulk_create(relatorios)
+                    ImagemRelatorio.objects.bulk_create(
+                        [
+                            ImagemRelatorio(relatorio=relatorio, imagem=gravadas[caminho], ordem=ordem)
+                            for relatorio, imagens in zip(relatorios, imagens_por_relatorio)
+                            for ordem, caminho in enumerate(imagens)
+                        ],
+                        batch_size=options['lote'],
+                    )
+                    # Na mesma transação: o progresso salvo nunca fica atrás dos lotes gravados
+                    progresso.registros = numero + len(lote)
+                    progresso.importados += len(relatorios)
+                    progresso.save()
+                # Só as que nenhum relatório, deste ou de outro lote, referencia
+                armazenamento.remover_sem_referencias(sorted(descartadas - set(usadas)))
+                self.stdout.write(f'{progresso.registros} registros lidos, {progresso.importados} importados')
+
+        # O bulk_create não dispara os sinais: recalcula o que eles manteriam
+        self.stdout.write('Recalculando contadores e agregados do mapa...')
+        contadores.reconciliar()
+        agrupamento.recalcular()
+        facetas.invalidar()
+        if not options['sem_derivados']:
+            call_command('gerar_derivados', processos=options['processos'], stdout=self.stdout, stderr=self.stderr)
+
+        progresso.delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'{progresso.importados} relatório(s) importado(s); '
+            f'{progresso.rejeitados} registro(s) rejeitado(s)'
+        ))
@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core import tarefas
+
+
+class Command(BaseCommand):
+    help = 'Worker da fila de tarefas em segundo plano (gravação de imagens, geração de derivados)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--uma-vez',
+            action='store_true',
+            help='Processa as tarefas disponíveis e termina, em vez de aguardar novas',
+        )
+        parser.add_argument(
+            '--intervalo',
+            type=float,
+            default=settings.TAREFAS_INTERVALO,
+            help='Segundos de espera por novas tarefas quando a fila está vazia',
+        )
+
+    def handle(self, *args, **options):
+        if not options['uma_vez']:
+            self.stdout.write('Aguardando tarefas (Ctrl+C para sair)...')
+        try:
+            while True:
+                close_old_connections()
+                liberadas = tarefas.liberar_travadas()
+                if liberadas:
+                    self.stdout.write(self.style.WARNING(f'{liberadas} tarefa(s) travada(s) devolvida(s) à fila'))
+
+                executadas = tarefas.processar()
+                if executadas:
+                    self.stdout.write(f'{executadas} tarefa(s) executada(s)')
+
+                if options['uma_vez']:
+                    break
+                if not executadas:
+                    tarefas.aguardar(options['intervalo'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS('Worker encerrado'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core import agrupamento
+
+
+class Command(BaseCommand):
+    help = 'Reconstrói os agregados de agrupamento do mapa a partir de todos os relatórios'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=2000,
+            help='Quantidade de linhas lidas e inseridas por vez',
+        )
+
+    def handle(self, *args, **options):
+        celulas = agrupamento.recalcular(lote=options['lote'])
+        self.stdout.write(self.style.SUCCESS(f'{celulas} célula(s) de agrupamento recalculadas'))
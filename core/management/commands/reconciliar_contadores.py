@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from core import cache_respostas, contadores
+
+
+class Command(BaseCommand):
+    help = 'Recalcula os contadores desnormalizados (imagens por relatório, totais gerais e por autor)'
+
+    def handle(self, *args, **options):
+        corrigidos = contadores.reconciliar()
+        if corrigidos:
+            # O número de imagens aparece nas páginas de detalhes em cache
+            cache_respostas.invalidar_tudo()
+        estatisticas = contadores.estatisticas()
+        self.stdout.write(f'{corrigidos} relatório(s) com número de imagens corrigido')
+        self.stdout.write(self.style.SUCCESS(
+            f'{estatisticas.total_relatorios} relatórios, '
+            f'{estatisticas.total_com_localizacao} com localização, '
+            f'{estatisticas.total_imagens} imagens'
+        ))
@@ -0,0 +1,179 @@
+import os
+import time
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+from django.db.models.functions import Collate
+
+from core.armazenamento import PREFIXO
+from core.imagens import DERIVADOS, filtro_do_arquivo
+from core.models import ImagemRelatorio
+
+
+# Pastas do MEDIA_ROOT com imagens dos relatórios (armazenamento por conteúdo e o formato antigo)
+PASTAS = (PREFIXO, 'relatorios')
+
+
+def _chave(entrada):
+    # Ordena as pastas como se o caminho seguisse com '/': a mesma ordem dos caminhos completos
+    return entrada[0] + '/' if entrada[1] else entrada[0]
+
+
+def _alterado_em(estado):
+    # O ctime acompanha a gravação e os reenvios, que não mudam o mtime (ver core/armazenamento.py)
+    return max(estado.st_mtime, estado.st_ctime)
+
+
+def _percorrer(raiz, relativo):
+    """
+    Arquivos sob ``raiz/relativo`` como (nome no storage, caminho), em ordem
+    crescente de nome. Guarda em memória apenas os nomes de uma pasta por nível.
+    """
+    try:
+        with os.scandir(os.path.join(raiz, relativo)) as entradas:
+            nomes = sorted(
+                ((entrada.name, entrada.is_dir(follow_symlinks=False)) for entrada in entradas),
+                key=_chave,
+            )
+    except FileNotFoundError:
+        return
+    for nome, pasta in nomes:
+        caminho = f'{relativo}/{nome}'
+        if pasta:
+            yield from _percorrer(raiz, caminho)
+        else:
+            yield caminho, os.path.join(raiz, caminho)
+
+
+def _referenciados(tamanho_bloco):
+    """
+    Todos os arquivos referenciados por ImagemRelatorio (originais e
+    derivados), sem repetição e na ordem de bytes ("C", a mesma da comparação
+    de str do Python), lidos do banco em blocos por um cursor no servidor.
+    """
+    consultas = [
+        ImagemRelatorio.objects.exclude(**{campo: ''}).order_by()
+        .annotate(nome=Collate(F(campo), 'C')).values_list('nome', flat=True)
+        for campo in ['imagem', *DERIVADOS]
+    ]
+    return consultas[0].union(*consultas[1:]).order_by('nome').iterator(chunk_size=tamanho_bloco)
+
+
+class Command(BaseCommand):
+    help = (
+        'Procura arquivos em media/conteudo e media/relatorios que nenhuma imagem de relatório '
+        'referencia e os lista ou, com --remover, os apaga. Arquivos alterados há menos que a '
+        'carência são mantidos'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--remover',
+            action='store_true',
+            help='Apaga os arquivos órfãos (sem esta opção, apenas os lista)',
+        )
+        parser.add_argument(
+            '--carencia',
+            type=float,
+            default=24,
+            help='Horas desde a última alteração para um arquivo órfão poder ser removido',
+        )
+        parser.add_argument(
+            '--lote',
+            type=int,
+            default=1000,
+            help='Arquivos órfãos conferidos de novo no banco e removidos por vez',
+        )
+
+    def _remover_pasta_vazia(self, caminho):
+        # O formato antigo tem uma pasta por relatório (relatorios/<id>/derivados)
+        raiz = os.path.join(settings.MEDIA_ROOT, 'relatorios')
+        pasta = os.path.dirname(caminho)
+        while pasta != raiz and pasta.startswith(raiz):
+            try:
+                os.rmdir(pasta)
+            except OSError:
+                return
+            pasta = os.path.dirname(pasta)
+
+    def _processar(self, candidatos, limite):
+        """
+        Confere os órfãos de novo, já que a lista do banco pode estar defasada,
+        e os remove. Retorna (removidos, bytes removidos).
+        """
+        filtros = [filtro_do_arquivo(nome) for nome, _ in candidatos]
+        filtros = [filtro for filtro in filtros if filtro is not None]
+        usados = set()
+        if filtros:
+            for linha in ImagemRelatorio.objects.filter(reduce(or_, filtros)).values_list('imagem', *DERIVADOS):
+                usados.update(linha)
+
+        removidos = bytes_removidos = 0
+        for nome, caminho in candidatos:
+            if nome in usados:
+                continue
+            try:
+                estado = os.stat(caminho)
+                # Reenviado (ArmazenamentoPorConteudo renova o ctime) desde a varredura
+                if _alterado_em(estado) > limite:
+                    continue
+                os.remove(caminho)
+            except FileNotFoundError:
+                continue
+            removidos += 1
+            bytes_removidos += estado.st_size
+            if nome.startswith('relatorios/'):
+                self._remover_pasta_vazia(caminho)
+        return removidos, bytes_removidos
+
+    def handle(self, *args, **options):
+        if options['carencia'] < 0:
+            raise CommandError('--carencia não pode ser negativa')
+        limite = time.time() - options['carencia'] * 3600
+
+        referenciados = _referenciados(options['lote'])
+        referencia = next(referenciados, None)
+        orfaos = bytes_orfaos = recentes = verificados = 0
+        removidos = bytes_removidos = 0
+        candidatos = []
+        for pasta in sorted(PASTAS):
+            for nome, caminho in _percorrer(settings.MEDIA_ROOT, pasta):
+                verificados += 1
+                # Junção de duas sequências ordenadas: memória constante para qualquer quantidade de arquivos
+                while referencia is not None and referencia < nome:
+                    referencia = next(referenciados, None)
+                if referencia == nome:
+                    continue
+                try:
+                    estado = os.stat(caminho)
+                except FileNotFoundError:
+                    continue
+                if _alterado_em(estado) > limite:
+                    recentes += 1
+                    continue
+                orfaos += 1
+                bytes_orfaos += estado.st_size
+                if options['verbosity'] >= 2 or not options['remover']:
+                    self.stdout.write(nome)
+                if options['remover']:
+                    candidatos.append((nome, caminho))
+                    if len(candidatos) >= options['lote']:
+                        resultado = self._processar(candidatos, limite)
+                        removidos += resultado[0]
+                        bytes_removidos += resultado[1]
+                        candidatos = []
+        if candidatos:
+            resultado = self._processar(candidatos, limite)
+            removidos += resultado[0]
+            bytes_removidos += resultado[1]
+
+        resumo = (
+            f'{verificados} arquivo(s) verificados, {orfaos} órfão(s) '
+            f'({bytes_orfaos / 1024 / 1024:.1f} MB), {recentes} sem referência dentro da carência'
+        )
+        if options['remover']:
+            resumo += f'; {removidos} removido(s) ({bytes_removidos / 1024 / 1024:.1f} MB)'
+        self.stdout.write(self.style.SUCCESS(resumo))
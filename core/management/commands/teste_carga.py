@@ -0,0 +1,463 @@
+import http.client
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.urls import reverse
+
+from core import sinteticos
+from core.models import Relatorio, Tarefa
+
+
+def _percentil(ordenados, fracao):
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * fracao))]
+
+
+def _multipart(campos, arquivos):
+    """Corpo multipart/form-data e o Content-Type correspondente"""
+    fronteira = uuid.uuid4().hex
+    partes = []
+    for nome, valor in campos.items():
+        partes.append(
+            f'--{fronteira}\r\nContent-Disposition: form-data; name="{nome}"\r\n\r\n{valor}\r\n'.encode()
+        )
+    for nome, (nome_arquivo, conteudo) in arquivos:
+        partes.append(
+            f'--{fronteira}\r\nContent-Disposition: form-data; name="{nome}"; filename="{nome_arquivo}"\r\n'
+            f'Content-Type: image/jpeg\r\n\r\n'.encode()
+        )
+        partes.append(conteudo)
+        partes.append(b'\r\n')
+    partes.append(f'--{fronteira}--\r\n'.encode())
+    return b''.join(partes), f'multipart/form-data; boundary={fronteira}'
+
+
+class _Cliente:
+    """Conexão keep-alive com o servidor; cada envio simula um novo visitante"""
+
+    def __init__(self, url):
+        partes = urlsplit(url)
+        self.classe = http.client.HTTPSConnection if partes.scheme == 'https' else http.client.HTTPConnection
+        self.servidor = partes.netloc
+        self.origem = f'{partes.scheme}://{partes.netloc}'
+        self.conexao = None
+        self.cookies = {}
+
+    def requisicao(self, metodo, caminho, corpo=None, cabecalhos=None):
+        if self.conexao is None:
+            self.conexao = self.classe(self.servidor, timeout=120)
+        cabecalhos = dict(cabecalhos or {})
+        if self.cookies:
+            cabecalhos['Cookie'] = '; '.join(f'{nome}={valor}' for nome, valor in self.cookies.items())
+        try:
+            self.conexao.request(metodo, caminho, body=corpo, headers=cabecalhos)
+            resposta = self.conexao.getresponse()
+            resposta.read()
+        except (OSError, http.client.HTTPException):
+            self.conexao.close()
+            self.conexao = None
+            raise
+        for cabecalho in resposta.headers.get_all('Set-Cookie') or []:
+            for nome, morsel in SimpleCookie(cabecalho).items():
+                self.cookies[nome] = morsel.value
+        return resposta.status
+
+
+class _Amostrador(threading.Thread):
+    """
+    Mede periodicamente o banco (pg_stat_activity) e o disco da MEDIA_ROOT
+    (/proc/diskstats) enquanto o teste roda. Só faz sentido com o servidor, o
+    banco e a mídia na mesma máquina que executa o comando.
+    """
+
+    def __init__(self, intervalo):
+        super().__init__(daemon=True)
+        self.intervalo = intervalo
+        self.parar = threading.Event()
+        self.ativas = []
+        self.esperando_lock = []
+        self.pendentes = []
+        self.utilizacao_disco = []
+        self.dispositivo = self._dispositivo()
+
+    def _dispositivo(self):
+        try:
+            estado = os.stat(settings.MEDIA_ROOT)
+            numeros = (os.major(estado.st_dev), os.minor(estado.st_dev))
+            with open('/proc/diskstats') as arquivo:
+                for linha in arquivo:
+                    campos = linha.split()
+                    if (int(campos[0]), int(campos[1])) == numeros:
+                        return campos[2]
+        except (OSError, AttributeError):
+            pass
+        return None
+
+    def disco(self):
+        """(ms com E/S em andamento, setores escritos) do dispositivo da mídia"""
+        if self.dispositivo is None:
+            return None
+        with open('/proc/diskstats') as arquivo:
+            for linha in arquivo:
+                campos = linha.split()
+                if campos[2] == self.dispositivo:
+                    return int(campos[12]), int(campos[9])
+        return None
+
+    def run(self):
+        anterior, instante = self.disco(), time.perf_counter()
+        try:
+            while not self.parar.wait(self.intervalo):
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT count(*) FILTER (WHERE state = 'active'), "
+                        "count(*) FILTER (WHERE wait_event_type = 'Lock') "
+                        "FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()"
+                    )
+                    ativas, esperando = cursor.fetchone()
+                self.ativas.append(ativas)
+                self.esperando_lock.append(esperando)
+                self.pendentes.append(Tarefa.objects.filter(status=Tarefa.PENDENTE).count())
+
+                atual, agora = self.disco(), time.perf_counter()
+                if atual is not None and anterior is not None:
+                    self.utilizacao_disco.append(
+                        min(100.0, (atual[0] - anterior[0]) / ((agora - instante) * 1000) * 100)
+                    )
+                anterior, instante = atual, agora
+        finally:
+            connection.close()
+
+
+def _estatisticas_banco():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT xact_commit, xact_rollback, blks_read, blks_hit, tup_inserted, '
+            'pg_database_size(current_database()) '
+            'FROM pg_stat_database WHERE datname = current_database()'
+        )
+        return dict(zip(
+            ('commits', 'rollbacks', 'blocos_lidos', 'blocos_cache', 'linhas_inseridas', 'tamanho'),
+            cursor.fetchone(),
+        ))
+
+
+class Command(BaseCommand):
+    help = (
+        'Teste de carga do envio de relatórios: envia formulários multipart com JPEGs '
+        'sintéticos, em paralelo, para um servidor em execução, e mostra a latência '
+        '(p50/p95/p99), a vazão e a utilização do banco e do disco'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url',
+            default='http://127.0.0.1:8000',
+            help='Endereço do servidor a testar',
+        )
+        parser.add_argument(
+            '--concorrencia',
+            type=int,
+            default=20,
+            help='Quantidade de visitantes enviando relatórios ao mesmo tempo',
+        )
+        parser.add_argument(
+            '--duracao',
+            type=float,
+            default=60,
+            help='Duração do teste em segundos',
+        )
+        parser.add_argument(
+            '--envios',
+            type=int,
+            help='Encerra após esta quantidade de envios, mesmo antes da duração',
+        )
+        parser.add_argument(
+            '--rampa',
+            type=float,
+            default=0,
+            help='Segundos para iniciar gradualmente todos os visitantes',
+        )
+        parser.add_argument(
+            '--imagens',
+            default='1-4',
+            help='Imagens por relatório: um número ou um intervalo (ex.: 1-4)',
+        )
+        parser.add_argument('--largura', type=int, default=2048, help='Largura das imagens em pixels')
+        parser.add_argument('--altura', type=int, default=1536, help='Altura das imagens em pixels')
+        parser.add_argument('--qualidade', type=int, default=85, help='Qualidade JPEG das imagens')
+        parser.add_argument(
+            '--variedade',
+            type=int,
+            default=6,
+            help='Quantidade de imagens distintas geradas (cada envio recebe uma cópia com hash único)',
+        )
+        parser.add_argument(
+            '--semente',
+            type=int,
+            default=42,
+            help='Semente dos dados sintéticos, para repetir o mesmo teste',
+        )
+        parser.add_argument(
+            '--intervalo',
+            type=float,
+            default=1,
+            help='Segundos entre as medições do banco e do disco',
+        )
+        parser.add_argument(
+            '--json',
+            help='Grava também o resultado neste arquivo JSON',
+        )
+        parser.add_argument(
+            '--limpar',
+            action='store_true',
+            help=f'Remove os relatórios sintéticos (email @{sinteticos.DOMINIO_EMAIL}) e termina',
+        )
+
+    def _intervalo_imagens(self, valor):
+        try:
+            minimo, _, maximo = valor.partition('-')
+            minimo, maximo = int(minimo), int(maximo or minimo)
+        except ValueError:
+            raise CommandError(f'Quantidade de imagens inválida: {valor}')
+        if not 0 <= minimo <= maximo:
+            raise CommandError(f'Quantidade de imagens inválida: {valor}')
+        return minimo, maximo
+
+    def _visitante(self, indice, options, imagens, resultados, trava, fim):
+        aleatorio = random.Random(options['semente'] * 1000003 + indice)
+        cliente = _Cliente(options['url'])
+        caminho = reverse('core:criar_relatorio')
+        minimo, maximo = self._intervalo_imagens(options['imagens'])
+        time.sleep(options['rampa'] * indice / options['concorrencia'])
+
+        while time.perf_counter() < fim:
+            with trava:
+                if options['envios'] is not None and resultados['iniciados'] >= options['envios']:
+                    return
+                resultados['iniciados'] += 1
+
+            # Cada envio é um novo visitante: formulário, cookie CSRF e sessão novos
+            cliente.cookies = {}
+            try:
+                inicio = time.perf_counter()
+                status = cliente.requisicao('GET', caminho)
+                duracao_formulario = time.perf_counter() - inicio
+
+                campos = sinteticos.relatorio(aleatorio)
+                campos['csrfmiddlewaretoken'] = cliente.cookies.get('csrftoken', '')
+                arquivos = [
+                    ('imagens', (f'foto_{numero}.jpg', sinteticos.tornar_unico(aleatorio.choice(imagens), aleatorio)))
+                    for numero in range(aleatorio.randint(minimo, maximo))
+                ]
+                corpo, tipo = _multipart(campos, arquivos)
+
+                inicio = time.perf_counter()
+                status = cliente.requisicao('POST', caminho, corpo, {
+                    'Content-Type': tipo,
+                    'Referer': cliente.origem + caminho,
+                })
+                duracao_envio = time.perf_counter() - inicio
+            except (OSError, http.client.HTTPException) as erro:
+                with trava:
+                    resultados['falhas'][type(erro).__name__] = resultados['falhas'].get(type(erro).__name__, 0) + 1
+                continue
+
+            with trava:
+                resultados['formulario'].append(duracao_formulario)
+                resultados['envio'].append(duracao_envio)
+                resultados['bytes'] += len(corpo)
+                resultados['imagens'] += len(arquivos)
+                # Sucesso redireciona de volta ao formulário; 200 é o formulário com erros
+                chave = 'ok' if status == 302 else 'rejeitados' if status == 200 else f'http_{status}'
+                resultados['status'][chave] = resultados['status'].get(chave, 0) + 1
+
+    def _latencias(self, nome, duracoes):
+        if not duracoes:
+            return {'nome': nome, 'n': 0}
+        ordenados = sorted(duracoes)
+        return {
+            'nome': nome,
+            'n': len(ordenados),
+            'p50_ms': _percentil(ordenados, 0.50) * 1000,
+            'p95_ms': _percentil(ordenados, 0.95) * 1000,
+            'p99_ms': _percentil(ordenados, 0.99) * 1000,
+            'max_ms': ordenados[-1] * 1000,
+        }
+
+    def _limpar(self):
+        relatorios = Relatorio.objects.filter(email_usuario__endswith=f'@{sinteticos.DOMINIO_EMAIL}')
+        total = relatorios.count()
+        relatorios.delete()
+        self.stdout.write(self.style.SUCCESS(f'{total} relatório(s) sintético(s) removido(s)'))
+
+    def handle(self, *args, **options):
+        if options['limpar']:
+            return self._limpar()
+        self._intervalo_imagens(options['imagens'])
+        if options['concorrencia'] < 1:
+            raise CommandError('A concorrência deve ser ao menos 1')
+
+        try:
+            status = _Cliente(options['url']).requisicao('GET', reverse('core:criar_relatorio'))
+        except OSError as erro:
+            raise CommandError(f'Servidor inacessível em {options["url"]}: {erro}')
+        if status != 200:
+            raise CommandError(f'O formulário respondeu {status}; o servidor está em execução e acessível?')
+
+        self.stdout.write(f'Gerando {options["variedade"]} imagem(ns) de {options["largura"]}x{options["altura"]}...')
+        aleatorio = random.Random(options['semente'])
+        imagens = [
+            sinteticos.jpeg(aleatorio, options['largura'], options['altura'], options['qualidade'])
+            for _ in range(max(1, options['variedade']))
+        ]
+        self.stdout.write(
+            f'Tamanho médio: {sum(map(len, imagens)) / len(imagens) / 1024:.0f} KB. '
+            f'Enviando com {options["concorrencia"]} visitante(s) por até {options["duracao"]:.0f} s...'
+        )
+
+        resultados = {'iniciados': 0, 'formulario': [], 'envio': [], 'bytes': 0, 'imagens': 0,
+                      'status': {}, 'falhas': {}}
+        trava = threading.Lock()
+        amostrador = _Amostrador(options['intervalo'])
+        banco_antes = _estatisticas_banco()
+        disco_antes = amostrador.disco()
+        livre_antes = shutil.disk_usage(settings.MEDIA_ROOT).free
+        cpu_antes = os.times()
+
+        inicio = time.perf_counter()
+        fim = inicio + options['duracao']
+        amostrador.start()
+        visitantes = [
+            threading.Thread(target=self._visitante, args=(indice, options, imagens, resultados, trava, fim))
+            for indice in range(options['concorrencia'])
+        ]
+        for visitante in visitantes:
+            visitante.start()
+        for visitante in visitantes:
+            visitante.join()
+        decorrido = time.perf_counter() - inicio
+        amostrador.parar.set()
+        amostrador.join()
+
+        cpu_depois = os.times()
+        banco_depois = _estatisticas_banco()
+        disco_depois = amostrador.disco()
+        livre_depois = shutil.disk_usage(settings.MEDIA_ROOT).free
+
+        concluidos = len(resultados['envio'])
+        blocos = {chave: banco_depois[chave] - banco_antes[chave] for chave in banco_antes}
+        acessos = blocos['blocos_lidos'] + blocos['blocos_cache']
+        resumo = {
+            'parametros': {chave: options[chave] for chave in (
+                'url', 'concorrencia', 'duracao', 'envios', 'imagens', 'largura', 'altura', 'semente')},
+            'decorrido_s': decorrido,
+            'envios': concluidos,
+            'envios_por_s': concluidos / decorrido,
+            'imagens_por_s': resultados['imagens'] / decorrido,
+            'mb_por_s': resultados['bytes'] / decorrido / 1024 / 1024,
+            'status': resultados['status'],
+            'falhas': resultados['falhas'],
+            'latencias': [
+                self._latencias('formulário (GET)', resultados['formulario']),
+                self._latencias('envio (POST)', resultados['envio']),
+            ],
+            'banco': {
+                'conexoes_ativas_media': sum(amostrador.ativas) / len(amostrador.ativas) if amostrador.ativas else None,
+                'conexoes_ativas_max': max(amostrador.ativas, default=None),
+                'esperando_lock_max': max(amostrador.esperando_lock, default=None),
+                'commits_por_s': blocos['commits'] / decorrido,
+                'rollbacks': blocos['rollbacks'],
+                'linhas_inseridas': blocos['linhas_inseridas'],
+                'blocos_lidos_do_disco': blocos['blocos_lidos'],
+                'acerto_cache': blocos['blocos_cache'] / acessos if acessos else None,
+                'crescimento_mb': blocos['tamanho'] / 1024 / 1024,
+            },
+            'disco': {
+                'dispositivo': amostrador.dispositivo,
+                'utilizacao_media': (
+                    sum(amostrador.utilizacao_disco) / len(amostrador.utilizacao_disco)
+                    if amostrador.utilizacao_disco else None
+                ),
+                'utilizacao_max': max(amostrador.utilizacao_disco, default=None),
+                # Setores de 512 bytes, independente do dispositivo
+                'escrita_mb_por_s': (
+                    (disco_depois[1] - disco_antes[1]) * 512 / decorrido / 1024 / 1024
+                    if disco_antes and disco_depois else None
+                ),
+                'espaco_usado_mb': (livre_antes - livre_depois) / 1024 / 1024,
+            },
+            'tarefas_pendentes_max': max(amostrador.pendentes, default=None),
+            'tarefas_pendentes_final': Tarefa.objects.filter(status=Tarefa.PENDENTE).count(),
+            'cpu_cliente': (
+                (cpu_depois.user + cpu_depois.system - cpu_antes.user - cpu_antes.system) / decorrido
+            ),
+        }
+        self._exibir(resumo)
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as saida:
+                json.dump(resumo, saida, indent=2, ensure_ascii=False)
+
+    def _exibir(self, resumo):
+        def numero(valor, formato='.1f', sufixo=''):
+            return 'n/d' if valor is None else f'{valor:{formato}}{sufixo}'
+
+        self.stdout.write('')
+        self.stdout.write(
+            f'{resumo["envios"]} envio(s) em {resumo["decorrido_s"]:.1f} s: '
+            f'{resumo["envios_por_s"]:.2f} relatórios/s, {resumo["imagens_por_s"]:.2f} imagens/s, '
+            f'{resumo["mb_por_s"]:.2f} MB/s enviados'
+        )
+        status = ', '.join(f'{chave}: {total}' for chave, total in sorted(resumo['status'].items()))
+        self.stdout.write(f'Respostas: {status or "nenhuma"}')
+        if resumo['falhas']:
+            falhas = ', '.join(f'{chave}: {total}' for chave, total in sorted(resumo['falhas'].items()))
+            self.stdout.write(self.style.ERROR(f'Falhas de conexão: {falhas}'))
+
+        cabecalho = f'\n{"latência":<18} {"n":>7} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"máx ms":>9}'
+        self.stdout.write(cabecalho)
+        self.stdout.write('-' * (len(cabecalho) - 1))
+        for linha in resumo['latencias']:
+            if linha['n']:
+                self.stdout.write(
+                    f'{linha["nome"]:<18} {linha["n"]:>7} {linha["p50_ms"]:>9.1f} {linha["p95_ms"]:>9.1f} '
+                    f'{linha["p99_ms"]:>9.1f} {linha["max_ms"]:>9.1f}'
+                )
+
+        banco = resumo['banco']
+        self.stdout.write(
+            f'\nBanco: conexões ativas média {numero(banco["conexoes_ativas_media"])}, '
+            f'máx {numero(banco["conexoes_ativas_max"], "d")}; '
+            f'esperando lock máx {numero(banco["esperando_lock_max"], "d")}; '
+            f'{banco["commits_por_s"]:.1f} commits/s, {banco["rollbacks"]} rollback(s); '
+            f'{banco["linhas_inseridas"]} linhas inseridas; '
+            f'{banco["blocos_lidos_do_disco"]} blocos lidos do disco '
+            f'(acerto do cache {numero(banco["acerto_cache"] and banco["acerto_cache"] * 100, ".1f", "%")}); '
+            f'crescimento {banco["crescimento_mb"]:.1f} MB'
+        )
+        disco = resumo['disco']
+        self.stdout.write(
+            f'Disco da mídia ({disco["dispositivo"] or "n/d"}): utilização média '
+            f'{numero(disco["utilizacao_media"], ".1f", "%")}, máx {numero(disco["utilizacao_max"], ".1f", "%")}; '
+            f'escrita {numero(disco["escrita_mb_por_s"], ".2f", " MB/s")}; '
+            f'espaço usado {disco["espaco_usado_mb"]:.1f} MB'
+        )
+        self.stdout.write(
+            f'Fila de tarefas: {numero(resumo["tarefas_pendentes_max"], "d")} pendente(s) no máximo, '
+            f'{resumo["tarefas_pendentes_final"]} ao final'
+        )
+        if resumo['cpu_cliente'] > 0.9:
+            self.stdout.write(self.style.WARNING(
+                f'O próprio teste usou {resumo["cpu_cliente"] * 100:.0f}% de CPU e pode ser o gargalo; '
+                'rode-o em outra máquina ou com menor --concorrencia'
+            ))
+        self.stdout.write(self.style.SUCCESS('Teste de carga concluído'))
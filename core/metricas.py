@@ -0,0 +1,130 @@
+"""
+Métricas no formato do Prometheus, expostas em /metrics.
+
+O MetricasMiddleware registra, por nome da URL (ex.: ``core:home``), o tempo
+de resposta, o número e o tempo total das consultas ao banco, o tamanho do
+corpo recebido (uploads) e o tamanho da resposta. Em respostas em streaming
+(ex.: a exportação) a medição vai até o último bloco enviado.
+
+Com vários workers do gunicorn, defina PROMETHEUS_MULTIPROC_DIR com uma pasta
+compartilhada: cada processo grava suas métricas ali e /metrics soma todas
+(o gunicorn.conf.py limpa a pasta ao iniciar e descarta os workers que saem).
+"""
+import os
+import time
+
+from django.db import connection
+from django.http import FileResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest, multiprocess,
+)
+
+
+BUCKETS_CONSULTAS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+BUCKETS_BYTES = (0, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+duracao = Histogram(
+    'django_http_request_duration_seconds',
+    'Tempo de resposta das requisições',
+    ['view', 'metodo', 'status'],
+)
+consultas = Histogram(
+    'django_db_queries_per_request',
+    'Consultas ao banco por requisição',
+    ['view'],
+    buckets=BUCKETS_CONSULTAS,
+)
+tempo_banco = Histogram(
+    'django_db_time_per_request_seconds',
+    'Tempo total das consultas ao banco por requisição',
+    ['view'],
+)
+tamanho_requisicao = Histogram(
+    'django_http_request_body_bytes',
+    'Tamanho do corpo das requisições (uploads)',
+    ['view'],
+    buckets=BUCKETS_BYTES,
+)
+tamanho_resposta = Histogram(
+    'django_http_response_body_bytes',
+    'Tamanho do corpo das respostas',
+    ['view'],
+    buckets=BUCKETS_BYTES,
+)
+
+
+def exportar():
+    """Texto com todas as métricas e o content type correspondente"""
+    registro = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+    return generate_latest(registro), CONTENT_TYPE_LATEST
+
+
+def _nome_da_view(request):
+    # Apenas nomes de URL como rótulo: caminhos livres multiplicariam as séries
+    correspondencia = getattr(request, 'resolver_match', None)
+    return correspondencia.view_name if correspondencia is not None else 'nao_encontrada'
+
+
+class _Medicao:
+    """Acumula as consultas de uma requisição (usada como execute_wrapper)"""
+
+    def __init__(self, request):
+        self.request = request
+        self.inicio = time.perf_counter()
+        self.consultas = 0
+        self.tempo_banco = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        inicio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.consultas += 1
+            self.tempo_banco += time.perf_counter() - inicio
+
+    def registrar(self, response, tamanho):
+        view = _nome_da_view(self.request)
+        duracao.labels(view, self.request.method, str(response.status_code)).observe(
+            time.perf_counter() - self.inicio
+        )
+        consultas.labels(view).observe(self.consultas)
+        tempo_banco.labels(view).observe(self.tempo_banco)
+        try:
+            tamanho_requisicao.labels(view).observe(int(self.request.META.get('CONTENT_LENGTH') or 0))
+        except ValueError:
+            pass
+        tamanho_resposta.labels(view).observe(tamanho)
+
+
+class MetricasMiddleware:
+    """Registra as métricas de cada requisição; deve ser o primeiro middleware"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        medicao = _Medicao(request)
+        with connection.execute_wrapper(medicao):
+            response = self.get_response(request)
+
+        if isinstance(response, FileResponse):
+            # Envolver o arquivo impediria o servidor de usar o sendfile
+            medicao.registrar(response, int(response.get('Content-Length') or 0))
+        elif response.streaming:
+            response.streaming_content = self._acompanhar(response, response.streaming_content, medicao)
+        else:
+            medicao.registrar(response, len(response.content))
+        return response
+
+    def _acompanhar(self, response, conteudo, medicao):
+        tamanho = 0
+        try:
+            with connection.execute_wrapper(medicao):
+                for parte in conteudo:
+                    tamanho += len(parte)
+                    yield parte
+        finally:
+            medicao.registrar(response, tamanho)
@@ -0,0 +1,168 @@
+"""
+Entrega das imagens dos relatórios (MEDIA_URL) em produção.
+
+Uma imagem só é servida a quem pode ver algum relatório que a referencia,
+pelas mesmas regras de ``detalhes_relatorio_publico``: administradores veem
+todas, usuários registrados as dos seus relatórios e visitantes anônimos as
+dos relatórios criados com o seu token (ver core/autoria.py). Nos demais
+casos a resposta é 404, sem revelar se o arquivo existe. Derivados são
+localizados pela imagem original (ver core/imagens.py), o que mantém a
+verificação em uma consulta por igualdade no índice de ``imagem``.
+
+As respostas têm ETag forte no formato do nginx (``"<mtime>-<tamanho>"`` em
+hexadecimal), Last-Modified e Cache-Control privado de longa duração
+(``immutable`` para os originais, nomeados pelo hash do conteúdo), e
+respondem a If-None-Match/If-Modified-Since com 304 e a um intervalo Range
+com 206. Com MIDIA_ENVIO a transferência dos bytes é delegada ao proxy
+(X-Accel-Redirect do nginx ou X-Sendfile do Apache), que também trata o
+Range; sem ele o arquivo é enviado com FileResponse, que usa o sendfile do
+servidor WSGI quando disponível.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+from . import autoria
+from .armazenamento import PREFIXO, armazenamento
+from .imagens import filtro_do_arquivo
+from .models import ImagemRelatorio
+
+
+TAMANHO_BLOCO = 64 * 1024
+_INTERVALO = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class _IntervaloInvalido(Exception):
+    pass
+
+
+def pode_ver(request, nome):
+    """Se o usuário pode ver algum relatório que usa o arquivo"""
+    filtro = filtro_do_arquivo(nome)
+    if filtro is None:
+        return False
+    imagens = ImagemRelatorio.objects.filter(filtro)
+    usuario = request.user
+    if usuario.is_authenticated:
+        if not (usuario.is_staff or usuario.is_superuser):
+            imagens = imagens.filter(relatorio__usuario=usuario)
+    else:
+        token = autoria.token(request)
+        if token is None:
+            return False
+        imagens = imagens.filter(relatorio__token_anonimo=token)
+    return imagens.exists()
+
+
+def _etag(estado):
+    return f'"{int(estado.st_mtime):x}-{estado.st_size:x}"'
+
+
+def _intervalo(request, etag, ultima_modificacao, tamanho):
+    """
+    (início, fim) inclusivos do intervalo pedido em Range, ou None para enviar
+    o arquivo inteiro: sem Range, com vários intervalos, com sintaxe inválida
+    ou com If-Range de outra versão. Levanta _IntervaloInvalido se o intervalo
+    não puder ser atendido (416).
+    """
+    cabecalho = request.headers.get('Range')
+    if not cabecalho:
+        return None
+    condicao = request.headers.get('If-Range')
+    if condicao and condicao not in (etag, http_date(ultima_modificacao)):
+        return None
+    correspondencia = _INTERVALO.match(cabecalho.strip())
+    if not correspondencia:
+        return None
+    inicio, fim = correspondencia.groups()
+    if not inicio:
+        # bytes=-N: os últimos N bytes
+        if not fim or int(fim) == 0:
+            raise _IntervaloInvalido
+        return max(0, tamanho - int(fim)), tamanho - 1
+    inicio = int(inicio)
+    if fim and int(fim) < inicio:
+        return None
+    if inicio >= tamanho:
+        raise _IntervaloInvalido
+    return inicio, min(int(fim), tamanho - 1) if fim else tamanho - 1
+
+
+def _ler(caminho, inicio, quantidade):
+    with open(caminho, 'rb') as arquivo:
+        arquivo.seek(inicio)
+        while quantidade > 0:
+            parte = arquivo.read(min(TAMANHO_BLOCO, quantidade))
+            if not parte:
+                break
+            quantidade -= len(parte)
+            yield parte
+
+
+def _cabecalhos_de_cache(response, nome, etag, ultima_modificacao):
+    imutavel = nome.startswith(PREFIXO + '/') and '/derivados/' not in nome
+    # Privado: a mesma URL não pode ser reaproveitada por caches compartilhados para outro visitante
+    if imutavel:
+        response['Cache-Control'] = f'private, max-age={settings.MIDIA_CACHE_IMUTAVEL}, immutable'
+    else:
+        response['Cache-Control'] = f'private, max-age={settings.MIDIA_CACHE_TIMEOUT}'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(ultima_modificacao)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
+
+def servir(request, nome):
+    """Resposta com o arquivo ``nome`` do storage das imagens, ou Http404"""
+    nome = posixpath.normpath(nome).lstrip('/')
+    if nome.startswith('..') or not pode_ver(request, nome):
+        raise Http404('Arquivo não encontrado')
+    try:
+        caminho = armazenamento.path(nome)
+        estado = os.stat(caminho)
+    except (OSError, SuspiciousFileOperation):
+        raise Http404('Arquivo não encontrado')
+
+    etag = _etag(estado)
+    ultima_modificacao = int(estado.st_mtime)
+    condicional = get_conditional_response(request, etag=etag, last_modified=ultima_modificacao)
+    if condicional is not None:
+        return _cabecalhos_de_cache(condicional, nome, etag, ultima_modificacao)
+
+    tipo = mimetypes.guess_type(nome)[0] or 'application/octet-stream'
+    if settings.MIDIA_ENVIO == 'x-accel-redirect':
+        response = HttpResponse(content_type=tipo)
+        response['X-Accel-Redirect'] = settings.MIDIA_PREFIXO_INTERNO + quote(nome)
+        return _cabecalhos_de_cache(response, nome, etag, ultima_modificacao)
+    if settings.MIDIA_ENVIO == 'x-sendfile':
+        response = HttpResponse(content_type=tipo)
+        response['X-Sendfile'] = caminho
+        return _cabecalhos_de_cache(response, nome, etag, ultima_modificacao)
+
+    try:
+        intervalo = _intervalo(request, etag, ultima_modificacao, estado.st_size)
+    except _IntervaloInvalido:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{estado.st_size}'
+        return response
+
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=tipo)
+        response['Content-Length'] = estado.st_size
+    elif intervalo is None:
+        response = FileResponse(open(caminho, 'rb'), content_type=tipo)
+    else:
+        inicio, fim = intervalo
+        response = StreamingHttpResponse(_ler(caminho, inicio, fim - inicio + 1), content_type=tipo, status=206)
+        response['Content-Range'] = f'bytes {inicio}-{fim}/{estado.st_size}'
+        response['Content-Length'] = fim - inicio + 1
+    response['Accept-Ranges'] = 'bytes'
+    return _cabecalhos_de_cache(response, nome, etag, ultima_modificacao)
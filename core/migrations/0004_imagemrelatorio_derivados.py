@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_relatorio_endereco_relatorio_latitude_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagemrelatorio',
+            name='imagem_media',
+            field=models.ImageField(blank=True, editable=False, upload_to='', verbose_name='Imagem em tamanho de exibição'),
+        ),
+        migrations.AddField(
+            model_name='imagemrelatorio',
+            name='imagem_media_webp',
+            field=models.ImageField(blank=True, editable=False, upload_to='', verbose_name='Imagem em tamanho de exibição (WebP)'),
+        ),
+        migrations.AddField(
+            model_name='imagemrelatorio',
+            name='miniatura',
+            field=models.ImageField(blank=True, editable=False, upload_to='', verbose_name='Miniatura'),
+        ),
+        migrations.AddField(
+            model_name='imagemrelatorio',
+            name='miniatura_webp',
+            field=models.ImageField(blank=True, editable=False, upload_to='', verbose_name='Miniatura (WebP)'),
+        ),
+    ]
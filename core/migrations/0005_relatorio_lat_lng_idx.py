@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_imagemrelatorio_derivados'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='relatorio',
+            index=models.Index(fields=['latitude', 'longitude'], name='relatorio_lat_lng_idx'),
+        ),
+    ]
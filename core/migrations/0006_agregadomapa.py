@@ -0,0 +1,86 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:32
+
+import math
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+# Cópia da grade de core/agrupamento.py com os valores das configurações
+# (MAPA_ZOOM_MAXIMO_AGRUPAMENTO e MAPA_TAMANHO_CELULA) desta migração: o
+# resultado não pode mudar com o código e as configurações atuais
+ZOOM_MAXIMO = 16
+TAMANHO_CELULA = 64
+LATITUDE_MAXIMA_MERCATOR = 85.05112878
+
+
+def celulas_do_ponto(latitude, longitude):
+    celulas = []
+    latitude = max(-LATITUDE_MAXIMA_MERCATOR, min(LATITUDE_MAXIMA_MERCATOR, latitude))
+    radianos = math.radians(latitude)
+    for zoom in range(ZOOM_MAXIMO + 1):
+        n = 2 ** zoom * 256 // TAMANHO_CELULA
+        x = int((longitude + 180) / 360 * n)
+        y = int((1 - math.log(math.tan(radianos) + 1 / math.cos(radianos)) / math.pi) / 2 * n)
+        celulas.append((zoom, min(max(x, 0), n - 1), min(max(y, 0), n - 1)))
+    return celulas
+
+
+def popular_agregados(apps, schema_editor):
+    """Calcula os agregados para os relatórios já existentes"""
+    Relatorio = apps.get_model('core', 'Relatorio')
+    AgregadoMapa = apps.get_model('core', 'AgregadoMapa')
+
+    acumulado = defaultdict(lambda: [0, 0.0, 0.0])
+    coordenadas = (
+        Relatorio.objects.filter(latitude__isnull=False, longitude__isnull=False)
+        .order_by()
+        .values_list('latitude', 'longitude')
+        .iterator(chunk_size=2000)
+    )
+    for latitude, longitude in coordenadas:
+        latitude, longitude = float(latitude), float(longitude)
+        for chave in celulas_do_ponto(latitude, longitude):
+            valores = acumulado[chave]
+            valores[0] += 1
+            valores[1] += latitude
+            valores[2] += longitude
+
+    AgregadoMapa.objects.bulk_create(
+        (
+            AgregadoMapa(
+                zoom=zoom, celula_x=x, celula_y=y, quantidade=quantidade,
+                soma_latitude=soma_latitude, soma_longitude=soma_longitude
+            )
+            for (zoom, x, y), (quantidade, soma_latitude, soma_longitude) in acumulado.items()
+        ),
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_relatorio_lat_lng_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgregadoMapa',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.PositiveSmallIntegerField(verbose_name='Zoom')),
+                ('celula_x', models.PositiveIntegerField(verbose_name='Célula X')),
+                ('celula_y', models.PositiveIntegerField(verbose_name='Célula Y')),
+                ('quantidade', models.IntegerField(default=0, verbose_name='Quantidade de relatórios')),
+                ('soma_latitude', models.FloatField(default=0, verbose_name='Soma das latitudes')),
+                ('soma_longitude', models.FloatField(default=0, verbose_name='Soma das longitudes')),
+            ],
+            options={
+                'verbose_name': 'Agregado do Mapa',
+                'verbose_name_plural': 'Agregados do Mapa',
+                'constraints': [models.UniqueConstraint(fields=('zoom', 'celula_x', 'celula_y'), name='agregado_mapa_celula_unica')],
+            },
+        ),
+        migrations.RunPython(popular_agregados, migrations.RunPython.noop),
+    ]
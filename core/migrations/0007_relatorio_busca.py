@@ -0,0 +1,75 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:34
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.conf import settings
+from django.contrib.postgres.operations import UnaccentExtension
+from django.db import migrations
+
+
+# Configuração de busca em português que ignora acentos
+CRIAR_CONFIGURACAO = """
+CREATE TEXT SEARCH CONFIGURATION portugues_sem_acento (COPY = portuguese);
+ALTER TEXT SEARCH CONFIGURATION portugues_sem_acento
+    ALTER MAPPING FOR hword, hword_part, word WITH unaccent, portuguese_stem;
+"""
+
+# Mantém o vetor de busca atualizado em inserções e alterações, inclusive bulk_create
+CRIAR_TRIGGER = """
+CREATE FUNCTION core_relatorio_busca_atualizar() RETURNS trigger AS $$
+BEGIN
+    NEW.busca :=
+        setweight(to_tsvector('portugues_sem_acento', coalesce(NEW.titulo, '')), 'A') ||
+        setweight(to_tsvector('portugues_sem_acento', coalesce(NEW.conteudo, '')), 'B') ||
+        setweight(to_tsvector('portugues_sem_acento', concat_ws(' ',
+            (SELECT username FROM auth_user WHERE id = NEW.usuario_id),
+            NEW.nome_usuario, NEW.email_usuario, NEW.endereco
+        )), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER core_relatorio_busca
+    BEFORE INSERT OR UPDATE OF titulo, conteudo, usuario_id, nome_usuario, email_usuario, endereco, busca
+    ON core_relatorio
+    FOR EACH ROW EXECUTE FUNCTION core_relatorio_busca_atualizar();
+
+UPDATE core_relatorio SET busca = NULL;
+"""
+
+REMOVER = """
+DROP TRIGGER IF EXISTS core_relatorio_busca ON core_relatorio;
+DROP FUNCTION IF EXISTS core_relatorio_busca_atualizar();
+DROP TEXT SEARCH CONFIGURATION IF EXISTS portugues_sem_acento;
+"""
+
+
+def executar_sql(sql):
+    """RunPython que executa o SQL apenas no PostgreSQL"""
+    def operacao(apps, schema_editor):
+        if schema_editor.connection.vendor == 'postgresql':
+            schema_editor.execute(sql)
+    return operacao
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_agregadomapa'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        UnaccentExtension(),
+        migrations.RunPython(executar_sql(CRIAR_CONFIGURACAO), executar_sql(REMOVER)),
+        migrations.AddField(
+            model_name='relatorio',
+            name='busca',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name='Vetor de busca'),
+        ),
+        migrations.AddIndex(
+            model_name='relatorio',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['busca'], name='relatorio_busca_gin_idx'),
+        ),
+        migrations.RunPython(executar_sql(CRIAR_TRIGGER), migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_relatorio_busca'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='relatorio',
+            index=models.Index(fields=['data_criacao', 'id'], name='relatorio_data_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='relatorio',
+            index=models.Index(fields=['usuario', 'data_criacao', 'id'], name='relatorio_usuario_data_id_idx'),
+        ),
+    ]
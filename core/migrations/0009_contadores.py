@@ -0,0 +1,85 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def popular_contadores(apps, schema_editor):
+    """Calcula os contadores para os dados já existentes"""
+    Relatorio = apps.get_model('core', 'Relatorio')
+    ImagemRelatorio = apps.get_model('core', 'ImagemRelatorio')
+    EstatisticasRelatorios = apps.get_model('core', 'EstatisticasRelatorios')
+    ContagemAutor = apps.get_model('core', 'ContagemAutor')
+
+    por_relatorio = (
+        ImagemRelatorio.objects.order_by().values('relatorio').annotate(total=Count('pk'))
+    )
+    for linha in por_relatorio.iterator(chunk_size=2000):
+        Relatorio.objects.filter(pk=linha['relatorio']).update(num_imagens=linha['total'])
+
+    EstatisticasRelatorios.objects.create(
+        pk=1,
+        total_relatorios=Relatorio.objects.count(),
+        total_com_localizacao=Relatorio.objects.filter(latitude__isnull=False, longitude__isnull=False).count(),
+        total_imagens=ImagemRelatorio.objects.count(),
+    )
+
+    registrados = (
+        Relatorio.objects.filter(usuario__isnull=False).order_by()
+        .values('usuario').annotate(quantidade=Count('pk'))
+    )
+    nao_registrados = (
+        Relatorio.objects.filter(usuario__isnull=True).exclude(nome_usuario='').order_by()
+        .values('nome_usuario').annotate(quantidade=Count('pk'))
+    )
+    ContagemAutor.objects.bulk_create(
+        [ContagemAutor(usuario_id=linha['usuario'], quantidade=linha['quantidade']) for linha in registrados]
+        + [ContagemAutor(nome_usuario=linha['nome_usuario'], quantidade=linha['quantidade']) for linha in nao_registrados],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_relatorio_paginacao_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EstatisticasRelatorios',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_relatorios', models.PositiveIntegerField(default=0, verbose_name='Total de relatórios')),
+                ('total_com_localizacao', models.PositiveIntegerField(default=0, verbose_name='Relatórios com localização')),
+                ('total_imagens', models.PositiveIntegerField(default=0, verbose_name='Total de imagens')),
+            ],
+            options={
+                'verbose_name': 'Estatísticas dos Relatórios',
+                'verbose_name_plural': 'Estatísticas dos Relatórios',
+            },
+        ),
+        migrations.AddField(
+            model_name='relatorio',
+            name='num_imagens',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Número de imagens'),
+        ),
+        migrations.CreateModel(
+            name='ContagemAutor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nome_usuario', models.CharField(blank=True, max_length=100, verbose_name='Nome do Usuário')),
+                ('quantidade', models.IntegerField(default=0, verbose_name='Quantidade de relatórios')),
+                ('usuario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Usuário')),
+            ],
+            options={
+                'verbose_name': 'Contagem por Autor',
+                'verbose_name_plural': 'Contagens por Autor',
+                'constraints': [models.UniqueConstraint(condition=models.Q(('usuario__isnull', False)), fields=('usuario',), name='contagem_autor_usuario_unico'), models.UniqueConstraint(condition=models.Q(('usuario__isnull', True)), fields=('nome_usuario',), name='contagem_autor_nome_unico')],
+            },
+        ),
+        migrations.RunPython(popular_contadores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:48
+
+import core.armazenamento
+import core.models
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def popular_referencias(apps, schema_editor):
+    """Registra as referências dos arquivos já existentes (ainda em relatorios/<id>/)"""
+    ImagemRelatorio = apps.get_model('core', 'ImagemRelatorio')
+    ConteudoImagem = apps.get_model('core', 'ConteudoImagem')
+
+    contagens = (
+        ImagemRelatorio.objects.exclude(imagem='').order_by()
+        .values('imagem').annotate(referencias=Count('pk'))
+    )
+    ConteudoImagem.objects.bulk_create(
+        (ConteudoImagem(arquivo=linha['imagem'], referencias=linha['referencias']) for linha in contagens.iterator(chunk_size=2000)),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_tarefa'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConteudoImagem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('arquivo', models.CharField(max_length=255, unique=True, verbose_name='Arquivo')),
+                ('referencias', models.IntegerField(default=0, verbose_name='Referências')),
+            ],
+            options={
+                'verbose_name': 'Conteúdo de Imagem',
+                'verbose_name_plural': 'Conteúdos de Imagem',
+            },
+        ),
+        migrations.AlterField(
+            model_name='imagemrelatorio',
+            name='imagem',
+            field=models.ImageField(help_text='Formatos suportados: JPG, PNG, GIF. Tamanho máximo: 5MB', max_length=255, storage=core.armazenamento.ArmazenamentoPorConteudo(), upload_to=core.models.relatorio_imagem_path, verbose_name='Imagem'),
+        ),
+        migrations.AlterField(
+            model_name='imagemrelatorio',
+            name='imagem_media',
+            field=models.ImageField(blank=True, editable=False, max_length=255, upload_to='', verbose_name='Imagem em tamanho de exibição'),
+        ),
+        migrations.AlterField(
+            model_name='imagemrelatorio',
+            name='imagem_media_webp',
+            field=models.ImageField(blank=True, editable=False, max_length=255, upload_to='', verbose_name='Imagem em tamanho de exibição (WebP)'),
+        ),
+        migrations.AlterField(
+            model_name='imagemrelatorio',
+            name='miniatura',
+            field=models.ImageField(blank=True, editable=False, max_length=255, upload_to='', verbose_name='Miniatura'),
+        ),
+        migrations.AlterField(
+            model_name='imagemrelatorio',
+            name='miniatura_webp',
+            field=models.ImageField(blank=True, editable=False, max_length=255, upload_to='', verbose_name='Miniatura (WebP)'),
+        ),
+        migrations.RunPython(popular_referencias, migrations.RunPython.noop),
+    ]
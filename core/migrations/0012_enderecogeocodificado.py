@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_armazenamento_por_conteudo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnderecoGeocodificado',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('latitude', models.DecimalField(decimal_places=6, max_digits=10, verbose_name='Latitude')),
+                ('longitude', models.DecimalField(decimal_places=6, max_digits=10, verbose_name='Longitude')),
+                ('endereco', models.TextField(blank=True, verbose_name='Endereço')),
+                ('atualizado_em', models.DateTimeField(auto_now=True, verbose_name='Atualizado em')),
+            ],
+            options={
+                'verbose_name': 'Endereço Geocodificado',
+                'verbose_name_plural': 'Endereços Geocodificados',
+                'constraints': [models.UniqueConstraint(fields=('latitude', 'longitude'), name='endereco_geocodificado_unico')],
+            },
+        ),
+    ]
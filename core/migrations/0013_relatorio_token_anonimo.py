@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-17 17:56
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_enderecogeocodificado'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='relatorio',
+            name='token_anonimo',
+            field=models.UUIDField(blank=True, editable=False, help_text='Identifica o visitante não logado que criou o relatório (ver core/autoria.py)', null=True, verbose_name='Token do autor anônimo'),
+        ),
+        migrations.AddIndex(
+            model_name='relatorio',
+            index=models.Index(condition=models.Q(('token_anonimo__isnull', False)), fields=['token_anonimo', 'data_criacao', 'id'], name='relatorio_token_data_id_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.4 on 2026-10-17 18:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_relatorio_token_anonimo'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PerfilRequisicao',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('view', models.CharField(max_length=200, verbose_name='View')),
+                ('caminho', models.TextField(verbose_name='Caminho')),
+                ('metodo', models.CharField(max_length=10, verbose_name='Método')),
+                ('status', models.PositiveSmallIntegerField(verbose_name='Status')),
+                ('motivo', models.CharField(choices=[('amostra', 'Amostragem'), ('cabecalho', 'Cabeçalho X-Perfilar')], max_length=20, verbose_name='Motivo')),
+                ('duracao_ms', models.FloatField(verbose_name='Duração (ms)')),
+                ('consultas', models.PositiveIntegerField(verbose_name='Consultas')),
+                ('tempo_banco_ms', models.FloatField(verbose_name='Tempo no banco (ms)')),
+                ('funcao_principal', models.CharField(blank=True, help_text='Maior tempo próprio (excluindo as funções chamadas)', max_length=500, verbose_name='Função mais cara')),
+                ('perfil', models.BinaryField(verbose_name='Perfil')),
+                ('sql', models.BinaryField(verbose_name='SQL')),
+                ('criado_em', models.DateTimeField(auto_now_add=True, verbose_name='Criado em')),
+                ('usuario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Usuário')),
+            ],
+            options={
+                'verbose_name': 'Perfil de Requisição',
+                'verbose_name_plural': 'Perfis de Requisições',
+                'ordering': ['-criado_em'],
+            },
+        ),
+        migrations.CreateModel(
+            name='FuncaoPerfil',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('funcao', models.CharField(max_length=500, verbose_name='Função')),
+                ('chamadas', models.PositiveIntegerField(verbose_name='Chamadas')),
+                ('tempo_proprio_ms', models.FloatField(verbose_name='Tempo próprio (ms)')),
+                ('tempo_acumulado_ms', models.FloatField(verbose_name='Tempo acumulado (ms)')),
+                ('perfil', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='funcoes', to='core.perfilrequisicao', verbose_name='Perfil')),
+            ],
+            options={
+                'verbose_name': 'Função do Perfil',
+                'verbose_name_plural': 'Funções dos Perfis',
+                'ordering': ['-tempo_proprio_ms'],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-17 18:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_perfil_requisicao'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='imagemrelatorio',
+            index=models.Index(fields=['imagem'], name='imagem_relatorio_imagem_idx'),
+        ),
+    ]
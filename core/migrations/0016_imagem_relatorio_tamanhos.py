@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-17 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_imagem_relatorio_indice_imagem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagemrelatorio',
+            name='tamanho',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Tamanho armazenado (bytes)'),
+        ),
+        migrations.AddField(
+            model_name='imagemrelatorio',
+            name='tamanho_enviado',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Tamanho enviado (bytes)'),
+        ),
+    ]
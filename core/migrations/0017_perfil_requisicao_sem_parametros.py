@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def remover_perfis(apps, schema_editor):
+    # Perfis gravados antes guardavam o SQL com os valores dos parâmetros
+    # (chaves de sessão, hashes de senha, tokens): não podem ser mantidos
+    apps.get_model('core', 'PerfilRequisicao').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_imagem_relatorio_tamanhos'),
+    ]
+
+    operations = [
+        migrations.RunPython(remover_perfis, migrations.RunPython.noop),
+    ]
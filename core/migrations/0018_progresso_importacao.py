@@ -0,0 +1,29 @@
+# Generated by Django 5.2.4 on 2026-10-17 18:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_perfil_requisicao_sem_parametros'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProgressoImportacao',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('arquivo', models.CharField(max_length=500, unique=True, verbose_name='Arquivo')),
+                ('tamanho', models.BigIntegerField(verbose_name='Tamanho do arquivo (bytes)')),
+                ('registros', models.PositiveIntegerField(default=0, verbose_name='Registros lidos')),
+                ('importados', models.PositiveIntegerField(default=0, verbose_name='Relatórios importados')),
+                ('rejeitados', models.PositiveIntegerField(default=0, verbose_name='Registros rejeitados')),
+                ('atualizado_em', models.DateTimeField(auto_now=True, verbose_name='Atualizado em')),
+            ],
+            options={
+                'verbose_name': 'Progresso de Importação',
+                'verbose_name_plural': 'Progressos de Importação',
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.4 on 2026-10-17 18:50
+
+from django.db import migrations, models
+
+
+def criar_primeira_fatia(apps, schema_editor):
+    """Garante os totais atuais na fatia 1, sem depender da primeira gravação"""
+    EstatisticasRelatorios = apps.get_model('core', 'EstatisticasRelatorios')
+    if EstatisticasRelatorios.objects.exists():
+        return
+    Relatorio = apps.get_model('core', 'Relatorio')
+    EstatisticasRelatorios.objects.create(
+        pk=1,
+        total_relatorios=Relatorio.objects.count(),
+        total_com_localizacao=Relatorio.objects.filter(latitude__isnull=False, longitude__isnull=False).count(),
+        total_imagens=apps.get_model('core', 'ImagemRelatorio').objects.count(),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_progresso_importacao'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='estatisticasrelatorios',
+            name='total_com_localizacao',
+            field=models.IntegerField(default=0, verbose_name='Relatórios com localização'),
+        ),
+        migrations.AlterField(
+            model_name='estatisticasrelatorios',
+            name='total_imagens',
+            field=models.IntegerField(default=0, verbose_name='Total de imagens'),
+        ),
+        migrations.AlterField(
+            model_name='estatisticasrelatorios',
+            name='total_relatorios',
+            field=models.IntegerField(default=0, verbose_name='Total de relatórios'),
+        ),
+        migrations.RunPython(criar_primeira_fatia, migrations.RunPython.noop),
+    ]
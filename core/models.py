@@ -1,10 +1,32 @@
-from django.db import models
+from django.db import models, transaction
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.auth.models import User
 from django.utils import timezone
-import os
+from PIL import Image
+from . import cache_respostas
+from .armazenamento import armazenamento, liberacoes_em_lote
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Create your models here.
 
+class RelatorioQuerySet(models.QuerySet):
+    """Nas exclusões, as imagens removidas em cascata liberam os arquivos em lote (ver core/armazenamento.py)"""
+    
+    def delete(self):
+        with liberacoes_em_lote():
+            return super().delete()
+
+
+class RelatorioManager(models.Manager.from_queryset(RelatorioQuerySet)):
+    """Não carrega o vetor de busca, usado apenas nos filtros do banco"""
+    
+    def get_queryset(self):
+        return super().get_queryset().defer('busca')
+
 class Relatorio(models.Model):
     """Modelo para relatórios criados pelos usuários"""
     
@@ -29,6 +51,13 @@ class Relatorio(models.Model):
         blank=True,
         help_text="Email do usuário quando não logado"
     )
+    token_anonimo = models.UUIDField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Token do autor anônimo",
+        help_text="Identifica o visitante não logado que criou o relatório (ver core/autoria.py)"
+    )
     
     titulo = models.CharField(
         max_length=200, 
@@ -67,10 +96,43 @@ class Relatorio(models.Model):
         verbose_name="Data de Criação"
     )
     
+    # Vetor da busca textual, preenchido por trigger no banco (ver core/busca.py)
+    busca = SearchVectorField(
+        null=True,
+        editable=False,
+        verbose_name="Vetor de busca"
+    )
+    
+    # Mantido pelos sinais de ImagemRelatorio (ver core/contadores.py)
+    num_imagens = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name="Número de imagens"
+    )
+    
+    objects = RelatorioManager()
+    
+    # Campos cujas alterações afetam os agregados do mapa e os contadores
+    CAMPOS_MONITORADOS = ('latitude', 'longitude', 'usuario_id', 'nome_usuario')
+    
     class Meta:
         verbose_name = "Relatório"
         verbose_name_plural = "Relatórios"
         ordering = ['-data_criacao']
+        indexes = [
+            # Consultas por viewport (bbox) do mapa do painel administrativo
+            models.Index(fields=['latitude', 'longitude'], name='relatorio_lat_lng_idx'),
+            GinIndex(fields=['busca'], name='relatorio_busca_gin_idx'),
+            # Paginação por cursor em (data_criacao, id), geral e por usuário
+            models.Index(fields=['data_criacao', 'id'], name='relatorio_data_id_idx'),
+            models.Index(fields=['usuario', 'data_criacao', 'id'], name='relatorio_usuario_data_id_idx'),
+            # Relatórios de um visitante anônimo; só os criados sem login têm token
+            models.Index(
+                fields=['token_anonimo', 'data_criacao', 'id'],
+                name='relatorio_token_data_id_idx',
+                condition=models.Q(token_anonimo__isnull=False),
+            ),
+        ]
 
     def __str__(self):
         if self.usuario:
@@ -110,9 +172,24 @@ class Relatorio(models.Model):
         """Verifica se o relatório tem localização definida"""
         return self.latitude is not None and self.longitude is not None
 
+    def delete(self, *args, **kwargs):
+        with liberacoes_em_lote():
+            return super().delete(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Guarda os valores carregados para atualizar agregados e contadores ao salvar
+        instance._valores_salvos = {
+            campo: getattr(instance, campo)
+            for campo in cls.CAMPOS_MONITORADOS if campo in field_names
+        }
+        return instance
+
 def relatorio_imagem_path(instance, filename):
     """Função para definir o caminho das imagens dos relatórios"""
-    # Organiza as imagens por relatório: media/relatorios/{relatorio_id}/{filename}
+    # Nome sugerido ao storage; o ArmazenamentoPorConteudo usa dele apenas a
+    # extensão e grava o arquivo em conteudo/<aa>/<bb>/<sha256>.<ext>
     return f'relatorios/{instance.relatorio.id}/{filename}'
 
 class ImagemRelatorio(models.Model):
@@ -126,6 +203,8 @@ class ImagemRelatorio(models.Model):
     )
     imagem = models.ImageField(
         upload_to=relatorio_imagem_path,
+        storage=armazenamento,
+        max_length=255,
         verbose_name="Imagem",
         help_text="Formatos suportados: JPG, PNG, GIF. Tamanho máximo: 5MB"
     )
@@ -145,17 +224,379 @@ class ImagemRelatorio(models.Model):
         help_text="Ordem de exibição da imagem no relatório"
     )
     
+    # Preenchidos pela normalização do upload (ver core/normalizacao.py)
+    tamanho_enviado = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Tamanho enviado (bytes)"
+    )
+    tamanho = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Tamanho armazenado (bytes)"
+    )
+    
+    # Versões reduzidas geradas a partir da imagem original (ver core/imagens.py)
+    miniatura = models.ImageField(
+        blank=True,
+        max_length=255,
+        editable=False,
+        verbose_name="Miniatura"
+    )
+    imagem_media = models.ImageField(
+        blank=True,
+        max_length=255,
+        editable=False,
+        verbose_name="Imagem em tamanho de exibição"
+    )
+    miniatura_webp = models.ImageField(
+        blank=True,
+        max_length=255,
+        editable=False,
+        verbose_name="Miniatura (WebP)"
+    )
+    imagem_media_webp = models.ImageField(
+        blank=True,
+        max_length=255,
+        editable=False,
+        verbose_name="Imagem em tamanho de exibição (WebP)"
+    )
+    
+    CAMPOS_DERIVADOS = ['miniatura', 'imagem_media', 'miniatura_webp', 'imagem_media_webp']
+    
     class Meta:
         verbose_name = "Imagem do Relatório"
         verbose_name_plural = "Imagens dos Relatórios"
         ordering = ['ordem', 'data_upload']
+        indexes = [
+            # Verificação de acesso ao servir um arquivo (ver core/midia.py)
+            models.Index(fields=['imagem'], name='imagem_relatorio_imagem_idx'),
+        ]
     
     def __str__(self):
         return f"Imagem {self.ordem} - {self.relatorio.titulo}"
     
-    def delete(self, *args, **kwargs):
-        # Remove o arquivo físico quando o objeto é deletado
-        if self.imagem:
-            if os.path.isfile(self.imagem.path):
-                os.remove(self.imagem.path)
-        super().delete(*args, **kwargs)
+    @property
+    def url_miniatura(self):
+        """URL da miniatura, ou da imagem original enquanto não houver derivados"""
+        return self.miniatura.url if self.miniatura else self.imagem.url
+    
+    @property
+    def url_media(self):
+        """URL da imagem em tamanho de exibição, ou da original enquanto não houver derivados"""
+        return self.imagem_media.url if self.imagem_media else self.imagem.url
+    
+    @property
+    def srcset(self):
+        """Valor do atributo srcset com as versões JPEG disponíveis"""
+        return self._montar_srcset(self.miniatura, self.imagem_media)
+    
+    @property
+    def srcset_webp(self):
+        """Valor do atributo srcset com as versões WebP disponíveis"""
+        return self._montar_srcset(self.miniatura_webp, self.imagem_media_webp)
+    
+    def _montar_srcset(self, miniatura, media):
+        if not (miniatura and media):
+            return ''
+        return (
+            f'{miniatura.url} {settings.IMAGEM_MINIATURA_LARGURA}w, '
+            f'{media.url} {settings.IMAGEM_MEDIA_LARGURA}w'
+        )
+    
+    def gerar_derivados(self):
+        """Gera e persiste as versões reduzidas da imagem"""
+        from .imagens import gerar_derivados
+        
+        try:
+            derivados = gerar_derivados(self.imagem.name)
+        except (OSError, Image.DecompressionBombError):
+            # Sem derivados os templates continuam usando a imagem original
+            logger.warning('Não foi possível gerar derivados de %s', self.imagem.name, exc_info=True)
+            return
+        
+        for campo, nome in derivados.items():
+            setattr(self, campo, nome)
+        ImagemRelatorio.objects.filter(pk=self.pk).update(**derivados)
+        transaction.on_commit(lambda: cache_respostas.invalidar_relatorio(self.relatorio_id))
+    
+    def save(self, *args, **kwargs):
+        # Arquivo recém-enviado ainda não foi gravado no storage
+        imagem_nova = bool(self.imagem) and not self.imagem._committed
+        # A trava do arquivo tomada pelo storage vale até a referência ser contada
+        # pelo sinal post_save (ver core/armazenamento.py)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+        if self.imagem and (imagem_nova or not self.miniatura):
+            # A mesma foto já enviada em outro relatório compartilha o arquivo e os derivados
+            existentes = (
+                ImagemRelatorio.objects.filter(imagem=self.imagem.name)
+                .exclude(pk=self.pk).exclude(miniatura='')
+                .values(*self.CAMPOS_DERIVADOS).first()
+            )
+            if existentes:
+                for campo, nome in existentes.items():
+                    setattr(self, campo, nome)
+                ImagemRelatorio.objects.filter(pk=self.pk).update(**existentes)
+            else:
+                # Gerados pelo worker depois do commit (ver core/tarefas.py)
+                from .tarefas import enfileirar
+                enfileirar('gerar_derivados', imagem_id=self.pk)
+    
+    # Os arquivos são removidos pelo sinal post_delete quando a última
+    # referência deixa de existir (ver core/armazenamento.py)
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Guarda o arquivo carregado para atualizar as referências se ele for trocado
+        if 'imagem' in field_names:
+            instance._imagem_salva = instance.imagem.name
+        return instance
+
+
+class AgregadoMapa(models.Model):
+    """Célula da grade de agrupamento do mapa em um nível de zoom (ver core/agrupamento.py)"""
+    
+    zoom = models.PositiveSmallIntegerField(verbose_name="Zoom")
+    celula_x = models.PositiveIntegerField(verbose_name="Célula X")
+    celula_y = models.PositiveIntegerField(verbose_name="Célula Y")
+    quantidade = models.IntegerField(default=0, verbose_name="Quantidade de relatórios")
+    soma_latitude = models.FloatField(default=0, verbose_name="Soma das latitudes")
+    soma_longitude = models.FloatField(default=0, verbose_name="Soma das longitudes")
+    
+    class Meta:
+        verbose_name = "Agregado do Mapa"
+        verbose_name_plural = "Agregados do Mapa"
+        constraints = [
+            models.UniqueConstraint(fields=['zoom', 'celula_x', 'celula_y'], name='agregado_mapa_celula_unica'),
+        ]
+    
+    def __str__(self):
+        return f"Zoom {self.zoom} ({self.celula_x}, {self.celula_y}): {self.quantidade}"
+
+
+class EstatisticasRelatorios(models.Model):
+    """
+    Fatia dos totais gerais dos relatórios; os totais são a soma das fatias
+    (ver core/contadores.py). Uma fatia pode ficar negativa
+    """
+    
+    total_relatorios = models.IntegerField(default=0, verbose_name="Total de relatórios")
+    total_com_localizacao = models.IntegerField(default=0, verbose_name="Relatórios com localização")
+    total_imagens = models.IntegerField(default=0, verbose_name="Total de imagens")
+    
+    class Meta:
+        verbose_name = "Estatísticas dos Relatórios"
+        verbose_name_plural = "Estatísticas dos Relatórios"
+    
+    def __str__(self):
+        return f"{self.total_relatorios} relatórios, {self.total_imagens} imagens"
+
+
+class ContagemAutor(models.Model):
+    """Quantidade de relatórios por autor: usuário registrado ou nome informado por não registrados"""
+    
+    usuario = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        verbose_name="Usuário"
+    )
+    nome_usuario = models.CharField(
+        max_length=100,
+        blank=True,
+        verbose_name="Nome do Usuário"
+    )
+    quantidade = models.IntegerField(default=0, verbose_name="Quantidade de relatórios")
+    
+    class Meta:
+        verbose_name = "Contagem por Autor"
+        verbose_name_plural = "Contagens por Autor"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['usuario'],
+                condition=models.Q(usuario__isnull=False),
+                name='contagem_autor_usuario_unico'
+            ),
+            models.UniqueConstraint(
+                fields=['nome_usuario'],
+                condition=models.Q(usuario__isnull=True),
+                name='contagem_autor_nome_unico'
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.usuario or self.nome_usuario}: {self.quantidade}"
+
+
+class Tarefa(models.Model):
+    """Tarefa em segundo plano processada pelo worker (ver core/tarefas.py)"""
+    
+    PENDENTE = 'pendente'
+    EXECUTANDO = 'executando'
+    CONCLUIDA = 'concluida'
+    FALHOU = 'falhou'
+    STATUS_CHOICES = [
+        (PENDENTE, 'Pendente'),
+        (EXECUTANDO, 'Em execução'),
+        (CONCLUIDA, 'Concluída'),
+        (FALHOU, 'Falhou'),
+    ]
+    
+    tipo = models.CharField(max_length=50, verbose_name="Tipo")
+    dados = models.JSONField(default=dict, blank=True, verbose_name="Dados")
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=PENDENTE,
+        verbose_name="Status"
+    )
+    tentativas = models.PositiveSmallIntegerField(default=0, verbose_name="Tentativas")
+    max_tentativas = models.PositiveSmallIntegerField(default=5, verbose_name="Máximo de tentativas")
+    erro = models.TextField(blank=True, verbose_name="Último erro")
+    executar_em = models.DateTimeField(
+        default=timezone.now,
+        verbose_name="Executar a partir de",
+        help_text="Adiada a cada nova tentativa após uma falha"
+    )
+    criada_em = models.DateTimeField(auto_now_add=True, verbose_name="Criada em")
+    iniciada_em = models.DateTimeField(null=True, blank=True, verbose_name="Iniciada em")
+    concluida_em = models.DateTimeField(null=True, blank=True, verbose_name="Concluída em")
+    
+    class Meta:
+        verbose_name = "Tarefa"
+        verbose_name_plural = "Tarefas"
+        ordering = ['-criada_em']
+        indexes = [
+            # Próximas tarefas a executar: WHERE status = 'pendente' ORDER BY executar_em
+            models.Index(fields=['status', 'executar_em'], name='tarefa_status_executar_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.tipo} #{self.pk} ({self.get_status_display()})"
+
+
+class ConteudoImagem(models.Model):
+    """Arquivo de imagem armazenado pelo hash do conteúdo e suas referências (ver core/armazenamento.py)"""
+    
+    arquivo = models.CharField(max_length=255, unique=True, verbose_name="Arquivo")
+    referencias = models.IntegerField(default=0, verbose_name="Referências")
+    
+    class Meta:
+        verbose_name = "Conteúdo de Imagem"
+        verbose_name_plural = "Conteúdos de Imagem"
+    
+    def __str__(self):
+        return f"{self.arquivo} ({self.referencias})"
+
+
+class EnderecoGeocodificado(models.Model):
+    """Resultado da geocodificação reversa de coordenadas arredondadas (ver core/geocodificacao.py)"""
+    
+    latitude = models.DecimalField(max_digits=10, decimal_places=6, verbose_name="Latitude")
+    longitude = models.DecimalField(max_digits=10, decimal_places=6, verbose_name="Longitude")
+    endereco = models.TextField(blank=True, verbose_name="Endereço")
+    atualizado_em = models.DateTimeField(auto_now=True, verbose_name="Atualizado em")
+    
+    class Meta:
+        verbose_name = "Endereço Geocodificado"
+        verbose_name_plural = "Endereços Geocodificados"
+        constraints = [
+            models.UniqueConstraint(fields=['latitude', 'longitude'], name='endereco_geocodificado_unico'),
+        ]
+    
+    def __str__(self):
+        return f"{self.latitude}, {self.longitude}: {self.endereco or '(sem endereço)'}"
+
+
+class PerfilRequisicao(models.Model):
+    """Perfil (cProfile) de uma requisição amostrada e o SQL executado nela (ver core/perfis.py)"""
+    
+    AMOSTRA = 'amostra'
+    CABECALHO = 'cabecalho'
+    MOTIVO_CHOICES = [
+        (AMOSTRA, 'Amostragem'),
+        (CABECALHO, 'Cabeçalho X-Perfilar'),
+    ]
+    
+    view = models.CharField(max_length=200, verbose_name="View")
+    caminho = models.TextField(verbose_name="Caminho")
+    metodo = models.CharField(max_length=10, verbose_name="Método")
+    status = models.PositiveSmallIntegerField(verbose_name="Status")
+    motivo = models.CharField(max_length=20, choices=MOTIVO_CHOICES, verbose_name="Motivo")
+    usuario = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name="Usuário"
+    )
+    duracao_ms = models.FloatField(verbose_name="Duração (ms)")
+    consultas = models.PositiveIntegerField(verbose_name="Consultas")
+    tempo_banco_ms = models.FloatField(verbose_name="Tempo no banco (ms)")
+    funcao_principal = models.CharField(
+        max_length=500,
+        blank=True,
+        verbose_name="Função mais cara",
+        help_text="Maior tempo próprio (excluindo as funções chamadas)"
+    )
+    # Comprimidos com zlib: estatísticas no formato do pstats e lista JSON das consultas
+    perfil = models.BinaryField(verbose_name="Perfil")
+    sql = models.BinaryField(verbose_name="SQL")
+    criado_em = models.DateTimeField(auto_now_add=True, verbose_name="Criado em")
+    
+    class Meta:
+        verbose_name = "Perfil de Requisição"
+        verbose_name_plural = "Perfis de Requisições"
+        ordering = ['-criado_em']
+    
+    def __str__(self):
+        return f"{self.metodo} {self.caminho} ({self.duracao_ms:.0f} ms)"
+
+
+class FuncaoPerfil(models.Model):
+    """Uma das funções mais caras de um perfil de requisição"""
+    
+    perfil = models.ForeignKey(
+        PerfilRequisicao,
+        on_delete=models.CASCADE,
+        related_name='funcoes',
+        verbose_name="Perfil"
+    )
+    funcao = models.CharField(max_length=500, verbose_name="Função")
+    chamadas = models.PositiveIntegerField(verbose_name="Chamadas")
+    tempo_proprio_ms = models.FloatField(verbose_name="Tempo próprio (ms)")
+    tempo_acumulado_ms = models.FloatField(verbose_name="Tempo acumulado (ms)")
+    
+    class Meta:
+        verbose_name = "Função do Perfil"
+        verbose_name_plural = "Funções dos Perfis"
+        ordering = ['-tempo_proprio_ms']
+    
+    def __str__(self):
+        return self.funcao
+
+
+class ProgressoImportacao(models.Model):
+    """
+    Progresso do comando importar_relatorios para um arquivo, atualizado na
+    mesma transação que insere cada lote: a retomada nunca repete um lote gravado
+    """
+    
+    arquivo = models.CharField(max_length=500, unique=True, verbose_name="Arquivo")
+    tamanho = models.BigIntegerField(verbose_name="Tamanho do arquivo (bytes)")
+    registros = models.PositiveIntegerField(default=0, verbose_name="Registros lidos")
+    importados = models.PositiveIntegerField(default=0, verbose_name="Relatórios importados")
+    rejeitados = models.PositiveIntegerField(default=0, verbose_name="Registros rejeitados")
+    atualizado_em = models.DateTimeField(auto_now=True, verbose_name="Atualizado em")
+    
+    class Meta:
+        verbose_name = "Progresso de Importação"
+        verbose_name_plural = "Progressos de Importação"
+    
+    def __str__(self):
+        return f"{self.arquivo}: {self.registros} registros lidos"
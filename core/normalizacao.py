@@ -0,0 +1,151 @@
+"""
+Normalização das imagens enviadas nos relatórios, antes do armazenamento.
+
+Fotos de celular chegam com 4 a 12 MP e EXIF completo. A tarefa
+``salvar_imagem`` (ver core/tarefas.py) grava no storage, no lugar do
+arquivo enviado, uma versão com a orientação da câmera aplicada aos pixels,
+sem metadados (EXIF, XMP, comentários; o perfil de cor é mantido), reduzida
+a IMAGEM_DIMENSAO_MAXIMA no maior lado e recomprimida com IMAGEM_QUALIDADE.
+Se a original já está adequada e a versão nova não é menor, a original é
+mantida. GIFs (possivelmente animados) são sempre regravados com todos os
+quadros, o loop e as durações, mas sem os blocos de comentário e as
+extensões de aplicação (XMP e outras), que o Pillow nem sempre expõe para
+sabermos se existem; as dimensões não são alteradas.
+
+A posição do GPS do EXIF é devolvida antes de ser descartada: ela preenche a
+localização dos relatórios enviados sem uma.
+
+Imagens com mais de IMAGEM_MAX_PIXELS (decompression bombs: poucos KB que
+ocupariam gigabytes de memória ao decodificar) são recusadas já no upload
+por ``verificar``, que lê apenas o cabeçalho.
+"""
+import hashlib
+import os
+from io import BytesIO
+
+from django.conf import settings
+from PIL import ExifTags, Image, ImageOps, UnidentifiedImageError
+
+
+# Chaves de Image.info com metadados que não são gravados de volta
+METADADOS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop')
+FORMATOS_NORMALIZADOS = ('JPEG', 'PNG')
+
+
+class ImagemInvalida(Exception):
+    pass
+
+
+def _abrir(arquivo):
+    try:
+        imagem = Image.open(arquivo)
+    except Image.DecompressionBombError:
+        raise ImagemInvalida('a imagem tem pixels demais')
+    except (UnidentifiedImageError, OSError):
+        raise ImagemInvalida('não é uma imagem JPG, PNG ou GIF válida')
+    if imagem.width * imagem.height > settings.IMAGEM_MAX_PIXELS:
+        imagem.close()
+        raise ImagemInvalida(
+            f'a imagem tem {imagem.width}x{imagem.height} pixels; '
+            f'o máximo é {settings.IMAGEM_MAX_PIXELS // 1000000} megapixels'
+        )
+    return imagem
+
+
+def verificar(arquivo):
+    """Recusa (ImagemInvalida) arquivos que não são imagens ou têm pixels demais, sem decodificá-los"""
+    posicao = arquivo.tell()
+    with _abrir(arquivo):
+        pass
+    arquivo.seek(posicao)
+
+
+def _graus(valor, referencia, limite):
+    try:
+        graus, minutos, segundos = (float(parte) for parte in valor)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    resultado = graus + minutos / 60 + segundos / 3600
+    if referencia in ('S', 'W'):
+        resultado = -resultado
+    return resultado if -limite <= resultado <= limite else None
+
+
+def localizacao_gps(imagem):
+    """(latitude, longitude) do GPS no EXIF, ou None"""
+    gps = imagem.getexif().get_ifd(ExifTags.IFD.GPSInfo)
+    latitude = _graus(gps.get(ExifTags.GPS.GPSLatitude), gps.get(ExifTags.GPS.GPSLatitudeRef), 90)
+    longitude = _graus(gps.get(ExifTags.GPS.GPSLongitude), gps.get(ExifTags.GPS.GPSLongitudeRef), 180)
+    # Câmeras sem sinal gravam 0,0
+    if latitude is None or longitude is None or (latitude == 0 and longitude == 0):
+        return None
+    return latitude, longitude
+
+
+def _tem_metadados(imagem):
+    return bool(imagem.getexif()) or any(chave in imagem.info for chave in METADADOS) or bool(
+        getattr(imagem, 'text', None)
+    )
+
+
+def _codificar(imagem, formato, info):
+    buffer = BytesIO()
+    opcoes = {}
+    if info.get('icc_profile'):
+        opcoes['icc_profile'] = info['icc_profile']
+    if formato == 'JPEG':
+        opcoes.update(quality=settings.IMAGEM_QUALIDADE, optimize=True, progressive=True)
+    else:
+        opcoes['optimize'] = True
+        if 'transparency' in info and imagem.mode in ('P', 'L', 'RGB'):
+            opcoes['transparency'] = info['transparency']
+    imagem.save(buffer, formato, **opcoes)
+    return buffer.getvalue()
+
+
+def _codificar_gif(imagem):
+    buffer = BytesIO()
+    # O comentário do primeiro quadro seria copiado; as extensões de aplicação
+    # não são gravadas pelo Pillow, exceto a do loop (NETSCAPE2.0)
+    imagem.save(buffer, 'GIF', save_all=True, comment=b'')
+    return buffer.getvalue()
+
+
+def normalizar(origem, destino):
+    """
+    Grava em ``destino`` a versão normalizada da imagem em ``origem``.
+    Retorna (sha256, localização): sha256 do arquivo gravado, ou None se a
+    original deve ser mantida (``destino`` não é criado), e (latitude,
+    longitude) do GPS, ou None. Levanta ImagemInvalida.
+    """
+    with open(origem, 'rb') as arquivo, _abrir(arquivo) as original:
+        localizacao = localizacao_gps(original)
+        formato = original.format
+        if formato == 'GIF':
+            try:
+                conteudo = _codificar_gif(original)
+            except (OSError, ValueError, Image.DecompressionBombError):
+                raise ImagemInvalida('não foi possível decodificar a imagem')
+            with open(destino, 'wb') as saida:
+                saida.write(conteudo)
+            return hashlib.sha256(conteudo).hexdigest(), localizacao
+        if formato not in FORMATOS_NORMALIZADOS:
+            return None, localizacao
+        info = dict(original.info)
+        orientada = original.getexif().get(ExifTags.Base.Orientation, 1) not in (1, None)
+        metadados = _tem_metadados(original)
+        try:
+            imagem = ImageOps.exif_transpose(original)
+            limite = settings.IMAGEM_DIMENSAO_MAXIMA
+            reduzida = max(imagem.size) > limite
+            if reduzida:
+                imagem.thumbnail((limite, limite), Image.Resampling.LANCZOS)
+            conteudo = _codificar(imagem, formato, info)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            raise ImagemInvalida('não foi possível decodificar a imagem')
+
+    if not (orientada or metadados or reduzida) and len(conteudo) >= os.path.getsize(origem):
+        return None, localizacao
+    with open(destino, 'wb') as saida:
+        saida.write(conteudo)
+    return hashlib.sha256(conteudo).hexdigest(), localizacao
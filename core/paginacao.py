@@ -0,0 +1,174 @@
+"""
+Paginação por cursor (keyset) das listagens de relatórios.
+
+Em vez de ``COUNT(*)`` + ``OFFSET``, cada página é buscada a partir da
+posição ``(data_criacao, id)`` do último (ou primeiro) relatório da página
+anterior, o que mantém o custo constante em qualquer profundidade. Os
+tokens de navegação são assinados e opacos para o usuário.
+
+Listagens com outra ordem (a busca textual ordena pela relevância) usam o
+Paginator do Django, para não perder a ordem escolhida, mas com a mesma
+contagem limitada (``contar``) no lugar do ``COUNT(*)`` exato.
+"""
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.core import signing
+from django.core.paginator import Paginator
+from django.db.models import Q
+
+
+SALT = 'core.paginacao'
+# Ordens atendidas pelo paginador keyset; vazia é a padrão do modelo (-data_criacao)
+ORDENS_POR_DATA = {(), ('-data_criacao',), ('-data_criacao', '-pk'), ('-data_criacao', '-id')}
+
+
+def contar(queryset):
+    """
+    Retorna (total, aproximado). Conta exatamente até
+    PAGINACAO_CONTAGEM_EXATA_ATE linhas; acima disso usa a estimativa do
+    planejador do PostgreSQL em vez de percorrer todo o conjunto filtrado.
+    """
+    limite = settings.PAGINACAO_CONTAGEM_EXATA_ATE
+    queryset = queryset.order_by()
+    parcial = queryset[:limite + 1].count()
+    if parcial <= limite:
+        return parcial, False
+
+    plano = queryset.explain(format='json')
+    try:
+        estimativa = int(json.loads(plano)[0]['Plan']['Plan Rows'])
+    except (ValueError, KeyError, IndexError, TypeError):
+        estimativa = 0
+    return max(estimativa, parcial), True
+
+
+def ordem_por_data(queryset):
+    """Se o queryset está na ordem (-data_criacao, -id) do paginador keyset"""
+    return not queryset.query.extra_order_by and tuple(queryset.query.order_by) in ORDENS_POR_DATA
+
+
+class PaginaCursor:
+    """Página de resultados com tokens para a página anterior e a próxima"""
+
+    por_cursor = True
+
+    def __init__(self, object_list, token_anterior, token_proximo):
+        self.object_list = object_list
+        self.token_anterior = token_anterior
+        self.token_proximo = token_proximo
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, indice):
+        return self.object_list[indice]
+
+    def has_previous(self):
+        return self.token_anterior is not None
+
+    def has_next(self):
+        return self.token_proximo is not None
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+
+class PaginadorCursor:
+    """Paginador keyset na ordem (-data_criacao, -id) usada pelo modelo Relatorio"""
+
+    def __init__(self, queryset, por_pagina):
+        self.queryset = queryset
+        self.por_pagina = por_pagina
+
+    def _token(self, relatorio, direcao):
+        return signing.dumps(
+            [relatorio.data_criacao.isoformat(), relatorio.pk, direcao],
+            salt=SALT,
+        )
+
+    def _ler_token(self, token):
+        try:
+            data, pk, direcao = signing.loads(token, salt=SALT)
+            return datetime.fromisoformat(data), int(pk), direcao
+        except (signing.BadSignature, ValueError, TypeError):
+            return None
+
+    def pagina(self, token=None):
+        """Retorna a página indicada pelo token (ou a primeira, se ausente ou inválido)"""
+        cursor = self._ler_token(token) if token else None
+        limite = self.por_pagina + 1
+
+        if cursor is None:
+            objetos = list(self.queryset.order_by('-data_criacao', '-pk')[:limite])
+            tem_mais = len(objetos) > self.por_pagina
+            objetos = objetos[:self.por_pagina]
+            return PaginaCursor(
+                objetos,
+                None,
+                self._token(objetos[-1], 'apos') if tem_mais else None,
+            )
+
+        data, pk, direcao = cursor
+        if direcao == 'antes':
+            # Página anterior: percorre em ordem crescente a partir do cursor e inverte
+            objetos = list(
+                self.queryset.filter(data_criacao__gte=data)
+                .filter(Q(data_criacao__gt=data) | Q(pk__gt=pk))
+                .order_by('data_criacao', 'pk')[:limite]
+            )
+            tem_mais = len(objetos) > self.por_pagina
+            objetos = objetos[:self.por_pagina][::-1]
+            if not objetos:
+                return self.pagina()
+            return PaginaCursor(
+                objetos,
+                self._token(objetos[0], 'antes') if tem_mais else None,
+                self._token(objetos[-1], 'apos'),
+            )
+
+        objetos = list(
+            self.queryset.filter(data_criacao__lte=data)
+            .filter(Q(data_criacao__lt=data) | Q(pk__lt=pk))
+            .order_by('-data_criacao', '-pk')[:limite]
+        )
+        tem_mais = len(objetos) > self.por_pagina
+        objetos = objetos[:self.por_pagina]
+        if not objetos:
+            return self.pagina()
+        return PaginaCursor(
+            objetos,
+            self._token(objetos[0], 'antes'),
+            self._token(objetos[-1], 'apos') if tem_mais else None,
+        )
+
+
+def paginar(request, queryset, por_pagina, total=None):
+    """
+    Pagina uma listagem de relatórios. Retorna (página, total, aproximado).
+    Com PAGINACAO_POR_CURSOR ativo usa o paginador keyset e a contagem
+    aproximada; listagens com outra ordem (ver ``ordem_por_data``) usam o
+    Paginator do Django com a contagem aproximada. Sem a configuração, o
+    Paginator com a contagem exata. Um ``total`` já conhecido (por exemplo,
+    dos contadores) dispensa a contagem.
+    """
+    if settings.PAGINACAO_POR_CURSOR and ordem_por_data(queryset):
+        pagina = PaginadorCursor(queryset, por_pagina).pagina(request.GET.get('cursor'))
+        if total is not None:
+            return pagina, total, False
+        total, aproximado = contar(queryset)
+        return pagina, total, aproximado
+
+    paginator = Paginator(queryset, por_pagina)
+    aproximado = False
+    if total is None and settings.PAGINACAO_POR_CURSOR:
+        total, aproximado = contar(queryset)
+    if total is not None:
+        # Paginator.count é uma cached_property; o valor informado evita o COUNT(*)
+        paginator.count = total
+    pagina = paginator.get_page(request.GET.get('page'))
+    return pagina, paginator.count, aproximado
@@ -0,0 +1,159 @@
+"""
+Perfis (cProfile) de requisições amostradas, consultados pelo admin.
+
+Desativado por padrão. O PerfilMiddleware perfila uma fração PERFIS_AMOSTRAGEM
+das requisições (ex.: 0.01) e, independente da amostragem, as requisições de
+administradores que enviem o cabeçalho ``X-Perfilar: 1``, útil para reproduzir
+em produção uma combinação de filtros lenta do painel:
+
+    curl -H 'X-Perfilar: 1' -b 'sessionid=...' 'https://servidor/painel/relatorios/?search=...'
+
+Cada perfil é gravado em ``PerfilRequisicao`` com as estatísticas comprimidas
+(formato do pstats, que pode ser baixado pelo admin e aberto no snakeviz), o
+SQL executado (sem os valores dos parâmetros) e as funções mais caras em
+``FuncaoPerfil``. O perfil cobre a view e os middlewares abaixo deste; em
+respostas em streaming, apenas até o início do envio. São mantidos apenas os PERFIS_MAXIMO mais recentes.
+"""
+import cProfile
+import json
+import logging
+import marshal
+import pstats
+import random
+import time
+import zlib
+
+from django.conf import settings
+from django.db import connection
+
+from .models import FuncaoPerfil, PerfilRequisicao
+
+logger = logging.getLogger(__name__)
+
+CABECALHO = 'X-Perfilar'
+
+
+def _motivo(request):
+    if request.headers.get(CABECALHO) == '1' and request.user.is_staff:
+        return PerfilRequisicao.CABECALHO
+    if settings.PERFIS_AMOSTRAGEM and random.random() < settings.PERFIS_AMOSTRAGEM:
+        return PerfilRequisicao.AMOSTRA
+    return None
+
+
+def _nome_da_funcao(chave):
+    arquivo, linha, nome = chave
+    return f'{arquivo}:{linha}({nome})'[-500:]
+
+
+def comprimir(dados):
+    return zlib.compress(dados, 6)
+
+
+def descomprimir(dados):
+    return zlib.decompress(bytes(dados))
+
+
+def consultas_do_perfil(perfil):
+    """Lista de dicionários {sql, tempo_ms} gravada com o perfil"""
+    return json.loads(descomprimir(perfil.sql))
+
+
+class _CapturaSQL:
+    """
+    execute_wrapper que guarda o SQL e o tempo de cada consulta. Os valores
+    dos parâmetros não são guardados (apenas os marcadores %s): incluiriam
+    chaves de sessão, hashes de senha, tokens e e-mails
+    """
+
+    def __init__(self):
+        self.consultas = []
+        self.tempo = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        inicio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duracao = time.perf_counter() - inicio
+            self.tempo += duracao
+            if len(self.consultas) < settings.PERFIS_MAX_CONSULTAS:
+                self.consultas.append({'sql': sql, 'tempo_ms': round(duracao * 1000, 3)})
+
+
+def _gravar(request, response, motivo, perfil, captura, duracao):
+    estatisticas = pstats.Stats(perfil).stats
+    # Funções mais caras por tempo próprio e por tempo acumulado
+    funcoes = {}
+    for indice in (2, 3):
+        for chave, valores in sorted(
+            estatisticas.items(), key=lambda item: item[1][indice], reverse=True
+        )[:settings.PERFIS_FUNCOES]:
+            funcoes[chave] = valores
+    principal = max(estatisticas.items(), key=lambda item: item[1][2], default=None)
+
+    correspondencia = getattr(request, 'resolver_match', None)
+    registro = PerfilRequisicao.objects.create(
+        view=correspondencia.view_name if correspondencia is not None else 'nao_encontrada',
+        caminho=request.get_full_path(),
+        metodo=request.method,
+        status=response.status_code,
+        motivo=motivo,
+        usuario=request.user if request.user.is_authenticated else None,
+        duracao_ms=duracao * 1000,
+        consultas=len(captura.consultas),
+        tempo_banco_ms=captura.tempo * 1000,
+        funcao_principal=_nome_da_funcao(principal[0]) if principal else '',
+        perfil=comprimir(marshal.dumps(estatisticas)),
+        sql=comprimir(json.dumps(captura.consultas).encode()),
+    )
+    FuncaoPerfil.objects.bulk_create([
+        FuncaoPerfil(
+            perfil=registro,
+            funcao=_nome_da_funcao(chave),
+            chamadas=chamadas,
+            tempo_proprio_ms=tempo_proprio * 1000,
+            tempo_acumulado_ms=tempo_acumulado * 1000,
+        )
+        for chave, (_, chamadas, tempo_proprio, tempo_acumulado, _) in funcoes.items()
+    ])
+
+    # Retenção: descarta os perfis mais antigos
+    limite = registro.pk - settings.PERFIS_MAXIMO
+    if limite > 0:
+        PerfilRequisicao.objects.filter(pk__lte=limite).delete()
+
+
+class PerfilMiddleware:
+    """Perfila as requisições amostradas; deve vir depois do AuthenticationMiddleware"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        motivo = _motivo(request)
+        if motivo is None:
+            return self.get_response(request)
+
+        perfil = cProfile.Profile()
+        captura = _CapturaSQL()
+        try:
+            perfil.enable()
+        except ValueError:
+            # Outro profiler já está ativo nesta thread
+            return self.get_response(request)
+
+        inicio = time.perf_counter()
+        try:
+            with connection.execute_wrapper(captura):
+                response = self.get_response(request)
+        finally:
+            perfil.disable()
+        duracao = time.perf_counter() - inicio
+
+        try:
+            _gravar(request, response, motivo, perfil, captura, duracao)
+        except Exception:
+            # O perfil nunca deve derrubar a requisição
+            logger.exception('Falha ao gravar o perfil de %s', request.path)
+        return response
@@ -0,0 +1,83 @@
+"""
+Consultas por proximidade: relatórios num raio e os k mais próximos de um ponto.
+
+As duas consultas começam pelo retângulo (bbox) que contém o círculo de
+busca, filtrado pelo índice (latitude, longitude) de Relatorio, e calculam a
+distância exata (haversine, em metros) no próprio banco apenas para os
+relatórios dentro dele; a ordenação e o limite também ficam no banco, então
+só os resultados chegam ao Python.
+
+Os k mais próximos são procurados num raio inicial (PROXIMIDADE_RAIO_INICIAL)
+que dobra até encontrar k relatórios ou chegar ao raio máximo: quando o
+círculo de raio r contém k relatórios, nenhum relatório fora dele está mais
+perto que o k-ésimo, então o resultado é exato. Em regiões densas bastam uma
+ou duas consultas pequenas; em regiões vazias, no máximo
+log2(raio máximo / raio inicial) + 1.
+"""
+import math
+
+from django.conf import settings
+from django.db.models import FloatField, Q, Value
+from django.db.models.functions import ASin, Cast, Cos, Least, Power, Radians, Sin, Sqrt
+
+
+RAIO_TERRA = 6371008.8  # metros (raio médio)
+METROS_POR_GRAU = math.pi * RAIO_TERRA / 180
+K_PADRAO = 20
+
+
+def distancia(latitude, longitude):
+    """Expressão da distância em metros (haversine) entre o relatório e o ponto"""
+    phi = math.radians(latitude)
+    lat = Radians(Cast('latitude', FloatField()))
+    lng = Radians(Cast('longitude', FloatField()))
+    a = (
+        Power(Sin((lat - Value(phi)) / Value(2.0)), 2)
+        + Value(math.cos(phi)) * Cos(lat) * Power(Sin((lng - Value(math.radians(longitude))) / Value(2.0)), 2)
+    )
+    # Least: o arredondamento pode passar de 1 em pontos antípodas
+    return Value(2 * RAIO_TERRA) * ASin(Sqrt(Least(a, Value(1.0))))
+
+
+def filtro_bbox(latitude, longitude, metros):
+    """Filtro do retângulo que contém o círculo de ``metros`` em torno do ponto"""
+    graus = metros / METROS_POR_GRAU
+    sul, norte = latitude - graus, latitude + graus
+    filtro = Q(latitude__range=(max(sul, -90.0), min(norte, 90.0)))
+    # Largura do círculo em longitude (maior que ``graus`` longe do equador)
+    razao = math.sin(metros / RAIO_TERRA) / math.cos(math.radians(latitude)) if abs(latitude) < 90 else 2
+    if sul <= -90 or norte >= 90 or razao >= 1:
+        # O círculo contém um polo: todas as longitudes
+        return filtro
+    largura = math.degrees(math.asin(razao))
+    oeste, leste = longitude - largura, longitude + largura
+    if oeste < -180 or leste > 180:
+        # Atravessa o antimeridiano
+        oeste = (oeste + 180) % 360 - 180
+        leste = (leste + 180) % 360 - 180
+        return filtro & (Q(longitude__gte=oeste) | Q(longitude__lte=leste))
+    return filtro & Q(longitude__range=(oeste, leste))
+
+
+def no_raio(relatorios, latitude, longitude, metros):
+    """Relatórios a até ``metros`` do ponto, anotados com ``distancia`` e do mais próximo ao mais distante"""
+    return (
+        relatorios.filter(filtro_bbox(latitude, longitude, metros))
+        .annotate(distancia=distancia(latitude, longitude))
+        .filter(distancia__lte=metros)
+        .order_by('distancia', 'pk')
+    )
+
+
+def mais_proximos(relatorios, latitude, longitude, k, raio_maximo=None):
+    """
+    Lista dos ``k`` relatórios mais próximos do ponto a até ``raio_maximo``
+    metros (PROXIMIDADE_RAIO_MAXIMO), anotados com ``distancia``
+    """
+    raio_maximo = raio_maximo or settings.PROXIMIDADE_RAIO_MAXIMO
+    metros = min(settings.PROXIMIDADE_RAIO_INICIAL, raio_maximo)
+    while True:
+        encontrados = list(no_raio(relatorios, latitude, longitude, metros)[:k])
+        if len(encontrados) == k or metros >= raio_maximo:
+            return encontrados
+        metros = min(metros * 2, raio_maximo)
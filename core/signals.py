@@ -0,0 +1,160 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import agrupamento, armazenamento, cache_respostas, contadores, facetas
+from .models import ImagemRelatorio, Relatorio
+
+
+def _localizacao(latitude, longitude):
+    if latitude is None or longitude is None:
+        return None
+    return float(latitude), float(longitude)
+
+
+@receiver(post_save, sender=Relatorio)
+def atualizar_agregados_e_contadores(sender, instance, created, raw=False, **kwargs):
+    """Atualiza agregados do mapa e contadores quando um relatório é criado ou alterado"""
+    if raw:
+        return
+    monitorados = set(Relatorio.CAMPOS_MONITORADOS)
+    if monitorados & instance.get_deferred_fields():
+        # Campos não carregados também não foram alterados
+        return
+    
+    salvos = {} if created else getattr(instance, '_valores_salvos', {})
+    atuais = {campo: getattr(instance, campo) for campo in monitorados}
+    instance._valores_salvos = atuais
+    
+    anterior = _localizacao(salvos.get('latitude'), salvos.get('longitude'))
+    atual = _localizacao(atuais['latitude'], atuais['longitude'])
+    autor_atual = contadores.autor_do_relatorio(atuais['usuario_id'], atuais['nome_usuario'])
+    
+    if created:
+        contadores.registrar_relatorio(autor_atual, atual is not None, sinal=1)
+        transaction.on_commit(facetas.invalidar)
+    else:
+        autor_anterior = contadores.autor_do_relatorio(salvos.get('usuario_id'), salvos.get('nome_usuario'))
+        contadores.alterar_relatorio(autor_anterior, autor_atual, anterior is not None, atual is not None)
+        if autor_anterior != autor_atual:
+            transaction.on_commit(facetas.invalidar)
+    
+    if anterior != atual:
+        if anterior:
+            agrupamento.registrar_apos_commit(*anterior, sinal=-1)
+        if atual:
+            agrupamento.registrar_apos_commit(*atual, sinal=1)
+
+
+@receiver(post_delete, sender=Relatorio)
+def remover_dos_agregados_e_contadores(sender, instance, **kwargs):
+    """Retira o relatório removido (inclusive em cascata) dos agregados e contadores"""
+    salvos = getattr(instance, '_valores_salvos', {})
+    valores = {
+        campo: salvos[campo] if campo in salvos else getattr(instance, campo)
+        for campo in Relatorio.CAMPOS_MONITORADOS
+    }
+    localizacao = _localizacao(valores['latitude'], valores['longitude'])
+    contadores.registrar_relatorio(
+        contadores.autor_do_relatorio(valores['usuario_id'], valores['nome_usuario']),
+        localizacao is not None,
+        sinal=-1,
+    )
+    transaction.on_commit(facetas.invalidar)
+    if localizacao:
+        agrupamento.registrar_apos_commit(*localizacao, sinal=-1)
+
+
+@receiver(post_save, sender=ImagemRelatorio)
+def contar_imagem_criada(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        contadores.registrar_imagem(instance.relatorio_id, sinal=1)
+
+
+@receiver(post_save, sender=ImagemRelatorio)
+def referenciar_arquivo(sender, instance, created, raw=False, **kwargs):
+    """Atualiza as referências do arquivo compartilhado (ver core/armazenamento.py)"""
+    if raw:
+        return
+    anterior = '' if created else getattr(instance, '_imagem_salva', instance.imagem.name)
+    if instance.imagem.name != anterior:
+        if instance.imagem.name:
+            armazenamento.referenciar(instance.imagem.name)
+        if anterior:
+            armazenamento.liberar(anterior)
+    instance._imagem_salva = instance.imagem.name
+
+
+@receiver(post_delete, sender=ImagemRelatorio)
+def contar_imagem_removida(sender, instance, **kwargs):
+    contadores.registrar_imagem(instance.relatorio_id, sinal=-1)
+
+
+@receiver(post_delete, sender=ImagemRelatorio)
+def liberar_arquivo(sender, instance, **kwargs):
+    """Também nas exclusões em cascata, ao contrário de ImagemRelatorio.delete()"""
+    if instance.imagem.name:
+        armazenamento.liberar(instance.imagem.name)
+
+
+@receiver(post_save, sender=Relatorio)
+@receiver(post_delete, sender=Relatorio)
+def invalidar_cache_do_relatorio(sender, instance, raw=False, **kwargs):
+    """Descarta o corpo em cache das páginas de detalhes (ver core/cache_respostas.py)"""
+    if not raw:
+        relatorio_id = instance.pk
+        transaction.on_commit(lambda: cache_respostas.invalidar_relatorio(relatorio_id))
+
+
+@receiver(post_save, sender=ImagemRelatorio)
+@receiver(post_delete, sender=ImagemRelatorio)
+def invalidar_cache_das_imagens(sender, instance, raw=False, **kwargs):
+    if not raw:
+        relatorio_id = instance.relatorio_id
+        transaction.on_commit(lambda: cache_respostas.invalidar_relatorio(relatorio_id))
+
+
+# Campos do autor exibidos nas páginas de detalhes
+CAMPOS_EXIBIDOS_DO_USUARIO = ('username', 'first_name', 'last_name', 'email', 'is_staff')
+
+
+@receiver(pre_save, sender=User)
+def verificar_alteracoes_do_usuario(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    Marca o usuário cujos dados exibidos mudaram, para descartar o cache das
+    páginas, e o que trocou de username, para reindexar seus relatórios. Os
+    saves que só gravam o last_login (a cada login) não consultam o banco.
+    """
+    instance._exibicao_alterada = instance._username_alterado = False
+    campos = CAMPOS_EXIBIDOS_DO_USUARIO
+    if update_fields is not None:
+        campos = tuple(campo for campo in campos if campo in update_fields)
+    if raw or instance.pk is None or not campos:
+        return
+    anteriores = User.objects.filter(pk=instance.pk).values(*campos).first()
+    if anteriores is None:
+        return
+    alterados = {campo for campo, valor in anteriores.items() if valor != getattr(instance, campo)}
+    instance._exibicao_alterada = bool(alterados)
+    instance._username_alterado = 'username' in alterados
+
+
+@receiver(post_save, sender=User)
+def invalidar_cache_do_usuario(sender, instance, raw=False, **kwargs):
+    """O nome, o email e o username do autor aparecem nas páginas de detalhes"""
+    if not raw and getattr(instance, '_exibicao_alterada', False):
+        usuario_id = instance.pk
+        transaction.on_commit(lambda: cache_respostas.invalidar_usuario(usuario_id))
+        instance._exibicao_alterada = False
+
+
+@receiver(post_save, sender=User)
+def reindexar_relatorios_do_usuario(sender, instance, **kwargs):
+    """O username faz parte do vetor de busca dos relatórios do usuário"""
+    if getattr(instance, '_username_alterado', False):
+        # Qualquer UPDATE da coluna dispara o trigger que recalcula o vetor
+        Relatorio.objects.filter(usuario=instance).update(busca=None)
+        # O username também é o valor exibido no filtro de autores
+        transaction.on_commit(facetas.invalidar)
+        instance._username_alterado = False
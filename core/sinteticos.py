@@ -0,0 +1,209 @@
+"""
+Dados sintéticos de relatórios e imagens, reproduzíveis por semente.
+
+Usados pelo teste de carga (comando ``teste_carga``), que monta envios
+realistas ao ``criar_relatorio``, e pelo gerador de bases de teste
+(comando ``gerar_dados_sinteticos``). Todas as funções recebem um
+``random.Random`` já semeado: a mesma semente gera os mesmos relatórios e as
+mesmas imagens.
+
+A distribuição imita a dos relatórios reais: concentrados em focos
+(bairros com problemas recorrentes) dentro das cidades, mais frequentes nos
+últimos meses, em horário comercial e em picos logo após as tempestades.
+
+As imagens imitam fotos de celular reduzidas: gradiente, formas desfocadas e
+ruído, o que deixa o JPEG com 0,3 a 1 bit por pixel, como uma foto real (um
+JPEG liso teria poucos KB e subestimaria o upload e o disco). Gerar uma
+imagem leva centenas de milissegundos, por isso o teste de carga gera poucas e
+usa ``tornar_unico`` para que cada envio tenha um conteúdo (e um SHA-256)
+diferente, sem ser deduplicado pelo armazenamento (ver core/armazenamento.py).
+"""
+import io
+import struct
+import uuid
+from datetime import timedelta
+
+from PIL import Image, ImageDraw, ImageFilter
+
+
+# Domínio reservado (RFC 2606): identifica os relatórios sintéticos na base
+DOMINIO_EMAIL = 'sintetico.invalid'
+
+# Centro padrão do mapa do formulário (ver criar_relatorio.html)
+CENTRO_PADRAO = (-15.7801, -47.9292)
+
+# (nome, latitude, longitude, peso aproximado pela população em milhões)
+CIDADES = [
+    ('São Paulo', -23.5505, -46.6333, 11.5),
+    ('Rio de Janeiro', -22.9068, -43.1729, 6.2),
+    ('Brasília', -15.7801, -47.9292, 2.8),
+    ('Fortaleza', -3.7319, -38.5267, 2.4),
+    ('Salvador', -12.9714, -38.5014, 2.4),
+    ('Belo Horizonte', -19.9167, -43.9345, 2.3),
+    ('Manaus', -3.1190, -60.0217, 2.1),
+    ('Curitiba', -25.4284, -49.2733, 1.8),
+    ('Recife', -8.0476, -34.8770, 1.5),
+    ('Porto Alegre', -30.0346, -51.2177, 1.3),
+]
+KM_POR_GRAU = 111
+
+PROBLEMAS = [
+    ('Buraco', 'um buraco grande na pista, que já causou acidentes com motos'),
+    ('Poste sem luz', 'a iluminação pública está apagada há várias noites'),
+    ('Lixo acumulado', 'lixo acumulado na calçada, com mau cheiro e insetos'),
+    ('Árvore caída', 'uma árvore caiu depois da chuva e bloqueia a passagem'),
+    ('Alagamento', 'a rua alaga a cada chuva forte e a água invade as casas'),
+    ('Calçada quebrada', 'a calçada está quebrada e impede a passagem de cadeirantes'),
+    ('Semáforo com defeito', 'o semáforo está piscando em amarelo o dia todo'),
+    ('Bueiro entupido', 'o bueiro está entupido e a água não escoa'),
+]
+DETALHES = [
+    'O problema piora a cada dia.',
+    'Já liguei para a prefeitura duas vezes e nada foi feito.',
+    'Moradores idosos e crianças passam por ali todos os dias.',
+    'À noite a situação é ainda mais perigosa.',
+    'Depois da última chuva ficou bem pior.',
+    'Há uma escola e um posto de saúde bem perto.',
+    'Vários vizinhos também reclamaram.',
+    'Segue foto para ajudar a localizar.',
+]
+DESDE = ['há uma semana', 'há duas semanas', 'há mais de um mês', 'desde a última chuva', 'desde ontem',
+         'há alguns dias']
+LOGRADOUROS = ['Rua das Flores', 'Avenida Central', 'Rua do Comércio', 'Quadra 302', 'Rua Projetada 4',
+               'Avenida das Palmeiras', 'Travessa da Escola', 'Rua São José']
+BAIRROS = ['Centro', 'Jardim América', 'Vila Nova', 'Boa Vista', 'Santa Luzia', 'São Francisco',
+           'Industrial', 'Planalto', 'Bela Vista', 'Novo Horizonte']
+NOMES = ['Ana', 'Bruno', 'Carla', 'Diego', 'Fernanda', 'Gabriel', 'Helena', 'Igor', 'Juliana', 'Lucas',
+         'Mariana', 'Paulo', 'Renata', 'Tiago']
+SOBRENOMES = ['Almeida', 'Barbosa', 'Costa', 'Ferreira', 'Gomes', 'Lima', 'Oliveira', 'Pereira',
+              'Rodrigues', 'Santos', 'Silva', 'Souza']
+
+
+def _cor(aleatorio):
+    return tuple(aleatorio.randrange(256) for _ in range(3))
+
+
+def jpeg(aleatorio, largura=2048, altura=1536, qualidade=85):
+    """Bytes de um JPEG com a textura e o tamanho típicos de uma foto"""
+    mascara = Image.linear_gradient('L').rotate(aleatorio.uniform(0, 360)).resize((largura, altura))
+    imagem = Image.composite(
+        Image.new('RGB', (largura, altura), _cor(aleatorio)),
+        Image.new('RGB', (largura, altura), _cor(aleatorio)),
+        mascara,
+    )
+    desenho = ImageDraw.Draw(imagem)
+    for _ in range(aleatorio.randint(20, 60)):
+        x, y = aleatorio.randrange(largura), aleatorio.randrange(altura)
+        raio = aleatorio.randint(10, max(11, largura // 5))
+        forma = desenho.ellipse if aleatorio.random() < 0.5 else desenho.rectangle
+        forma([x - raio, y - raio, x + raio, y + raio], fill=_cor(aleatorio))
+    imagem = imagem.filter(ImageFilter.GaussianBlur(2))
+    ruido = Image.effect_noise((largura, altura), aleatorio.uniform(20, 40)).convert('RGB')
+    imagem = Image.blend(imagem, ruido, 0.25)
+
+    saida = io.BytesIO()
+    imagem.save(saida, 'JPEG', quality=qualidade)
+    return saida.getvalue()
+
+
+def tornar_unico(conteudo, aleatorio):
+    """
+    Mesmo JPEG com um segmento de comentário aleatório logo após o SOI:
+    a imagem decodificada não muda, mas o conteúdo e o hash sim.
+    """
+    comentario = aleatorio.randbytes(16).hex().encode()
+    segmento = b'\xff\xfe' + struct.pack('>H', len(comentario) + 2) + comentario
+    return conteudo[:2] + segmento + conteudo[2:]
+
+
+def _gauss_km(aleatorio, centro, desvio_km):
+    return (
+        centro[0] + aleatorio.gauss(0, desvio_km / KM_POR_GRAU),
+        centro[1] + aleatorio.gauss(0, desvio_km / KM_POR_GRAU),
+    )
+
+
+def focos(aleatorio, por_cidade=8):
+    """
+    Focos de relatórios de cada cidade: [(cidade, latitude, longitude, desvio em km, peso)].
+    Gerados uma vez por semente e compartilhados por todos os lotes.
+    """
+    resultado = []
+    for nome, latitude, longitude, peso in CIDADES:
+        for _ in range(por_cidade):
+            centro = _gauss_km(aleatorio, (latitude, longitude), 6)
+            # Poucos focos concentram a maior parte dos relatórios da cidade
+            resultado.append((nome, *centro, aleatorio.uniform(0.2, 1.5), peso * aleatorio.paretovariate(1.5)))
+    return resultado
+
+
+def ponto(aleatorio, focos, fracao_dispersa=0.2):
+    """(cidade, latitude, longitude) perto de um foco ou, às vezes, em qualquer ponto da cidade"""
+    cidade, latitude, longitude, desvio_km, _ = aleatorio.choices(focos, weights=[foco[4] for foco in focos])[0]
+    if aleatorio.random() < fracao_dispersa:
+        centro = next((lat, lng) for nome, lat, lng, _ in CIDADES if nome == cidade)
+        return (cidade, *_gauss_km(aleatorio, centro, 8))
+    return (cidade, *_gauss_km(aleatorio, (latitude, longitude), desvio_km))
+
+
+def tempestades(aleatorio, fim, dias, quantidade):
+    """Inícios das tempestades no período que termina em ``fim``"""
+    return sorted(fim - timedelta(days=aleatorio.uniform(0, dias)) for _ in range(quantidade))
+
+
+def data_criacao(aleatorio, fim, dias, tempestades, fracao_tempestades=0.25):
+    """
+    Data de um relatório nos ``dias`` anteriores a ``fim``: mais relatórios
+    recentes (decaimento exponencial), em horário comercial e nas 48 horas
+    após cada tempestade.
+    """
+    if tempestades and aleatorio.random() < fracao_tempestades:
+        data = aleatorio.choice(tempestades) + timedelta(hours=aleatorio.expovariate(1 / 12))
+        return min(data, fim)
+    idade = min(aleatorio.expovariate(3 / dias), dias)
+    dia = (fim - timedelta(days=idade)).replace(hour=0, minute=0, second=0, microsecond=0)
+    hora = min(max(aleatorio.gauss(14, 4), 0), 23.99)
+    return min(dia + timedelta(hours=hora, seconds=aleatorio.randrange(60)), fim)
+
+
+def pessoa(aleatorio):
+    """(nome, email) de um visitante anônimo"""
+    nome = f'{aleatorio.choice(NOMES)} {aleatorio.choice(SOBRENOMES)}'
+    return nome, f'{nome.lower().replace(" ", ".")}.{aleatorio.randrange(10**6)}@{DOMINIO_EMAIL}'
+
+
+def token(aleatorio):
+    """UUID4 reproduzível pela semente"""
+    return uuid.UUID(int=aleatorio.getrandbits(128), version=4)
+
+
+def texto(aleatorio, cidade=None):
+    """(titulo, conteudo, endereco) de um relatório em português"""
+    problema, descricao = aleatorio.choice(PROBLEMAS)
+    logradouro = aleatorio.choice(LOGRADOUROS)
+    numero = aleatorio.randint(1, 2000)
+    bairro = aleatorio.choice(BAIRROS)
+    detalhes = ' '.join(aleatorio.sample(DETALHES, aleatorio.randint(0, 3)))
+    conteudo = (
+        f'Na {logradouro}, próximo ao número {numero}, {descricao} {aleatorio.choice(DESDE)}. '
+        f'{detalhes} Solicito providências o quanto antes.'
+    ).replace('  ', ' ')
+    endereco = f'{logradouro}, {numero} - {bairro}' + (f', {cidade}' if cidade else '')
+    return f'{problema} na {logradouro}', conteudo, endereco
+
+
+def relatorio(aleatorio, centro=CENTRO_PADRAO, raio_km=10):
+    """Campos do formulário de um relatório anônimo plausível"""
+    titulo, conteudo, endereco = texto(aleatorio)
+    nome, email = pessoa(aleatorio)
+    # A distribuição normal concentra os relatórios perto do centro
+    latitude, longitude = _gauss_km(aleatorio, centro, raio_km / 2)
+    return {
+        'titulo': titulo,
+        'conteudo': conteudo,
+        'nome_usuario': nome,
+        'email_usuario': email,
+        'latitude': f'{latitude:.6f}',
+        'longitude': f'{longitude:.6f}',
+        'endereco': endereco,
+    }
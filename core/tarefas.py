@@ -0,0 +1,267 @@
+"""
+Fila de tarefas em segundo plano persistida no banco, sem broker externo.
+
+As tarefas são linhas de ``Tarefa`` criadas na mesma transação da alteração
+que as originou, por isso só ficam visíveis depois do commit. Após o commit
+o worker (``manage.py processar_tarefas``) é acordado por um NOTIFY do
+PostgreSQL; com TAREFAS_SINCRONAS ativo a tarefa é executada no próprio
+processo, o que dispensa o worker em desenvolvimento.
+
+Falhas são repetidas com espera exponencial até ``max_tentativas``; o
+status e o último erro de cada tarefa ficam visíveis no admin.
+"""
+import logging
+import os
+import select
+import time
+import traceback
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import normalizacao
+from .models import ImagemRelatorio, Relatorio, Tarefa
+from .uploads import ArquivoEmDisco
+
+logger = logging.getLogger(__name__)
+
+# Canal do LISTEN/NOTIFY usado para acordar o worker
+CANAL = 'core_tarefas'
+
+_executores = {}
+
+
+def tarefa(tipo):
+    """Registra a função que executa as tarefas do tipo informado"""
+    def registrar(funcao):
+        _executores[tipo] = funcao
+        return funcao
+    return registrar
+
+
+def _notificar():
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'NOTIFY {CANAL}')
+
+
+def enfileirar(tipo, **dados):
+    """Cria a tarefa na transação atual; ela só é executada após o commit"""
+    if tipo not in _executores:
+        raise ValueError(f'Tipo de tarefa desconhecido: {tipo}')
+    nova = Tarefa.objects.create(tipo=tipo, dados=dados, max_tentativas=settings.TAREFAS_MAX_TENTATIVAS)
+    _agendar([nova.pk])
+    return nova
+
+
+def reenfileirar(queryset):
+    """Devolve as tarefas à fila com as tentativas zeradas. Retorna a quantidade"""
+    with transaction.atomic():
+        pks = list(queryset.exclude(status=Tarefa.EXECUTANDO).values_list('pk', flat=True))
+        Tarefa.objects.filter(pk__in=pks).update(
+            status=Tarefa.PENDENTE,
+            tentativas=0,
+            erro='',
+            executar_em=timezone.now(),
+        )
+        _agendar(pks)
+    return len(pks)
+
+
+def _agendar(pks):
+    if settings.TAREFAS_SINCRONAS:
+        transaction.on_commit(lambda: [executar(pk) for pk in pks])
+    else:
+        transaction.on_commit(_notificar)
+
+
+def _reservar(tarefas):
+    """Marca como em execução a primeira tarefa disponível do queryset e a retorna"""
+    agora = timezone.now()
+    with transaction.atomic():
+        registro = (
+            tarefas.select_for_update(skip_locked=True)
+            .filter(status=Tarefa.PENDENTE)
+            .order_by('executar_em', 'pk')
+            .first()
+        )
+        if registro is None:
+            return None
+        registro.status = Tarefa.EXECUTANDO
+        registro.tentativas += 1
+        registro.iniciada_em = agora
+        registro.save(update_fields=['status', 'tentativas', 'iniciada_em'])
+    return registro
+
+
+def _executar(registro):
+    try:
+        executor = _executores.get(registro.tipo)
+        if executor is None:
+            raise LookupError(f'Tipo de tarefa desconhecido: {registro.tipo}')
+        executor(**registro.dados)
+    except Exception:
+        logger.exception('Falha na tarefa %s (tentativa %s)', registro, registro.tentativas)
+        registro.erro = traceback.format_exc()
+        if registro.tentativas >= registro.max_tentativas:
+            registro.status = Tarefa.FALHOU
+        else:
+            registro.status = Tarefa.PENDENTE
+            espera = settings.TAREFAS_ESPERA_BASE * 2 ** (registro.tentativas - 1)
+            registro.executar_em = timezone.now() + timedelta(seconds=espera)
+        registro.save(update_fields=['status', 'erro', 'executar_em'])
+        return False
+
+    registro.status = Tarefa.CONCLUIDA
+    registro.erro = ''
+    registro.concluida_em = timezone.now()
+    registro.save(update_fields=['status', 'erro', 'concluida_em'])
+    return True
+
+
+def executar(pk):
+    """Executa imediatamente a tarefa indicada, se ela ainda estiver pendente"""
+    registro = _reservar(Tarefa.objects.filter(pk=pk))
+    if registro is None:
+        return False
+    return _executar(registro)
+
+
+def processar(limite=None):
+    """Executa as tarefas disponíveis até esvaziar a fila. Retorna quantas foram executadas"""
+    executadas = 0
+    while limite is None or executadas < limite:
+        registro = _reservar(Tarefa.objects.filter(executar_em__lte=timezone.now()))
+        if registro is None:
+            break
+        _executar(registro)
+        executadas += 1
+    return executadas
+
+
+def liberar_travadas():
+    """
+    Devolve à fila as tarefas em execução há mais de TAREFAS_TEMPO_LIMITE
+    segundos (worker interrompido no meio da execução).
+    """
+    agora = timezone.now()
+    travadas = Tarefa.objects.filter(
+        status=Tarefa.EXECUTANDO,
+        iniciada_em__lt=agora - timedelta(seconds=settings.TAREFAS_TEMPO_LIMITE),
+    )
+    esgotadas = travadas.filter(tentativas__gte=F('max_tentativas')).update(
+        status=Tarefa.FALHOU,
+        erro='Tempo limite de execução excedido',
+    )
+    return esgotadas + travadas.update(status=Tarefa.PENDENTE, executar_em=agora)
+
+
+def aguardar(segundos):
+    """Espera um NOTIFY de nova tarefa (PostgreSQL) ou apenas o intervalo informado"""
+    if connection.vendor != 'postgresql':
+        time.sleep(segundos)
+        return
+    connection.ensure_connection()
+    conexao = connection.connection
+    if not hasattr(conexao, 'poll'):
+        # Driver sem a API de notificações do psycopg2 (psycopg 3)
+        time.sleep(segundos)
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'LISTEN {CANAL}')
+    if select.select([conexao], [], [], segundos)[0]:
+        conexao.poll()
+        conexao.notifies.clear()
+
+
+def preparar_upload(arquivo):
+    """
+    Guarda o upload na pasta de pendentes (TAREFAS_PASTA_UPLOADS) e retorna
+    o nome usado na tarefa ``salvar_imagem``. Uploads já gravados em disco
+    (pelo ImagemUploadHandler ou pelo Django) são apenas movidos.
+    """
+    os.makedirs(settings.TAREFAS_PASTA_UPLOADS, exist_ok=True)
+    nome = uuid.uuid4().hex + os.path.splitext(arquivo.name)[1].lower()
+    destino = os.path.join(settings.TAREFAS_PASTA_UPLOADS, nome)
+    if hasattr(arquivo, 'temporary_file_path'):
+        file_move_safe(arquivo.temporary_file_path(), destino)
+    else:
+        with open(destino, 'wb') as saida:
+            for parte in arquivo.chunks():
+                saida.write(parte)
+    return nome
+
+
+def descartar_upload(nome):
+    """Remove um upload pendente"""
+    caminho = os.path.join(settings.TAREFAS_PASTA_UPLOADS, nome)
+    if os.path.isfile(caminho):
+        os.remove(caminho)
+
+
+def _localizar(relatorio_id, latitude, longitude):
+    """Usa a posição do GPS da foto no relatório enviado sem localização"""
+    with transaction.atomic():
+        relatorio = Relatorio.objects.select_for_update().filter(pk=relatorio_id).first()
+        if relatorio is None or relatorio.tem_localizacao:
+            return
+        relatorio.latitude = round(Decimal(latitude), 6)
+        relatorio.longitude = round(Decimal(longitude), 6)
+        # O save atualiza os agregados do mapa e os contadores (core/signals.py)
+        relatorio.save(update_fields=['latitude', 'longitude'])
+
+
+@tarefa('salvar_imagem')
+def salvar_imagem(relatorio_id, arquivo, nome, ordem, sha256=None):
+    """Normaliza (core/normalizacao.py) e grava no storage uma imagem guardada por preparar_upload"""
+    relatorio = Relatorio.objects.filter(pk=relatorio_id).first()
+    base, extensao = os.path.splitext(arquivo)
+    normalizada = f'{base}_normalizada{extensao}'
+    # Uma execução anterior pode ter criado a imagem e sido interrompida antes de concluir
+    if relatorio is not None and not relatorio.imagens_relatorio.filter(ordem=ordem).exists():
+        caminho = os.path.join(settings.TAREFAS_PASTA_UPLOADS, arquivo)
+        tamanho_enviado = os.path.getsize(caminho)
+        try:
+            sha256_normalizada, localizacao = normalizacao.normalizar(
+                caminho, os.path.join(settings.TAREFAS_PASTA_UPLOADS, normalizada)
+            )
+        except normalizacao.ImagemInvalida:
+            logger.warning('Imagem %s do relatório %s recusada', nome, relatorio_id, exc_info=True)
+            descartar_upload(arquivo)
+            return
+        if sha256_normalizada:
+            caminho, sha256 = os.path.join(settings.TAREFAS_PASTA_UPLOADS, normalizada), sha256_normalizada
+        tamanho = os.path.getsize(caminho)
+
+        # O storage move o arquivo pendente para o destino final em vez de copiá-lo
+        # e, com o hash já calculado, não precisa relê-lo (core/armazenamento.py)
+        with open(caminho, 'rb') as conteudo:
+            imagem = ArquivoEmDisco(conteudo, name=nome)
+            imagem.sha256 = sha256
+            ImagemRelatorio.objects.create(
+                relatorio=relatorio, imagem=imagem, ordem=ordem,
+                tamanho_enviado=tamanho_enviado, tamanho=tamanho,
+            )
+        logger.info(
+            'Imagem %s do relatório %s: %d bytes enviados, %d armazenados (%d economizados)',
+            nome, relatorio_id, tamanho_enviado, tamanho, tamanho_enviado - tamanho,
+        )
+        if localizacao and not relatorio.tem_localizacao:
+            _localizar(relatorio_id, *localizacao)
+    descartar_upload(arquivo)
+    # Conteúdo já armazenado: o storage não moveu a versão normalizada
+    descartar_upload(normalizada)
+
+
+@tarefa('gerar_derivados')
+def gerar_derivados(imagem_id):
+    """Gera a miniatura e a versão de exibição de uma imagem"""
+    imagem = ImagemRelatorio.objects.filter(pk=imagem_id).first()
+    if imagem is not None:
+        imagem.gerar_derivados()
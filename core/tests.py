@@ -1,3 +1,1276 @@
-from django.test import TestCase
+"""
+Regressão de desempenho das views do core.
 
-# Create your tests here.
+Cria uma base com algumas centenas de relatórios, acessa todas as URLs de
+core/urls.py e a listagem de relatórios do admin e verifica limites para o
+número de consultas e para o tempo de resposta (mediana de REPETICOES
+execuções, sempre com o cache vazio). Os planos de execução (EXPLAIN) das
+consultas às tabelas do core também são registrados.
+
+O resultado de cada caso é gravado em JSON no arquivo DESEMPENHO_RESULTADO
+(padrão: desempenho.json no diretório atual), junto com o commit, para
+comparar a evolução entre versões. Em máquinas lentas os limites de tempo
+podem ser ampliados com DESEMPENHO_FATOR_TEMPO (ex.: 2).
+
+Ao final ficam os testes de comportamento dos módulos com casos de borda
+que as views não exercitam (referências e remoção dos arquivos
+compartilhados, comando remover_arquivos_orfaos, agregados incrementais do
+mapa, invalidação do cache pelas alterações do autor, normalização das
+imagens enviadas, fila de tarefas, importação em massa, tokens da paginação
+por cursor, consultas por proximidade perto dos polos e do antimeridiano).
+
+    python manage.py test core
+"""
+import csv
+import io
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, connection, transaction
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import ExifTags, Image, ImageCms
+
+from . import (
+    agrupamento, armazenamento, autoria, busca, cache_respostas, contadores, geocodificacao, importacao, normalizacao,
+    proximidade, tarefas,
+)
+from .imagens import DERIVADOS, caminho_derivado
+from .models import AgregadoMapa, ConteudoImagem, ImagemRelatorio, ProgressoImportacao, Relatorio, Tarefa
+from .paginacao import PaginaCursor, PaginadorCursor, paginar
+from .urls import urlpatterns
+
+
+REPETICOES = 5
+FATOR_TEMPO = float(os.getenv('DESEMPENHO_FATOR_TEMPO', '1'))
+ARQUIVO_RESULTADO = os.getenv('DESEMPENHO_RESULTADO', 'desempenho.json')
+
+TITULOS = [
+    'Buraco na calçada', 'Poste apagado', 'Lixo acumulado na praça',
+    'Árvore caída', 'Vazamento de água', 'Semáforo quebrado',
+]
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _varreduras_sequenciais(plano):
+    """Tabelas lidas por Seq Scan em qualquer nó do plano"""
+    tabelas = []
+    if plano.get('Node Type') == 'Seq Scan':
+        tabelas.append(plano.get('Relation Name'))
+    for filho in plano.get('Plans', []):
+        tabelas.extend(_varreduras_sequenciais(filho))
+    return tabelas
+
+
+def _planos(consultas):
+    """EXPLAIN de cada SELECT distinto às tabelas do core"""
+    planos = []
+    vistas = set()
+    with connection.cursor() as cursor:
+        for consulta in consultas:
+            sql = consulta['sql']
+            if sql in vistas or not sql.startswith('SELECT') or '"core_' not in sql:
+                continue
+            vistas.add(sql)
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+            plano = cursor.fetchone()[0][0]['Plan']
+            planos.append({
+                'sql': sql,
+                'tempo_ms': round(float(consulta['time']) * 1000, 2),
+                'custo_total': plano['Total Cost'],
+                'linhas_estimadas': plano['Plan Rows'],
+                'varreduras_sequenciais': _varreduras_sequenciais(plano),
+                'plano': plano,
+            })
+    return planos
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    GEOCODIFICACAO_PROVEDOR='core.geocodificacao.ProvedorFixture',
+    GEOCODIFICACAO_FIXTURE=None,
+    TAREFAS_SINCRONAS=True,
+)
+class DesempenhoViewsTest(TestCase):
+    """Limites de consultas e de tempo para cada URL do core e para o admin"""
+
+    resultados = []
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@exemplo.com', 'senha')
+        cls.usuarios = User.objects.bulk_create([
+            User(username=f'usuario{i:02d}', email=f'usuario{i:02d}@exemplo.com') for i in range(20)
+        ])
+        cls.autor = cls.usuarios[0]
+        cls.token = uuid.uuid4()
+
+        agora = timezone.now()
+        relatorios = []
+        for i in range(600):
+            relatorio = Relatorio(
+                titulo=f'{TITULOS[i % len(TITULOS)]} {i}',
+                conteudo=f'{TITULOS[(i + 1) % len(TITULOS)]} perto da rua {i % 50}. ' * 5,
+                data_criacao=agora - timedelta(hours=i * 7),
+                endereco=f'Rua {i % 50}, São Paulo' if i % 5 else '',
+            )
+            if i % 3:
+                relatorio.usuario = cls.usuarios[i % len(cls.usuarios)]
+            else:
+                relatorio.nome_usuario = f'Visitante {i % 15}'
+                relatorio.email_usuario = f'visitante{i % 15}@exemplo.com'
+                relatorio.token_anonimo = cls.token if i % 15 == 0 else uuid.uuid4()
+            if i % 5:
+                relatorio.latitude = Decimal('-23.55') + Decimal(i % 97) / 1000
+                relatorio.longitude = Decimal('-46.63') + Decimal(i % 89) / 1000
+            relatorios.append(relatorio)
+        Relatorio.objects.bulk_create(relatorios)
+
+        imagens = []
+        for relatorio in relatorios[::4]:
+            for ordem in range(relatorio.pk % 3 + 1):
+                sha256 = f'{relatorio.pk:032x}{ordem:032x}'
+                nome = armazenamento.caminho_conteudo(sha256, '.jpg')
+                imagens.append(ImagemRelatorio(
+                    relatorio=relatorio, imagem=nome, ordem=ordem,
+                    miniatura=caminho_derivado(nome, 'miniatura', 'JPEG'),
+                    imagem_media=caminho_derivado(nome, 'media', 'JPEG'),
+                ))
+        ImagemRelatorio.objects.bulk_create(imagens)
+
+        # O bulk_create não dispara os sinais que mantêm os dados desnormalizados
+        contadores.reconciliar()
+        agrupamento.recalcular()
+        armazenamento.reconciliar()
+
+        cls.do_autor = Relatorio.objects.filter(usuario=cls.autor, num_imagens__gt=0).first()
+        cls.anonimo = Relatorio.objects.filter(token_anonimo=cls.token).first()
+
+    @classmethod
+    def tearDownClass(cls):
+        with open(ARQUIVO_RESULTADO, 'w', encoding='utf-8') as arquivo:
+            json.dump({
+                'commit': _commit(),
+                'data': timezone.now().isoformat(),
+                'repeticoes': REPETICOES,
+                'casos': cls.resultados,
+            }, arquivo, ensure_ascii=False, indent=2, default=str)
+        super().tearDownClass()
+
+    def setUp(self):
+        # O provedor é criado uma vez por processo com as configurações da época
+        geocodificacao._provedor = None
+
+    def _cliente(self, quem):
+        self.client.logout()
+        self.client.cookies.pop('autor_anonimo', None)
+        if quem == 'admin':
+            self.client.force_login(self.admin)
+        elif quem == 'autor':
+            self.client.force_login(self.autor)
+        elif quem == 'anonimo_com_token':
+            resposta = HttpResponse()
+            resposta.set_signed_cookie('autor_anonimo', str(self.token), salt=autoria.SALT)
+            self.client.cookies['autor_anonimo'] = resposta.cookies['autor_anonimo'].value
+        return self.client
+
+    def _medir(self, nome, url, quem='anonimo', max_consultas=10, max_ms=300, metodo='get', dados=None,
+               status=(200,), cabecalhos=None):
+        cliente = self._cliente(quem)
+        tempos = []
+        for _ in range(REPETICOES):
+            cache.clear()
+            with CaptureQueriesContext(connection) as consultas:
+                inicio = time.perf_counter()
+                resposta = getattr(cliente, metodo)(url, dados or {}, headers=cabecalhos)
+                if resposta.streaming:
+                    b''.join(resposta.streaming_content)
+                tempos.append((time.perf_counter() - inicio) * 1000)
+            self.assertIn(resposta.status_code, status, f'{nome}: status {resposta.status_code}')
+
+        mediana = statistics.median(tempos)
+        self.resultados.append({
+            'caso': nome,
+            'url': url,
+            'metodo': metodo.upper(),
+            'usuario': quem,
+            'status': resposta.status_code,
+            'consultas': len(consultas),
+            'max_consultas': max_consultas,
+            'tempo_mediano_ms': round(mediana, 2),
+            'tempo_maximo_ms': round(max(tempos), 2),
+            'max_ms': max_ms * FATOR_TEMPO,
+            'planos': _planos(consultas.captured_queries),
+        })
+        self.assertLessEqual(
+            len(consultas), max_consultas,
+            f'{nome}: {len(consultas)} consultas\n' + '\n'.join(c['sql'] for c in consultas.captured_queries)
+        )
+        self.assertLessEqual(mediana, max_ms * FATOR_TEMPO, f'{nome}: {mediana:.0f} ms')
+        return resposta
+
+    def test_todas_as_urls_tem_caso(self):
+        """Novas URLs em core/urls.py precisam de um caso de desempenho aqui"""
+        testadas = {
+            'home', 'sobre', 'contato', 'register', 'criar_relatorio', 'meus_relatorios',
+            'detalhes_relatorio_publico', 'geocodificacao_reversa', 'admin_relatorios',
+            'admin_relatorios_mapa', 'admin_autores', 'exportar_relatorios', 'detalhes_relatorio',
+            'metricas_prometheus', 'servir_midia', 'admin_relatorios_proximos',
+        }
+        self.assertEqual({padrao.name for padrao in urlpatterns} - testadas, set())
+
+    def test_paginas_estaticas(self):
+        for nome in ('home', 'sobre', 'contato'):
+            self._medir(f'{nome} (anônimo)', reverse(f'core:{nome}'), max_consultas=0)
+        for nome in ('home', 'sobre', 'contato'):
+            self._medir(f'{nome} (autenticado)', reverse(f'core:{nome}'), quem='autor', max_consultas=2)
+
+    def test_registro(self):
+        self._medir('register', reverse('core:register'), max_consultas=0)
+
+    def test_criar_relatorio(self):
+        url = reverse('core:criar_relatorio')
+        self._medir('criar_relatorio (formulário)', url, max_consultas=0)
+        self._medir('criar_relatorio (envio anônimo)', url, metodo='post', status=(302,), max_consultas=12, dados={
+            'titulo': 'Buraco novo', 'conteudo': 'Buraco perto da escola',
+            'nome_usuario': 'Visitante', 'email_usuario': 'visitante@exemplo.com',
+            'latitude': '-23.5505', 'longitude': '-46.6333',
+        })
+        self._medir('criar_relatorio (envio autenticado)', url, quem='autor', metodo='post', status=(302,),
+                    max_consultas=14, dados={'titulo': 'Poste apagado', 'conteudo': 'Na esquina'})
+
+    def test_criar_relatorio_upload_interrompido(self):
+        """Imagem ou envio grande demais: a leitura para e nada é gravado"""
+        url = reverse('core:criar_relatorio')
+        cliente = self._cliente('autor')
+        dados = {'titulo': 'Foto enorme', 'conteudo': 'Na esquina'}
+        antes = Relatorio.objects.count()
+        with override_settings(MAX_UPLOAD_SIZE=1000, UPLOAD_MAX_REQUISICAO=100000):
+            imagem = SimpleUploadedFile('foto.jpg', b'\xff\xd8\xff' + os.urandom(5000), 'image/jpeg')
+            resposta = cliente.post(url, dict(dados, imagens=imagem))
+            self.assertEqual(resposta.status_code, 200)
+            self.assertContains(resposta, 'muito grande')
+
+            imagem = SimpleUploadedFile('foto.jpg', b'\xff\xd8\xff' + os.urandom(200000), 'image/jpeg')
+            resposta = cliente.post(url, dict(dados, imagens=imagem))
+            self.assertEqual(resposta.status_code, 200)
+            self.assertContains(resposta, 'passa do limite')
+        self.assertEqual(Relatorio.objects.count(), antes)
+
+        # A verificação do CSRF continua valendo com o handler trocado na view
+        protegido = Client(enforce_csrf_checks=True)
+        protegido.force_login(self.autor)
+        self.assertEqual(protegido.post(url, dados).status_code, 403)
+
+    def test_meus_relatorios(self):
+        url = reverse('core:meus_relatorios')
+        self._medir('meus_relatorios (anônimo com token)', url, quem='anonimo_com_token', max_consultas=3)
+        self._medir('meus_relatorios (autenticado)', url, quem='autor', max_consultas=5)
+
+    def test_detalhes_relatorio_publico(self):
+        self._medir(
+            'detalhes_relatorio_publico (autor)',
+            reverse('core:detalhes_relatorio_publico', args=[self.do_autor.pk]), quem='autor', max_consultas=5,
+        )
+        self._medir(
+            'detalhes_relatorio_publico (anônimo com token)',
+            reverse('core:detalhes_relatorio_publico', args=[self.anonimo.pk]), quem='anonimo_com_token',
+            max_consultas=3,
+        )
+
+    def test_geocodificacao_reversa(self):
+        self._medir(
+            'geocodificacao_reversa', reverse('core:geocodificacao_reversa') + '?lat=-23.5505&lng=-46.6333',
+            max_consultas=3,
+        )
+        with override_settings(GEOCODIFICACAO_LIMITE_POR_CLIENTE=0):
+            self._medir(
+                'geocodificacao_reversa (limite do cliente)',
+                reverse('core:geocodificacao_reversa') + '?lat=-22.9068&lng=-43.1729', max_consultas=1, status=(429,),
+            )
+
+    def test_metricas(self):
+        self._medir('metricas_prometheus', reverse('core:metricas_prometheus'), quem='admin', max_consultas=2)
+
+    def test_servir_midia(self):
+        imagem = self.do_autor.imagens_relatorio.first()
+        do_token = ImagemRelatorio.objects.filter(relatorio__token_anonimo=self.token).first()
+        with tempfile.TemporaryDirectory() as pasta, override_settings(MEDIA_ROOT=pasta):
+            for nome in (imagem.imagem.name, imagem.miniatura.name, do_token.imagem.name):
+                os.makedirs(os.path.dirname(os.path.join(pasta, nome)), exist_ok=True)
+                with open(os.path.join(pasta, nome), 'wb') as arquivo:
+                    arquivo.write(b'\xff\xd8\xff' + os.urandom(200000))
+
+            resposta = self._medir('servir_midia (autor)', imagem.imagem.url, quem='autor', max_consultas=3)
+            self.assertIn('immutable', resposta['Cache-Control'])
+            self._medir('servir_midia (miniatura)', imagem.miniatura.url, quem='autor', max_consultas=3)
+            self._medir('servir_midia (anônimo com token)', do_token.imagem.url, quem='anonimo_com_token',
+                        max_consultas=1)
+            self._medir('servir_midia (If-None-Match)', imagem.imagem.url, quem='autor', max_consultas=3,
+                        status=(304,), cabecalhos={'If-None-Match': resposta['ETag']})
+            self._medir('servir_midia (Range)', imagem.imagem.url, quem='autor', max_consultas=3,
+                        status=(206,), cabecalhos={'Range': 'bytes=0-1023'})
+            self._medir('servir_midia (sem permissão)', imagem.imagem.url, max_consultas=0, status=(404,))
+            with override_settings(MIDIA_ENVIO='x-accel-redirect'):
+                resposta = self._medir('servir_midia (X-Accel-Redirect)', imagem.imagem.url, quem='admin',
+                                       max_consultas=3)
+                self.assertEqual(resposta.content, b'')
+
+    def test_painel_administrativo(self):
+        url = reverse('core:admin_relatorios')
+        self._medir('admin_relatorios', url, quem='admin', max_consultas=6)
+        self._medir('admin_relatorios (busca)', url + '?search=buraco', quem='admin', max_consultas=6)
+        self._medir('admin_relatorios (autor)', url + '?usuario=usuario01', quem='admin', max_consultas=6)
+        self._medir('admin_relatorios (página 10)', url + '?page=10', quem='admin', max_consultas=6)
+        self._medir(
+            'detalhes_relatorio', reverse('core:detalhes_relatorio', args=[self.do_autor.pk]),
+            quem='admin', max_consultas=5,
+        )
+
+    def test_mapa_do_painel(self):
+        url = reverse('core:admin_relatorios_mapa')
+        self._medir('admin_relatorios_mapa (extensão)', url, quem='admin', max_consultas=4)
+        # Primeira carga do mapa: viewport inicial (zoom 4) e a extensão, já agrupados
+        resposta = self._medir('admin_relatorios_mapa (primeira carga)',
+                               url + '?bbox=-80,-40,-20,10&zoom=4&extensao=1', quem='admin', max_consultas=5)
+        colecao = resposta.json()
+        self.assertEqual(len(colecao['bbox']), 4)
+        self.assertTrue(colecao['features'])
+        self.assertTrue(all('quantidade' in feature['properties'] for feature in colecao['features']))
+        self._medir('admin_relatorios_mapa (agrupado)', url + '?bbox=-47,-24,-46,-23&zoom=8', quem='admin',
+                    max_consultas=4)
+        self._medir('admin_relatorios_mapa (marcadores)', url + '?bbox=-47,-24,-46,-23&zoom=18', quem='admin',
+                    max_consultas=4)
+        self._medir('admin_relatorios_mapa (busca)', url + '?bbox=-47,-24,-46,-23&zoom=8&search=poste',
+                    quem='admin', max_consultas=5)
+
+    def test_proximidade(self):
+        url = reverse('core:admin_relatorios_proximos')
+        resposta = self._medir('admin_relatorios_proximos (raio)', url + '?lat=-23.52&lng=-46.6&raio=300',
+                               quem='admin', max_consultas=3)
+        distancias = [feature['properties']['distancia'] for feature in resposta.json()['features']]
+        self.assertTrue(distancias)
+        self.assertEqual(distancias, sorted(distancias))
+        self.assertLessEqual(distancias[-1], 300)
+        resposta = self._medir('admin_relatorios_proximos (k)', url + '?lat=-23.52&lng=-46.6&k=20',
+                               quem='admin', max_consultas=6)
+        self.assertEqual(len(resposta.json()['features']), 20)
+        self._medir('admin_relatorios_proximos (longe)', url + '?lat=-3.1&lng=-60&k=5', quem='admin',
+                    max_consultas=10)
+        self._medir('admin_relatorios_proximos (inválido)', url + '?lat=-23.52&lng=-46.6&raio=-1',
+                    quem='admin', max_consultas=2, status=(400,))
+
+    def test_autores_e_exportacao(self):
+        self._medir('admin_autores', reverse('core:admin_autores') + '?q=usu', quem='admin', max_consultas=3)
+        url = reverse('core:exportar_relatorios')
+        self._medir('exportar_relatorios (csv)', url, quem='admin', max_consultas=4, max_ms=1000)
+        self._medir('exportar_relatorios (geojson gzip)', url + '?formato=geojson&gzip=1', quem='admin',
+                    max_consultas=4, max_ms=1000)
+
+    def test_admin_do_django(self):
+        url = reverse('admin:core_relatorio_changelist')
+        self._medir('admin changelist de relatórios', url, quem='admin', max_consultas=8, max_ms=500)
+        resposta = self._medir('admin changelist (busca)', url + '?q=poste', quem='admin', max_consultas=8,
+                               max_ms=500)
+        # Os mais relevantes primeiro, não os mais recentes
+        obtidos = [relatorio.pk for relatorio in resposta.context['cl'].result_list]
+        esperados = busca.buscar(Relatorio.objects.all(), 'poste').order_by(*busca.ORDEM_RELEVANCIA, '-pk')
+        self.assertEqual(obtidos, list(esperados.values_list('pk', flat=True)[:len(obtidos)]))
+        self.assertNotEqual(obtidos, sorted(obtidos, key=lambda pk: -pk))
+        # Ordem escolhida pela coluna de data (a terceira de list_display), crescente
+        resposta = self.client.get(url, {'q': 'poste', 'o': '3'})
+        obtidos = [relatorio.pk for relatorio in resposta.context['cl'].result_list]
+        esperados = busca.buscar(Relatorio.objects.all(), 'poste').order_by('data_criacao', '-pk')
+        self.assertEqual(obtidos, list(esperados.values_list('pk', flat=True)[:len(obtidos)]))
+        self.assertEqual(self.client.get(url, {'q': '@@'}).status_code, 200)
+        # Trecho do e-mail de visitante, que não é um termo do vetor de busca
+        resposta = self._medir('admin changelist (busca por e-mail)', url + '?q=e3@exemplo.com', quem='admin',
+                               max_consultas=8, max_ms=500)
+        emails = {relatorio.email_usuario for relatorio in resposta.context['cl'].result_list}
+        self.assertEqual(emails, {'visitante3@exemplo.com'})
+        self._medir(
+            'admin edição de relatório', reverse('admin:core_relatorio_change', args=[self.do_autor.pk]),
+            quem='admin', max_consultas=12, max_ms=500,
+        )
+
+
+@override_settings(TAREFAS_SINCRONAS=False)
+class ArmazenamentoTest(TestCase):
+    """Deduplicação, contagem de referências e remoção dos arquivos compartilhados"""
+
+    def setUp(self):
+        pasta = tempfile.TemporaryDirectory()
+        self.addCleanup(pasta.cleanup)
+        configuracao = override_settings(MEDIA_ROOT=pasta.name)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+        self.relatorios = Relatorio.objects.bulk_create([
+            Relatorio(titulo=f'Relatório {i}', conteudo='Com fotos') for i in range(3)
+        ])
+
+    def _imagem(self, relatorio, conteudo, ordem=0):
+        return ImagemRelatorio.objects.create(
+            relatorio=relatorio, imagem=ContentFile(conteudo, name='foto.jpg'), ordem=ordem
+        )
+
+    def _arquivos(self, nome):
+        """O arquivo e os derivados gerados ao lado dele"""
+        return [nome] + [caminho_derivado(nome, sufixo, formato) for sufixo, _, formato in DERIVADOS.values()]
+
+    def _criar_derivados(self, nome):
+        for derivado in self._arquivos(nome)[1:]:
+            caminho = armazenamento.armazenamento.path(derivado)
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            with open(caminho, 'wb') as arquivo:
+                arquivo.write(b'derivado')
+
+    def _existe(self, nome):
+        return armazenamento.armazenamento.exists(nome)
+
+    def _referencias(self, nome):
+        return ConteudoImagem.objects.filter(arquivo=nome).values_list('referencias', flat=True).first()
+
+    def test_mesmo_conteudo_grava_um_arquivo(self):
+        primeira = self._imagem(self.relatorios[0], b'foto repetida')
+        segunda = self._imagem(self.relatorios[1], b'foto repetida')
+        outra = self._imagem(self.relatorios[1], b'outra foto', ordem=1)
+        self.assertEqual(primeira.imagem.name, segunda.imagem.name)
+        self.assertNotEqual(primeira.imagem.name, outra.imagem.name)
+        self.assertTrue(primeira.imagem.name.startswith(armazenamento.PREFIXO + '/'))
+        self.assertEqual(
+            len(os.listdir(os.path.dirname(armazenamento.armazenamento.path(primeira.imagem.name)))), 1
+        )
+        self.assertEqual(self._referencias(primeira.imagem.name), 2)
+        self.assertEqual(self._referencias(outra.imagem.name), 1)
+
+    def test_remove_o_arquivo_apos_a_ultima_referencia(self):
+        primeira = self._imagem(self.relatorios[0], b'foto repetida')
+        segunda = self._imagem(self.relatorios[1], b'foto repetida')
+        nome = primeira.imagem.name
+        self._criar_derivados(nome)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            primeira.delete()
+        self.assertEqual(self._referencias(nome), 1)
+        self.assertTrue(all(self._existe(arquivo) for arquivo in self._arquivos(nome)))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            segunda.delete()
+        self.assertIsNone(self._referencias(nome))
+        self.assertFalse(any(self._existe(arquivo) for arquivo in self._arquivos(nome)))
+
+    def test_troca_do_arquivo_libera_o_anterior(self):
+        imagem = self._imagem(self.relatorios[0], b'foto antiga')
+        antiga = imagem.imagem.name
+        imagem = ImagemRelatorio.objects.get(pk=imagem.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            imagem.imagem = ContentFile(b'foto nova', name='foto.jpg')
+            imagem.save()
+        self.assertFalse(self._existe(antiga))
+        self.assertIsNone(self._referencias(antiga))
+        self.assertEqual(self._referencias(imagem.imagem.name), 1)
+
+    def test_liberacoes_em_lote(self):
+        compartilhada = self._imagem(self.relatorios[0], b'foto repetida').imagem.name
+        self._imagem(self.relatorios[0], b'foto repetida', ordem=1)
+        self._imagem(self.relatorios[1], b'foto repetida')
+        exclusiva = self._imagem(self.relatorios[0], b'foto exclusiva', ordem=2).imagem.name
+        self._criar_derivados(exclusiva)
+        self.assertEqual(self._referencias(compartilhada), 3)
+
+        # A exclusão em cascata acumula as liberações e as aplica juntas no fim do bloco
+        with self.captureOnCommitCallbacks(execute=True):
+            with CaptureQueriesContext(connection) as consultas:
+                Relatorio.objects.filter(pk=self.relatorios[0].pk).delete()
+        # Um UPDATE por quantidade liberada (2 da compartilhada e 1 da exclusiva), não um por imagem
+        atualizacoes = [
+            consulta for consulta in consultas.captured_queries
+            if consulta['sql'].startswith('UPDATE "core_conteudoimagem"')
+        ]
+        self.assertEqual(len(atualizacoes), 2)
+        self.assertEqual(self._referencias(compartilhada), 1)
+        self.assertTrue(self._existe(compartilhada))
+        self.assertIsNone(self._referencias(exclusiva))
+        self.assertFalse(any(self._existe(arquivo) for arquivo in self._arquivos(exclusiva)))
+
+        # Bloco aninhado: nada é aplicado antes do fim do bloco externo
+        with self.captureOnCommitCallbacks(execute=True):
+            with armazenamento.liberacoes_em_lote():
+                with armazenamento.liberacoes_em_lote():
+                    Relatorio.objects.filter(pk=self.relatorios[1].pk).delete()
+                self.assertEqual(self._referencias(compartilhada), 1)
+        self.assertIsNone(self._referencias(compartilhada))
+        self.assertFalse(self._existe(compartilhada))
+
+    def test_reenvio_antes_da_remocao_mantem_o_arquivo(self):
+        """A última referência é liberada e o mesmo conteúdo é reenviado antes da remoção após o commit"""
+        imagem = self._imagem(self.relatorios[0], b'foto repetida')
+        nome = imagem.imagem.name
+        with self.captureOnCommitCallbacks() as remocao:
+            imagem.delete()
+        self.assertEqual(self._referencias(nome), 0)
+        self._imagem(self.relatorios[1], b'foto repetida')
+        for callback in remocao:
+            callback()
+        self.assertTrue(self._existe(nome))
+        self.assertEqual(self._referencias(nome), 1)
+
+    def test_reenvio_depois_da_remocao_grava_de_novo(self):
+        imagem = self._imagem(self.relatorios[0], b'foto repetida')
+        nome = imagem.imagem.name
+        with self.captureOnCommitCallbacks(execute=True):
+            imagem.delete()
+        self.assertFalse(self._existe(nome))
+        self.assertEqual(self._imagem(self.relatorios[1], b'foto repetida').imagem.name, nome)
+        self.assertTrue(self._existe(nome))
+        self.assertEqual(self._referencias(nome), 1)
+
+
+@override_settings(TAREFAS_SINCRONAS=False)
+class ArmazenamentoConcorrenciaTest(TransactionTestCase):
+    """Remoção após o commit concorrente com um reenvio do mesmo conteúdo ainda não confirmado"""
+
+    def setUp(self):
+        pasta = tempfile.TemporaryDirectory()
+        self.addCleanup(pasta.cleanup)
+        configuracao = override_settings(MEDIA_ROOT=pasta.name)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+
+    def test_remocao_espera_o_reenvio(self):
+        relatorio = Relatorio.objects.create(titulo='Relatório', conteudo='Com fotos')
+        # Arquivo gravado e sem referências: a última imagem acabou de ser excluída
+        nome = armazenamento.armazenamento.save('foto.jpg', ContentFile(b'foto repetida'))
+        self.assertEqual(ConteudoImagem.objects.get(arquivo=nome).referencias, 0)
+
+        def remover():
+            try:
+                armazenamento.remover_sem_referencias([nome])
+            finally:
+                connection.close()
+
+        remocao = threading.Thread(target=remover)
+        with transaction.atomic():
+            ImagemRelatorio.objects.create(relatorio=relatorio, imagem=ContentFile(b'foto repetida', name='foto.jpg'))
+            remocao.start()
+            remocao.join(0.5)
+            # Bloqueada pela linha travada por ArmazenamentoPorConteudo.save
+            self.assertTrue(remocao.is_alive())
+        remocao.join(10)
+        self.assertFalse(remocao.is_alive())
+        self.assertTrue(armazenamento.armazenamento.exists(nome))
+        self.assertEqual(ConteudoImagem.objects.get(arquivo=nome).referencias, 1)
+
+
+class RemoverArquivosOrfaosTest(TestCase):
+    """Arquivos sem referência removidos pelo comando, com a carência e a nova conferência no banco"""
+
+    def setUp(self):
+        pasta = tempfile.TemporaryDirectory()
+        self.addCleanup(pasta.cleanup)
+        self.raiz = pasta.name
+        configuracao = override_settings(MEDIA_ROOT=self.raiz)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+        self.relatorio = Relatorio.objects.create(titulo='Relatório', conteudo='Com fotos')
+
+    def _gravar(self, *nomes):
+        for nome in nomes:
+            caminho = os.path.join(self.raiz, nome)
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            with open(caminho, 'wb') as arquivo:
+                arquivo.write(b'imagem')
+
+    def _referenciar(self, *nomes, derivados=False):
+        ImagemRelatorio.objects.bulk_create([
+            ImagemRelatorio(
+                relatorio=self.relatorio, imagem=nome, ordem=ordem,
+                **({campo: caminho_derivado(nome, sufixo, formato)
+                    for campo, (sufixo, _, formato) in DERIVADOS.items()} if derivados else {}),
+            )
+            for ordem, nome in enumerate(nomes)
+        ])
+
+    def _restantes(self):
+        return sorted(
+            os.path.relpath(os.path.join(pasta, nome), self.raiz).replace(os.sep, '/')
+            for pasta, _, nomes in os.walk(self.raiz) for nome in nomes
+        )
+
+    def _executar(self, **opcoes):
+        saida = io.StringIO()
+        call_command('remover_arquivos_orfaos', remover=True, stdout=saida, **opcoes)
+        return saida.getvalue()
+
+    def test_mantem_os_arquivos_dentro_da_carencia(self):
+        self._gravar('conteudo/aa/bb/recente.jpg', 'relatorios/1/recente.jpg')
+        saida = self._executar(carencia=1)
+        self.assertIn('2 sem referência dentro da carência', saida)
+        self.assertEqual(self._restantes(), ['conteudo/aa/bb/recente.jpg', 'relatorios/1/recente.jpg'])
+
+    def test_remove_os_derivados_junto_com_a_original(self):
+        orfa = armazenamento.caminho_conteudo('a' * 64, '.jpg')
+        usada = armazenamento.caminho_conteudo('b' * 64, '.jpg')
+        derivados = [caminho_derivado(nome, sufixo, formato)
+                     for nome in (orfa, usada) for sufixo, _, formato in DERIVADOS.values()]
+        self._gravar(orfa, usada, *derivados)
+        self._referenciar(usada, derivados=True)
+        self._executar(carencia=0)
+        self.assertEqual(self._restantes(), sorted([usada] + derivados[len(DERIVADOS):]))
+
+    def test_juncao_com_nomes_intercalados(self):
+        # Pastas e arquivos com nomes que a ordem das entradas de uma pasta não seguiria
+        # ('1-a.jpg' < '1/' < '10/'), nas duas pastas do MEDIA_ROOT e em lotes pequenos
+        usados = [
+            'conteudo/00/00/a.jpg', 'conteudo/00/00/c.jpg', 'conteudo/00/0a/b.jpg', 'conteudo/0a/00/a.jpg',
+            'relatorios/1-a.jpg', 'relatorios/1/b.jpg', 'relatorios/10/a.jpg', 'relatorios/1a/a.jpg',
+        ]
+        orfaos = [
+            'conteudo/00/00/b.jpg', 'conteudo/00/00/d.jpg', 'conteudo/00/0-/a.jpg', 'conteudo/00/0a/a.jpg',
+            'conteudo/0b/00/a.jpg', 'relatorios/1-b.jpg', 'relatorios/1/a.jpg', 'relatorios/1/c.jpg',
+            'relatorios/10-a.jpg', 'relatorios/2/a.jpg',
+        ]
+        self._gravar(*usados, *orfaos)
+        self._referenciar(*usados)
+        saida = self._executar(carencia=0, lote=2)
+        self.assertIn(f'{len(usados) + len(orfaos)} arquivo(s) verificados, {len(orfaos)} órfão(s)', saida)
+        self.assertEqual(self._restantes(), sorted(usados))
+        # Pasta do formato antigo que ficou vazia
+        self.assertFalse(os.path.exists(os.path.join(self.raiz, 'relatorios', '2')))
+
+    def test_mantem_o_arquivo_referenciado_desde_a_varredura(self):
+        nomes = ['conteudo/00/00/a.jpg', 'conteudo/00/00/b.jpg', 'relatorios/1/a.jpg']
+        self._gravar(*nomes)
+        self._referenciar(*nomes[1:])
+        # Lista do banco lida antes das novas referências: todos parecem órfãos na varredura
+        with mock.patch(
+            'core.management.commands.remover_arquivos_orfaos._referenciados', return_value=iter([])
+        ):
+            saida = self._executar(carencia=0)
+        self.assertIn('3 órfão(s)', saida)
+        self.assertIn('1 removido(s)', saida)
+        self.assertEqual(self._restantes(), nomes[1:])
+
+    def test_sem_remover_apenas_lista(self):
+        self._gravar('conteudo/00/00/a.jpg')
+        saida = io.StringIO()
+        call_command('remover_arquivos_orfaos', carencia=0, stdout=saida)
+        self.assertIn('conteudo/00/00/a.jpg', saida.getvalue())
+        self.assertEqual(self._restantes(), ['conteudo/00/00/a.jpg'])
+
+
+class AgrupamentoTest(TestCase):
+    """Agregados do mapa mantidos pelos sinais comparados com os recalculados do zero"""
+
+    def _agregados(self):
+        return {
+            (zoom, x, y): (quantidade, round(soma_latitude, 6), round(soma_longitude, 6))
+            for zoom, x, y, quantidade, soma_latitude, soma_longitude in AgregadoMapa.objects.values_list(
+                'zoom', 'celula_x', 'celula_y', 'quantidade', 'soma_latitude', 'soma_longitude'
+            )
+        }
+
+    def _ponto(self, aleatorio):
+        # Poucas regiões pequenas: várias células compartilhadas em todos os zooms
+        latitude, longitude = aleatorio.choice([(-23.55, -46.63), (-22.9, -43.2), (40.7, -74.0)])
+        return (
+            Decimal(f'{latitude + aleatorio.uniform(-0.05, 0.05):.6f}'),
+            Decimal(f'{longitude + aleatorio.uniform(-0.05, 0.05):.6f}'),
+        )
+
+    def test_incremental_igual_ao_recalculado(self):
+        aleatorio = random.Random(3)
+        with self.captureOnCommitCallbacks(execute=True):
+            relatorios = []
+            for i in range(60):
+                latitude, longitude = self._ponto(aleatorio) if i % 6 else (None, None)
+                relatorios.append(Relatorio.objects.create(
+                    titulo=f'Relatório {i}', conteudo='No mapa', latitude=latitude, longitude=longitude
+                ))
+        with self.captureOnCommitCallbacks(execute=True):
+            # Mudanças de posição, inclusive para e de "sem localização"
+            for relatorio in relatorios[::3]:
+                relatorio.latitude, relatorio.longitude = (
+                    self._ponto(aleatorio) if relatorio.pk % 4 else (None, None)
+                )
+                relatorio.save()
+            for relatorio in relatorios[1:20:4]:
+                relatorio.delete()
+            Relatorio.objects.filter(pk__in=[relatorio.pk for relatorio in relatorios[40:50]]).delete()
+
+        incrementais = self._agregados()
+        self.assertTrue(incrementais)
+        self.assertTrue(all(quantidade > 0 for quantidade, _, _ in incrementais.values()))
+        agrupamento.recalcular()
+        self.assertEqual(incrementais, self._agregados())
+
+    def test_repete_a_transacao_desfeita_por_deadlock(self):
+        class Deadlock(Exception):
+            pgcode = '40P01'
+
+        erro = OperationalError('deadlock detected')
+        erro.__cause__ = Deadlock()
+        filtrar = AgregadoMapa.objects.filter
+        with mock.patch.object(AgregadoMapa.objects, 'filter', side_effect=[erro] + [mock.DEFAULT] * 10,
+                               wraps=filtrar):
+            agrupamento.registrar(-23.55, -46.63, 1)
+        self.assertEqual(
+            AgregadoMapa.objects.filter(quantidade=1).count(), settings.MAPA_ZOOM_MAXIMO_AGRUPAMENTO + 1
+        )
+
+        # Outros erros operacionais não são repetidos
+        with mock.patch.object(AgregadoMapa.objects, 'filter', side_effect=OperationalError('sem conexão')):
+            with self.assertRaises(OperationalError):
+                agrupamento.registrar(-23.55, -46.63, 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CacheDoUsuarioTest(TestCase):
+    """As páginas de detalhes em cache só são descartadas quando os dados exibidos do autor mudam"""
+
+    def setUp(self):
+        cache.clear()
+        self.usuario = User.objects.create_user('autora', 'autora@exemplo.com', 'senha')
+        self.relatorio = Relatorio.objects.create(titulo='Buraco', conteudo='Na rua', usuario=self.usuario)
+
+    def _chave(self):
+        return cache_respostas.chave_relatorio(self.relatorio)
+
+    def test_login_nao_descarta_o_cache(self):
+        chave = self._chave()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(self.client.login(username='autora', password='senha'))
+        self.assertEqual(self._chave(), chave)
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.get(pk=self.usuario.pk).save()
+        self.assertEqual(self._chave(), chave)
+
+    def test_alteracao_exibida_descarta_o_cache(self):
+        chave = self._chave()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.usuario.first_name = 'Ana'
+            self.usuario.save()
+        self.assertNotEqual(self._chave(), chave)
+        chave = self._chave()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.usuario.email = 'ana@exemplo.com'
+            self.usuario.save(update_fields=['email', 'last_login'])
+        self.assertNotEqual(self._chave(), chave)
+        # A troca do username também reindexa os relatórios da autora
+        with self.captureOnCommitCallbacks(execute=True):
+            self.usuario.username = 'anasilva'
+            self.usuario.save()
+        self.assertEqual(list(busca.buscar(Relatorio.objects.all(), 'anasilva')), [self.relatorio])
+
+
+class NormalizacaoTest(SimpleTestCase):
+    """Orientação, metadados, perfil de cor e limite de pixels das imagens enviadas"""
+
+    def setUp(self):
+        pasta = tempfile.TemporaryDirectory()
+        self.addCleanup(pasta.cleanup)
+        self.pasta = pasta.name
+
+    def _gravar(self, imagem, formato, **opcoes):
+        caminho = os.path.join(self.pasta, f'origem.{formato.lower()}')
+        imagem.save(caminho, formato, **opcoes)
+        return caminho
+
+    def _normalizar(self, caminho):
+        destino = os.path.join(self.pasta, 'normalizada')
+        sha256, localizacao = normalizacao.normalizar(caminho, destino)
+        return (Image.open(destino) if sha256 else None), localizacao
+
+    def test_aplica_a_orientacao_e_devolve_o_gps(self):
+        exif = Image.Exif()
+        exif[ExifTags.Base.Orientation] = 6  # girada 90° no sentido horário
+        exif[ExifTags.Base.Make] = 'Câmera'
+        exif[ExifTags.IFD.GPSInfo] = {
+            ExifTags.GPS.GPSLatitudeRef: 'S', ExifTags.GPS.GPSLatitude: (23.0, 33.0, 18.0),
+            ExifTags.GPS.GPSLongitudeRef: 'W', ExifTags.GPS.GPSLongitude: (46.0, 38.0, 0.0),
+        }
+        imagem = Image.new('RGB', (40, 20), 'white')
+        imagem.paste((255, 0, 0), (0, 0, 10, 20))  # faixa vermelha à esquerda
+        normalizada, localizacao = self._normalizar(self._gravar(imagem, 'JPEG', exif=exif))
+
+        self.assertAlmostEqual(localizacao[0], -23.555, places=6)
+        self.assertAlmostEqual(localizacao[1], -46.633333, places=6)
+        with normalizada:
+            self.assertEqual(normalizada.size, (20, 40))
+            # A faixa da esquerda passa para o topo
+            vermelho, verde, azul = normalizada.getpixel((10, 2))
+            self.assertGreater(vermelho, 200)
+            self.assertLess(verde, 60)
+            self.assertEqual(dict(normalizada.getexif()), {})
+
+    def test_gps_zerado_e_ignorado(self):
+        exif = Image.Exif()
+        exif[ExifTags.IFD.GPSInfo] = {
+            ExifTags.GPS.GPSLatitudeRef: 'N', ExifTags.GPS.GPSLatitude: (0.0, 0.0, 0.0),
+            ExifTags.GPS.GPSLongitudeRef: 'E', ExifTags.GPS.GPSLongitude: (0.0, 0.0, 0.0),
+        }
+        normalizada, localizacao = self._normalizar(self._gravar(Image.new('RGB', (20, 20)), 'JPEG', exif=exif))
+        self.assertIsNone(localizacao)
+        with normalizada:
+            self.assertEqual(dict(normalizada.getexif()), {})
+
+    def test_mantem_o_perfil_de_cor(self):
+        perfil = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+        for formato in ('JPEG', 'PNG'):
+            with self.subTest(formato=formato):
+                caminho = self._gravar(Image.new('RGB', (30, 30), 'blue'), formato, icc_profile=perfil,
+                                       **({'exif': Image.Exif()} if formato == 'JPEG' else {}))
+                with override_settings(IMAGEM_DIMENSAO_MAXIMA=20):
+                    normalizada, _ = self._normalizar(caminho)
+                with normalizada:
+                    self.assertEqual(normalizada.size, (20, 20))
+                    self.assertEqual(normalizada.info.get('icc_profile'), perfil)
+
+    def test_mantem_a_original_sem_nada_a_mudar(self):
+        caminho = self._gravar(Image.new('RGB', (20, 20), 'green'), 'PNG', optimize=True)
+        self.assertEqual(self._normalizar(caminho), (None, None))
+
+    def test_gif_animado_sem_comentario(self):
+        quadros = [Image.new('RGB', (10, 10), cor).convert('P') for cor in ('red', 'blue', 'yellow')]
+        caminho = self._gravar(quadros[0], 'GIF', save_all=True, append_images=quadros[1:],
+                               comment=b'segredo', duration=[100, 200, 300], loop=0)
+        normalizada, _ = self._normalizar(caminho)
+        with normalizada:
+            self.assertEqual(normalizada.n_frames, 3)
+            self.assertEqual(normalizada.info.get('loop'), 0)
+            self.assertNotIn('comment', normalizada.info)
+            duracoes = []
+            for quadro in range(normalizada.n_frames):
+                normalizada.seek(quadro)
+                duracoes.append(normalizada.info['duration'])
+            self.assertEqual(duracoes, [100, 200, 300])
+        with open(os.path.join(self.pasta, 'normalizada'), 'rb') as arquivo:
+            self.assertNotIn(b'segredo', arquivo.read())
+
+    @override_settings(IMAGEM_MAX_PIXELS=1000)
+    def test_recusa_imagens_com_pixels_demais(self):
+        caminho = self._gravar(Image.new('RGB', (40, 30)), 'PNG')
+        with self.assertRaisesMessage(normalizacao.ImagemInvalida, '40x30 pixels'):
+            self._normalizar(caminho)
+        with open(caminho, 'rb') as arquivo, self.assertRaises(normalizacao.ImagemInvalida):
+            normalizacao.verificar(arquivo)
+        with open(self._gravar(Image.new('RGB', (20, 30)), 'PNG'), 'rb') as arquivo:
+            normalizacao.verificar(arquivo)
+            self.assertEqual(arquivo.tell(), 0)
+
+
+@override_settings(TAREFAS_SINCRONAS=False, TAREFAS_MAX_TENTATIVAS=3, TAREFAS_ESPERA_BASE=30,
+                   TAREFAS_TEMPO_LIMITE=600)
+class TarefasTest(TestCase):
+    """Repetição com espera exponencial, tarefas travadas e a retomada de salvar_imagem"""
+
+    def setUp(self):
+        self.falhas = []
+
+        @tarefas.tarefa('teste_instavel')
+        def instavel(falhar):
+            self.falhas.append(falhar)
+            if falhar:
+                raise ValueError('falha de teste')
+
+        self.addCleanup(tarefas._executores.pop, 'teste_instavel')
+
+    def _executar_agora(self, tarefa):
+        Tarefa.objects.filter(pk=tarefa.pk).update(executar_em=timezone.now())
+        with self.assertLogs('core.tarefas', 'ERROR'):
+            self.assertEqual(tarefas.processar(), 1)
+        tarefa.refresh_from_db()
+        return tarefa
+
+    def test_repete_com_espera_exponencial_ate_falhar(self):
+        tarefa = tarefas.enfileirar('teste_instavel', falhar=True)
+        esperas = []
+        for tentativa in (1, 2):
+            antes = timezone.now()
+            tarefa = self._executar_agora(tarefa)
+            self.assertEqual((tarefa.status, tarefa.tentativas), (Tarefa.PENDENTE, tentativa))
+            self.assertIn('falha de teste', tarefa.erro)
+            esperas.append(round((tarefa.executar_em - antes).total_seconds()))
+            # Ainda no intervalo de espera: não é executada
+            self.assertEqual(tarefas.processar(), 0)
+        self.assertEqual(esperas, [30, 60])
+
+        tarefa = self._executar_agora(tarefa)
+        self.assertEqual((tarefa.status, tarefa.tentativas), (Tarefa.FALHOU, 3))
+        self.assertEqual(tarefas.processar(), 0)
+        self.assertEqual(len(self.falhas), 3)
+
+        # Devolvida à fila pelo admin: tentativas zeradas
+        self.assertEqual(tarefas.reenfileirar(Tarefa.objects.filter(pk=tarefa.pk)), 1)
+        tarefa.refresh_from_db()
+        self.assertEqual((tarefa.status, tarefa.tentativas, tarefa.erro), (Tarefa.PENDENTE, 0, ''))
+
+    def test_conclui_e_nao_executa_de_novo(self):
+        tarefa = tarefas.enfileirar('teste_instavel', falhar=False)
+        self.assertTrue(tarefas.executar(tarefa.pk))
+        self.assertFalse(tarefas.executar(tarefa.pk))
+        tarefa.refresh_from_db()
+        self.assertEqual((tarefa.status, tarefa.tentativas), (Tarefa.CONCLUIDA, 1))
+        self.assertEqual(self.falhas, [False])
+
+    def test_libera_as_tarefas_travadas(self):
+        agora = timezone.now()
+
+        def criar(tentativas, iniciada_em):
+            return Tarefa.objects.create(
+                tipo='teste_instavel', dados={'falhar': False}, status=Tarefa.EXECUTANDO,
+                tentativas=tentativas, max_tentativas=3, iniciada_em=iniciada_em,
+            )
+
+        travada = criar(1, agora - timedelta(seconds=601))
+        esgotada = criar(3, agora - timedelta(seconds=601))
+        em_execucao = criar(1, agora - timedelta(seconds=60))
+
+        self.assertEqual(tarefas.liberar_travadas(), 2)
+        for tarefa in (travada, esgotada, em_execucao):
+            tarefa.refresh_from_db()
+        self.assertEqual(travada.status, Tarefa.PENDENTE)
+        self.assertLessEqual(travada.executar_em, timezone.now())
+        self.assertEqual((esgotada.status, esgotada.erro), (Tarefa.FALHOU, 'Tempo limite de execução excedido'))
+        self.assertEqual(em_execucao.status, Tarefa.EXECUTANDO)
+
+        self.assertEqual(tarefas.processar(), 1)
+        travada.refresh_from_db()
+        self.assertEqual((travada.status, travada.tentativas), (Tarefa.CONCLUIDA, 2))
+
+    def test_salvar_imagem_retomada_nao_duplica(self):
+        with tempfile.TemporaryDirectory() as midia, tempfile.TemporaryDirectory() as pendentes, \
+                override_settings(MEDIA_ROOT=midia, TAREFAS_PASTA_UPLOADS=pendentes):
+            relatorio = Relatorio.objects.create(titulo='Com fotos', conteudo='Na rua')
+
+            def pendente(nome, cor):
+                Image.new('RGB', (20, 20), cor).save(os.path.join(pendentes, nome), 'JPEG')
+
+            pendente('a.jpg', 'red')
+            tarefas.salvar_imagem(relatorio.pk, 'a.jpg', 'foto.jpg', ordem=0)
+            imagem = relatorio.imagens_relatorio.get()
+            self.assertTrue(imagem.imagem.storage.exists(imagem.imagem.name))
+            self.assertEqual(os.listdir(pendentes), [])
+
+            # Execução interrompida depois de criar a imagem: a repetição só descarta o arquivo
+            pendente('a.jpg', 'blue')
+            tarefas.salvar_imagem(relatorio.pk, 'a.jpg', 'foto.jpg', ordem=0)
+            self.assertEqual(list(relatorio.imagens_relatorio.values_list('pk', 'imagem')),
+                             [(imagem.pk, imagem.imagem.name)])
+            self.assertEqual(os.listdir(pendentes), [])
+
+            pendente('b.jpg', 'blue')
+            tarefas.salvar_imagem(relatorio.pk, 'b.jpg', 'foto2.jpg', ordem=1)
+            self.assertEqual(list(relatorio.imagens_relatorio.values_list('ordem', flat=True)), [0, 1])
+
+            # Relatório excluído antes da execução
+            pendente('c.jpg', 'green')
+            tarefas.salvar_imagem(relatorio.pk + 1000, 'c.jpg', 'foto3.jpg', ordem=0)
+            self.assertEqual(os.listdir(pendentes), [])
+
+
+class ImportacaoTest(TransactionTestCase):
+    """
+    Comando importar_relatorios: retomada após uma interrupção, arquivo
+    alterado e o recálculo ao final. TransactionTestCase porque o comando
+    fecha as conexões e grava as imagens em outros processos.
+    """
+
+    # Título, imagens e se o registro deve ser importado
+    REGISTROS = [
+        ('Buraco 1', 'a.jpg', True),
+        ('', '', False),
+        ('Buraco 3', 'a.jpg b.jpg', True),
+        ('Buraco 4', '', True),
+        ('Buraco 5', 'c.jpg ruim.jpg', False),
+        ('Buraco 6', 'd.jpg', True),
+        ('Buraco 7', '', True),
+        ('Buraco 8', 'a.jpg ruim.jpg', False),
+    ]
+
+    def setUp(self):
+        pasta = tempfile.TemporaryDirectory()
+        self.addCleanup(pasta.cleanup)
+        self.imagens = os.path.join(pasta.name, 'imagens')
+        os.makedirs(self.imagens)
+        for nome, cor in (('a.jpg', 'red'), ('b.jpg', 'blue'), ('c.jpg', 'green'), ('d.jpg', 'yellow')):
+            Image.new('RGB', (20, 20), cor).save(os.path.join(self.imagens, nome), 'JPEG')
+        with open(os.path.join(self.imagens, 'ruim.jpg'), 'wb') as arquivo:
+            arquivo.write(b'isto nao e uma imagem')
+
+        self.arquivo = os.path.join(pasta.name, 'relatorios.csv')
+        with open(self.arquivo, 'w', encoding='utf-8', newline='') as saida:
+            escritor = csv.writer(saida)
+            escritor.writerow(['titulo', 'conteudo', 'nome_usuario', 'email_usuario', 'latitude', 'longitude',
+                               'imagens'])
+            for numero, (titulo, imagens, _) in enumerate(self.REGISTROS, start=1):
+                escritor.writerow([titulo, 'Na rua', 'Visitante', 'visitante@exemplo.com',
+                                   f'-23.{numero}', f'-46.{numero}', imagens])
+
+        configuracao = override_settings(MEDIA_ROOT=os.path.join(pasta.name, 'media'), TAREFAS_SINCRONAS=False)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+
+    def _importar(self, **opcoes):
+        saida = io.StringIO()
+        call_command('importar_relatorios', self.arquivo, imagens=self.imagens, lote=2, processos=1,
+                     sem_derivados=True, stdout=saida, stderr=io.StringIO(), **opcoes)
+        return saida.getvalue()
+
+    def _interromper_no_registro(self, numero):
+        validar = importacao.validar
+        chamadas = []
+
+        def validar_ate(*args, **kwargs):
+            chamadas.append(1)
+            if len(chamadas) == numero:
+                raise KeyboardInterrupt
+            return validar(*args, **kwargs)
+
+        with mock.patch('core.importacao.validar', side_effect=validar_ate), self.assertRaises(KeyboardInterrupt):
+            self._importar()
+
+    def _nome(self, imagem):
+        with open(os.path.join(self.imagens, imagem), 'rb') as arquivo:
+            return armazenamento.caminho_conteudo(armazenamento.calcular_hash(File(arquivo)), '.jpg')
+
+    def test_retoma_apos_os_lotes_gravados(self):
+        # Lotes de 2: os registros 1 a 4 são gravados e o 5 interrompe o terceiro lote
+        self._interromper_no_registro(5)
+        self.assertEqual(sorted(Relatorio.objects.values_list('titulo', flat=True)),
+                         ['Buraco 1', 'Buraco 3', 'Buraco 4'])
+        progresso = ProgressoImportacao.objects.get(arquivo=self.arquivo)
+        self.assertEqual((progresso.registros, progresso.importados, progresso.rejeitados), (4, 3, 1))
+
+        saida = self._importar()
+        self.assertIn('Retomando a importação após o registro 4', saida)
+        self.assertIn('5 relatório(s) importado(s); 3 registro(s) rejeitado(s)', saida)
+        esperados = sorted(titulo for titulo, _, importar in self.REGISTROS if importar)
+        self.assertEqual(sorted(Relatorio.objects.values_list('titulo', flat=True)), esperados)
+        self.assertFalse(ProgressoImportacao.objects.exists())
+
+        # Recálculo ao final do que os sinais manteriam
+        totais = contadores.estatisticas()
+        self.assertEqual((totais.total_relatorios, totais.total_com_localizacao, totais.total_imagens), (5, 5, 4))
+        self.assertEqual(AgregadoMapa.objects.get(zoom=0).quantidade, 5)
+        self.assertEqual(contadores.total_do_autor(nome_usuario='Visitante'), 5)
+
+        # Referências dos arquivos e as imagens dos registros recusados
+        referencias = dict(ConteudoImagem.objects.filter(referencias__gt=0).values_list('arquivo', 'referencias'))
+        self.assertEqual(referencias, {self._nome('a.jpg'): 2, self._nome('b.jpg'): 1, self._nome('d.jpg'): 1})
+        for imagem in ('a.jpg', 'b.jpg', 'd.jpg'):
+            self.assertTrue(armazenamento.armazenamento.exists(self._nome(imagem)))
+        # Só usada pelo registro 5, recusado pela outra imagem
+        self.assertFalse(armazenamento.armazenamento.exists(self._nome('c.jpg')))
+
+    def test_recusa_o_arquivo_alterado(self):
+        self._interromper_no_registro(3)
+        with open(self.arquivo, 'a', encoding='utf-8') as saida:
+            saida.write('Buraco 9,Na rua,Visitante,visitante@exemplo.com,,,\n')
+        with self.assertRaisesMessage(CommandError, 'mudou desde a importação interrompida'):
+            self._importar()
+        self.assertEqual(Relatorio.objects.count(), 1)
+
+        # --reiniciar ignora o progresso salvo
+        saida = self._importar(reiniciar=True)
+        self.assertIn('6 relatório(s) importado(s)', saida)
+        self.assertEqual(Relatorio.objects.filter(titulo='Buraco 1').count(), 2)
+
+
+class PaginadorCursorTest(TestCase):
+    """Navegação pelos tokens do paginador keyset, inclusive com datas repetidas"""
+
+    @classmethod
+    def setUpTestData(cls):
+        agora = timezone.now()
+        # Grupos de 3 relatórios com a mesma data: o desempate é pelo id
+        Relatorio.objects.bulk_create([
+            Relatorio(
+                titulo=f'Buraco {i}' if i % 4 else f'Buraco buraco buraco {i}',
+                conteudo='Buraco na rua',
+                data_criacao=agora - timedelta(hours=i // 3),
+            )
+            for i in range(23)
+        ])
+        cls.esperados = list(Relatorio.objects.order_by('-data_criacao', '-pk').values_list('pk', flat=True))
+
+    def _pks(self, pagina):
+        return [relatorio.pk for relatorio in pagina]
+
+    def test_avancar_e_voltar(self):
+        paginador = PaginadorCursor(Relatorio.objects.all(), 5)
+        paginas = [paginador.pagina()]
+        self.assertFalse(paginas[0].has_previous())
+        while paginas[-1].has_next():
+            paginas.append(paginador.pagina(paginas[-1].token_proximo))
+        self.assertEqual([pk for pagina in paginas for pk in self._pks(pagina)], self.esperados)
+        self.assertEqual([len(pagina) for pagina in paginas], [5, 5, 5, 5, 3])
+
+        # Volta da última até a primeira pelos tokens de página anterior
+        voltando = [paginas[-1]]
+        while voltando[-1].has_previous():
+            voltando.append(paginador.pagina(voltando[-1].token_anterior))
+        self.assertEqual([self._pks(pagina) for pagina in voltando], [self._pks(pagina) for pagina in paginas[::-1]])
+        self.assertFalse(voltando[-1].has_previous())
+        self.assertTrue(voltando[-1].has_next())
+
+    def test_token_invalido_volta_a_primeira_pagina(self):
+        paginador = PaginadorCursor(Relatorio.objects.all(), 5)
+        for token in ('nao-e-um-token', paginador.pagina().token_proximo[:-2] + 'xx'):
+            self.assertEqual(self._pks(paginador.pagina(token)), self.esperados[:5])
+
+    @override_settings(PAGINACAO_POR_CURSOR=True)
+    def test_busca_mantem_a_ordem_da_relevancia(self):
+        requisicao = RequestFactory().get('/')
+        pagina, _, _ = paginar(requisicao, Relatorio.objects.all(), 5)
+        self.assertIsInstance(pagina, PaginaCursor)
+
+        resultados = busca.buscar(Relatorio.objects.all(), 'buraco')
+        pagina, total, aproximado = paginar(requisicao, resultados, 5)
+        self.assertNotIsInstance(pagina, PaginaCursor)
+        self.assertEqual((total, aproximado), (23, False))
+        relevancias = [relatorio.relevancia for relatorio in pagina]
+        self.assertEqual(relevancias, sorted(relevancias, reverse=True))
+        self.assertTrue(all(relatorio.titulo.startswith('Buraco buraco') for relatorio in pagina))
+
+        # Acima do limite da contagem exata, a estimativa do planejador no lugar do COUNT(*)
+        with override_settings(PAGINACAO_CONTAGEM_EXATA_ATE=10), CaptureQueriesContext(connection) as consultas:
+            pagina, total, aproximado = paginar(requisicao, resultados, 5)
+        self.assertNotIsInstance(pagina, PaginaCursor)
+        self.assertTrue(aproximado)
+        self.assertGreaterEqual(total, 11)
+        self.assertTrue(any(consulta['sql'].startswith('EXPLAIN') for consulta in consultas.captured_queries))
+        relevancias = [relatorio.relevancia for relatorio in pagina]
+        self.assertEqual(relevancias, sorted(relevancias, reverse=True))
+
+
+def _haversine(latitude1, longitude1, latitude2, longitude2):
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    )
+    return 2 * proximidade.RAIO_TERRA * math.asin(math.sqrt(min(a, 1.0)))
+
+
+class ProximidadeTest(TestCase):
+    """Consultas por proximidade comparadas com a distância calculada para todos os relatórios"""
+
+    # Pontos de consulta nos casos de borda do retângulo (bbox)
+    PONTOS = [
+        (10.0, 179.99), (10.0, -179.99), (10.0, 180.0), (-10.2, -179.9),  # antimeridiano
+        (89.9, 45.0), (90.0, 0.0), (89.99, -170.0), (-89.95, -120.0), (-90.0, 0.0),  # polos
+        (65.0, 20.0), (0.0, 0.0),
+    ]
+    RAIOS = [1000, 10000, 50000, 300000]
+
+    @classmethod
+    def setUpTestData(cls):
+        aleatorio = random.Random(7)
+        regioes = [
+            ((9.5, 10.5), (179.5, 180.0)), ((9.5, 10.5), (-180.0, -179.5)),
+            ((-10.5, -10.0), (179.8, 180.0)), ((-10.5, -10.0), (-180.0, -179.8)),
+            ((89.5, 90.0), (-180.0, 180.0)), ((-90.0, -89.5), (-180.0, 180.0)),
+            ((64.5, 65.5), (18.0, 22.0)), ((-0.5, 0.5), (-0.5, 0.5)),
+        ]
+        Relatorio.objects.bulk_create([
+            Relatorio(
+                titulo=f'Ponto {indice}',
+                conteudo='Relatório de teste',
+                latitude=Decimal(f'{aleatorio.uniform(*latitudes):.8f}'),
+                longitude=Decimal(f'{aleatorio.uniform(*longitudes):.8f}'),
+            )
+            for indice, (latitudes, longitudes) in enumerate(regioes * 60)
+        ])
+        cls.coordenadas = [
+            (pk, float(latitude), float(longitude))
+            for pk, latitude, longitude in Relatorio.objects.values_list('pk', 'latitude', 'longitude')
+        ]
+
+    def _esperados(self, latitude, longitude, metros):
+        """(distância, pk) de todos os relatórios a até ``metros``, do mais próximo ao mais distante"""
+        return sorted(
+            (distancia, pk) for pk, distancia in (
+                (pk, _haversine(latitude, longitude, lat, lng)) for pk, lat, lng in self.coordenadas
+            )
+            if distancia <= metros
+        )
+
+    def test_filtro_bbox_nos_polos_e_no_antimeridiano(self):
+        # Círculo com um polo: todas as longitudes
+        for latitude in (90.0, 89.99, -89.97):
+            self.assertNotIn('longitude', str(proximidade.filtro_bbox(latitude, 0.0, 5000)))
+        # Perto do polo, mas sem contê-lo: faixa de longitude bem mais larga que a de latitude
+        filtro = dict(proximidade.filtro_bbox(-89.95, 0.0, 5000).children)
+        self.assertGreater(filtro['longitude__range'][1], 60)
+        # Atravessa o antimeridiano: duas faixas de longitude
+        filtro = proximidade.filtro_bbox(10.0, 179.99, 5000)
+        self.assertEqual(filtro.connector, 'AND')
+        faixas = filtro.children[-1]
+        self.assertEqual(faixas.connector, 'OR')
+        self.assertEqual({campo for campo, _ in faixas.children}, {'longitude__gte', 'longitude__lte'})
+        oeste, leste = (valor for _, valor in sorted(faixas.children))
+        self.assertTrue(179 < oeste < 180 and -180 < leste < -179)
+        # Caso comum: um intervalo de longitude dentro de [-180, 180]
+        self.assertIn('longitude__range', str(proximidade.filtro_bbox(65.0, 20.0, 5000)))
+
+    def test_no_raio_igual_a_distancia_de_todos(self):
+        for latitude, longitude in self.PONTOS:
+            for metros in self.RAIOS:
+                with self.subTest(ponto=(latitude, longitude), metros=metros):
+                    obtidos = list(
+                        proximidade.no_raio(Relatorio.objects.all(), latitude, longitude, metros)
+                        .values_list('pk', 'distancia')
+                    )
+                    esperados = self._esperados(latitude, longitude, metros)
+                    self.assertEqual({pk for pk, _ in obtidos}, {pk for _, pk in esperados})
+                    for (pk, distancia), (esperada, _) in zip(obtidos, esperados):
+                        self.assertAlmostEqual(distancia, esperada, delta=0.01)
+
+    def test_mais_proximos_exatos(self):
+        for latitude, longitude in self.PONTOS:
+            for k in (1, 5, 25):
+                with self.subTest(ponto=(latitude, longitude), k=k):
+                    obtidos = proximidade.mais_proximos(Relatorio.objects.all(), latitude, longitude, k)
+                    esperados = self._esperados(latitude, longitude, 50000)[:k]
+                    self.assertEqual(
+                        [relatorio.pk for relatorio in obtidos], [pk for _, pk in esperados]
+                    )
+
+    def test_mais_proximo_do_outro_lado_do_antimeridiano(self):
+        perto = Relatorio.objects.create(titulo='Leste', conteudo='x', latitude=Decimal('30'),
+                                         longitude=Decimal('-179.995'))
+        Relatorio.objects.create(titulo='Oeste', conteudo='x', latitude=Decimal('30'), longitude=Decimal('179.9'))
+        obtidos = proximidade.mais_proximos(Relatorio.objects.all(), 30.0, 179.995, 2)
+        self.assertEqual(obtidos[0].pk, perto.pk)
+        self.assertLess(obtidos[0].distancia, 1000)
+        self.assertGreater(obtidos[1].distancia, 9000)
@@ -0,0 +1,216 @@
+"""
+Handler de upload das imagens dos relatórios.
+
+Valida o tamanho (MAX_UPLOAD_SIZE), a extensão e a assinatura do arquivo
+(magic bytes) enquanto o upload chega, calcula o SHA-256 do conteúdo e grava
+cada parte uma única vez, diretamente na pasta de uploads pendentes
+(TAREFAS_PASTA_UPLOADS). De lá o arquivo é apenas movido para o storage
+pelo worker (ver core/tarefas.py), sem nova cópia nem nova leitura.
+
+Arquivos inválidos deixam de ser gravados assim que o problema é detectado
+e chegam ao formulário como ``UploadRejeitado``, com a mensagem de erro. Ao
+fim do upload o cabeçalho da imagem é lido para recusar as que têm pixels
+demais (ver core/normalizacao.py). Um arquivo maior que MAX_UPLOAD_SIZE
+interrompe a leitura da requisição (o restante não é recebido), e um envio
+maior que UPLOAD_MAX_REQUISICAO nem começa a ser lido; nos dois casos o
+motivo fica em ``request.upload_interrompido``.
+
+O handler só é usado pelas views decoradas com ``upload_de_imagens``; os
+demais uploads (ex.: o admin) seguem com os handlers padrão do Django.
+"""
+import hashlib
+import io
+import os
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+from . import normalizacao
+
+
+# Assinaturas (magic bytes) dos formatos aceitos
+ASSINATURAS = {
+    b'\xff\xd8\xff': 'image/jpeg',
+    b'\x89PNG\r\n\x1a\n': 'image/png',
+    b'GIF87a': 'image/gif',
+    b'GIF89a': 'image/gif',
+}
+TAMANHO_ASSINATURA = max(len(assinatura) for assinatura in ASSINATURAS)
+EXTENSOES = ('.jpg', '.jpeg', '.png', '.gif')
+
+
+def tipo_pela_assinatura(inicio):
+    """Tipo MIME correspondente aos primeiros bytes do arquivo, ou None"""
+    for assinatura, tipo in ASSINATURAS.items():
+        if inicio.startswith(assinatura):
+            return tipo
+    return None
+
+
+class ArquivoEmDisco(File):
+    """Arquivo já gravado em disco, que o FileSystemStorage move em vez de copiar"""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class UploadImagem(UploadedFile):
+    """Imagem validada durante o upload e gravada na pasta de pendentes"""
+
+    def __init__(self, file, name, content_type, size, charset, content_type_extra, sha256):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.sha256 = sha256
+
+    def temporary_file_path(self):
+        return self.file.name
+
+    def close(self):
+        # Como o TemporaryUploadedFile: o arquivo que não foi movido é descartado ao fim da requisição
+        try:
+            self.file.close()
+            os.remove(self.file.name)
+        except FileNotFoundError:
+            pass
+
+
+class UploadRejeitado(UploadedFile):
+    """Upload interrompido pelo handler; o conteúdo não é mantido"""
+
+    def __init__(self, name, content_type, size, erro_upload):
+        super().__init__(io.BytesIO(), name, content_type, size)
+        self.erro_upload = erro_upload
+
+
+def _tamanho_da_requisicao(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+def _mensagem_requisicao_grande():
+    return f'O envio passa do limite de {settings.UPLOAD_MAX_REQUISICAO // 1024 // 1024}MB por relatório.'
+
+
+class ImagemUploadHandler(FileUploadHandler):
+    """Valida, calcula o hash e grava as imagens conforme o upload chega"""
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > settings.UPLOAD_MAX_REQUISICAO:
+            # Não lê o corpo: a view recebe o formulário vazio e o motivo
+            self.request.upload_interrompido = _mensagem_requisicao_grande()
+            return QueryDict(encoding=encoding), MultiValueDict()
+        return None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.erro = None
+        self.tamanho = 0
+        self.inicio = b''
+        self.hash = hashlib.sha256()
+
+        extensao = os.path.splitext(self.file_name)[1].lower()
+        if extensao not in EXTENSOES:
+            self.erro = f'Extensão de {self.file_name} não suportada. Use apenas .jpg, .jpeg, .png ou .gif.'
+            self.destino = None
+            return
+
+        os.makedirs(settings.TAREFAS_PASTA_UPLOADS, exist_ok=True)
+        self.destino = open(
+            os.path.join(settings.TAREFAS_PASTA_UPLOADS, uuid.uuid4().hex + extensao), 'w+b'
+        )
+
+    def _rejeitar(self, erro):
+        self.erro = erro
+        self._descartar()
+
+    def _descartar(self):
+        if self.destino is not None:
+            self.destino.close()
+            os.remove(self.destino.name)
+            self.destino = None
+
+    def _verificar_assinatura(self):
+        if tipo_pela_assinatura(self.inicio) is None:
+            self._rejeitar(f'Arquivo {self.file_name} não é uma imagem JPG, PNG ou GIF válida.')
+
+    def receive_data_chunk(self, raw_data, start):
+        # Retornar None impede que os handlers seguintes recebam a parte
+        self.tamanho += len(raw_data)
+        if self.erro:
+            return None
+
+        if self.tamanho > settings.MAX_UPLOAD_SIZE:
+            self._rejeitar(
+                f'Arquivo {self.file_name} é muito grande. '
+                f'Tamanho máximo: {settings.MAX_UPLOAD_SIZE // 1024 // 1024}MB'
+            )
+            # Para de ler a requisição em vez de receber (e descartar) o restante
+            self.request.upload_interrompido = self.erro
+            raise StopUpload(connection_reset=True)
+
+        if len(self.inicio) < TAMANHO_ASSINATURA:
+            self.inicio += raw_data[:TAMANHO_ASSINATURA - len(self.inicio)]
+            if len(self.inicio) == TAMANHO_ASSINATURA:
+                self._verificar_assinatura()
+                if self.erro:
+                    return None
+
+        self.hash.update(raw_data)
+        self.destino.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.erro and len(self.inicio) < TAMANHO_ASSINATURA:
+            # Arquivo menor que a maior assinatura
+            self._verificar_assinatura()
+        if not self.erro:
+            self.destino.flush()
+            self.destino.seek(0)
+            try:
+                normalizacao.verificar(self.destino)
+            except normalizacao.ImagemInvalida as erro:
+                self._rejeitar(f'Arquivo {self.file_name} não foi aceito: {erro}.')
+        if self.erro:
+            return UploadRejeitado(self.file_name, self.content_type, self.tamanho, self.erro)
+        return UploadImagem(
+            self.destino,
+            self.file_name,
+            tipo_pela_assinatura(self.inicio),
+            file_size,
+            self.charset,
+            self.content_type_extra,
+            self.hash.hexdigest(),
+        )
+
+    def upload_interrupted(self):
+        if getattr(self, 'destino', None) is not None:
+            self._descartar()
+
+
+def upload_de_imagens(view):
+    """
+    Usa o ImagemUploadHandler nos uploads da view. Os handlers precisam ser
+    trocados antes da leitura do POST pelo CsrfViewMiddleware, então a
+    verificação do CSRF passa para dentro da view. Envios maiores que
+    UPLOAD_MAX_REQUISICAO vão direto à view, sem CSRF: o corpo não é lido e
+    o formulário vazio não pode ser gravado.
+    """
+    protegida = csrf_protect(view)
+
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.upload_handlers = [ImagemUploadHandler(request)]
+        if _tamanho_da_requisicao(request) > settings.UPLOAD_MAX_REQUISICAO:
+            return view(request, *args, **kwargs)
+        return protegida(request, *args, **kwargs)
+
+    return wrapper
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
@@ -15,8 +16,19 @@ urlpatterns = [
     path('relatorios/criar/', views.criar_relatorio, name='criar_relatorio'),
     path('relatorios/meus/', views.meus_relatorios, name='meus_relatorios'),
     path('relatorios/<int:pk>/', views.detalhes_relatorio_publico, name='detalhes_relatorio_publico'),
+    path('geocodificacao/reversa/', views.geocodificacao_reversa, name='geocodificacao_reversa'),
+    
+    # Imagens dos relatórios, com as mesmas regras de acesso dos relatórios
+    path(f'{settings.MEDIA_URL.strip("/")}/<path:caminho>', views.servir_midia, name='servir_midia'),
+    
+    # Métricas para o Prometheus (sem barra final, o caminho padrão do scrape)
+    path('metrics', views.metricas_prometheus, name='metricas_prometheus'),
     
     # Relatórios - Admin (mudança de URL para evitar conflito)
     path('painel/relatorios/', views.admin_relatorios, name='admin_relatorios'),
+    path('painel/relatorios/mapa/', views.admin_relatorios_mapa, name='admin_relatorios_mapa'),
+    path('painel/relatorios/proximos/', views.admin_relatorios_proximos, name='admin_relatorios_proximos'),
+    path('painel/relatorios/autores/', views.admin_autores, name='admin_autores'),
+    path('painel/relatorios/exportar/', views.exportar_relatorios, name='exportar_relatorios'),
     path('painel/relatorios/<int:pk>/', views.detalhes_relatorio, name='detalhes_relatorio'),
 ] 
\ No newline at end of file
@@ -1,25 +1,35 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.views.decorators.http import require_safe
 from django.contrib.auth import login
-from django.contrib.auth.models import User
 from django.contrib import messages
-from django.db.models import Q
-from django.core.paginator import Paginator
+from django.db.models import Q, Min, Max
+from django.conf import settings
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from django.db import transaction
-from .models import Relatorio, ImagemRelatorio
+from .models import Relatorio
+from . import agrupamento, autoria, busca, cache_respostas, contadores, exportacao, facetas, geocodificacao, metricas, midia, proximidade, tarefas
+from .cache_respostas import cache_para_anonimos
+from .paginacao import paginar
+from .uploads import upload_de_imagens
 from .forms import RelatorioForm, CustomUserCreationForm, MultipleImageUploadForm
+import math
 
 # Create your views here.
 
+@cache_para_anonimos
 def home(request):
     """View para a página inicial"""
     return render(request, 'core/home.html')
 
+@cache_para_anonimos
 def sobre(request):
     """View para a página sobre"""
     return render(request, 'core/sobre.html')
 
+@cache_para_anonimos
 def contato(request):
     """View para a página de contato"""
     return render(request, 'core/contato.html')
@@ -28,6 +38,7 @@ def is_admin(user):
     """Função para verificar se o usuário é admin"""
     return user.is_staff or user.is_superuser
 
+@upload_de_imagens
 def criar_relatorio(request):
     """View para criação de relatórios - disponível apenas para usuários comuns"""
     # Bloquear acesso para administradores
@@ -37,41 +48,51 @@ def criar_relatorio(request):
     
     if request.method == 'POST':
         form = RelatorioForm(request.POST, user=request.user)
-        image_form = MultipleImageUploadForm(request.POST, request.FILES)
+        image_form = MultipleImageUploadForm(
+            request.POST, request.FILES, erro_upload=getattr(request, 'upload_interrompido', None)
+        )
         
         if form.is_valid() and image_form.is_valid():
+            # As imagens são apenas guardadas aqui; o worker as grava no storage
+            # depois do commit, fora da transação e da requisição
+            imagens = image_form.cleaned_data.get('imagens', [])
+            pendentes = []
             try:
+                for imagem in imagens:
+                    pendentes.append((tarefas.preparar_upload(imagem), imagem.name, getattr(imagem, 'sha256', None)))
+                
                 with transaction.atomic():
                     # Criar o relatório
                     relatorio = form.save(commit=False)
                     
-                    # Se o usuário estiver logado, associar ao relatório
+                    # Se o usuário estiver logado, associar ao relatório; senão, ao token do visitante
                     if request.user.is_authenticated:
                         relatorio.usuario = request.user
+                    else:
+                        relatorio.token_anonimo = autoria.token(request, criar=True)
                     
                     relatorio.save()
                     
-                    # Processar imagens se houver
-                    imagens = image_form.cleaned_data.get('imagens', [])
-                    if imagens:
-                        for ordem, imagem in enumerate(imagens):
-                            ImagemRelatorio.objects.create(
-                                relatorio=relatorio,
-                                imagem=imagem,
-                                ordem=ordem
-                            )
-                    
-                    messages.success(request, 'Relatório criado com sucesso!')
+                    for ordem, (arquivo, nome, sha256) in enumerate(pendentes):
+                        tarefas.enfileirar(
+                            'salvar_imagem',
+                            relatorio_id=relatorio.id,
+                            arquivo=arquivo,
+                            nome=nome,
+                            ordem=ordem,
+                            sha256=sha256
+                        )
                     
-                    # Armazenar ID do relatório na sessão para usuários anônimos
-                    if not request.user.is_authenticated:
-                        relatorios_sessao = request.session.get('relatorios_criados', [])
-                        relatorios_sessao.append(relatorio.id)
-                        request.session['relatorios_criados'] = relatorios_sessao
+                    if pendentes:
+                        messages.success(request, 'Relatório criado com sucesso! As imagens serão processadas em instantes.')
+                    else:
+                        messages.success(request, 'Relatório criado com sucesso!')
                     
                     return redirect('core:criar_relatorio')
             
             except Exception as e:
+                for arquivo, nome, sha256 in pendentes:
+                    tarefas.descartar_upload(arquivo)
                 messages.error(request, f'Erro ao criar relatório: {str(e)}')
     else:
         form = RelatorioForm(user=request.user)
@@ -82,6 +103,54 @@ def criar_relatorio(request):
         'image_form': image_form
     })
 
+def _ip_do_cliente(request):
+    """IP do visitante, considerando os PROXIES_CONFIAVEIS à frente do servidor"""
+    if settings.PROXIES_CONFIAVEIS:
+        encaminhados = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+        # Os primeiros itens vêm do próprio cliente e podem ser forjados
+        if len(encaminhados) >= settings.PROXIES_CONFIAVEIS:
+            return encaminhados[-settings.PROXIES_CONFIAVEIS]
+    return request.META.get('REMOTE_ADDR', '')
+
+def geocodificacao_reversa(request):
+    """Endereço aproximado das coordenadas clicadas no mapa (JSON)"""
+    try:
+        latitude = float(request.GET['lat'])
+        longitude = float(request.GET['lng'])
+    except (KeyError, ValueError):
+        return JsonResponse({'erro': 'Parâmetros lat e lng inválidos'}, status=400)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return JsonResponse({'erro': 'Coordenadas fora do intervalo válido'}, status=400)
+    
+    try:
+        endereco, latitude, longitude = geocodificacao.endereco(latitude, longitude, cliente=_ip_do_cliente(request))
+    except geocodificacao.LimiteExcedido:
+        return JsonResponse({'erro': 'Muitas consultas; tente novamente em um minuto'}, status=429)
+    return JsonResponse({
+        'endereco': endereco,
+        'latitude': float(latitude),
+        'longitude': float(longitude),
+    })
+
+def metricas_prometheus(request):
+    """Métricas no formato do Prometheus (token em METRICAS_TOKEN ou usuário admin)"""
+    token = settings.METRICAS_TOKEN
+    autorizado = (
+        settings.DEBUG
+        or is_admin(request.user)
+        or (token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'))
+    )
+    if not autorizado:
+        return HttpResponse('Acesso negado', status=403)
+    
+    conteudo, content_type = metricas.exportar()
+    return HttpResponse(conteudo, content_type=content_type)
+
+@require_safe
+def servir_midia(request, caminho):
+    """Imagem dos relatórios, para quem pode ver o relatório (ver core/midia.py)"""
+    return midia.servir(request, caminho)
+
 def meus_relatorios(request):
     """View para visualização dos relatórios do usuário - disponível apenas para usuários comuns"""
     # Bloquear acesso para administradores
@@ -91,22 +160,28 @@ def meus_relatorios(request):
     
     if request.user.is_authenticated:
         # Usuário logado: mostrar relatórios do usuário
-        relatorios = Relatorio.objects.filter(usuario=request.user).prefetch_related('imagens_relatorio')
+        relatorios = (
+            Relatorio.objects.filter(usuario=request.user)
+            .select_related('usuario')
+            .prefetch_related('imagens_relatorio')
+        )
         titulo_pagina = f"Meus Relatórios ({request.user.username})"
+        total = contadores.total_do_autor(usuario_id=request.user.pk)
     else:
-        # Usuário anônimo: mostrar relatórios da sessão
-        relatorios_ids = request.session.get('relatorios_criados', [])
-        relatorios = Relatorio.objects.filter(id__in=relatorios_ids).prefetch_related('imagens_relatorio')
+        # Usuário anônimo: mostrar relatórios criados com o token do seu cookie
+        token = autoria.token(request)
+        relatorios = Relatorio.objects.filter(token_anonimo=token) if token else Relatorio.objects.none()
+        relatorios = relatorios.prefetch_related('imagens_relatorio')
         titulo_pagina = "Relatórios Criados Nesta Sessão"
+        total = None
     
     # Paginação
-    paginator = Paginator(relatorios, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj, total_relatorios, total_aproximado = paginar(request, relatorios, 10, total=total)
     
     return render(request, 'core/meus_relatorios.html', {
         'relatorios': page_obj,
-        'total_relatorios': relatorios.count(),
+        'total_relatorios': total_relatorios,
+        'total_aproximado': total_aproximado,
         'titulo_pagina': titulo_pagina
     })
 
@@ -117,22 +192,20 @@ def detalhes_relatorio_publico(request, pk):
         messages.info(request, 'Redirecionando para o painel administrativo.')
         return redirect('core:detalhes_relatorio', pk=pk)
     
-    relatorio = get_object_or_404(
-        Relatorio.objects.prefetch_related('imagens_relatorio'),
-        pk=pk
-    )
+    # As imagens e o autor só são consultados se o corpo da página não estiver em cache
+    relatorio = get_object_or_404(Relatorio, pk=pk)
     
     # Verificar se o usuário tem permissão para ver este relatório
     pode_ver = False
     
     if request.user.is_authenticated:
         # Usuário logado pode ver seus próprios relatórios
-        if relatorio.usuario == request.user:
+        if relatorio.usuario_id == request.user.pk:
             pode_ver = True
     else:
-        # Usuário anônimo pode ver apenas relatórios da sua sessão
-        relatorios_ids = request.session.get('relatorios_criados', [])
-        if relatorio.id in relatorios_ids:
+        # Usuário anônimo pode ver apenas os relatórios criados com o seu token
+        token = autoria.token(request)
+        if token is not None and relatorio.token_anonimo == token:
             pode_ver = True
     
     if not pode_ver:
@@ -140,27 +213,15 @@ def detalhes_relatorio_publico(request, pk):
         return redirect('core:home')
     
     return render(request, 'core/detalhes_relatorio_publico.html', {
-        'relatorio': relatorio
+        'relatorio': relatorio,
+        'chave_cache': cache_respostas.chave_relatorio(relatorio),
+        'cache_timeout': settings.CACHE_FRAGMENTOS_TIMEOUT
     })
 
-@login_required
-@user_passes_test(is_admin)
-def admin_relatorios(request):
-    """View para admin visualizar todos os relatórios"""
-    relatorios = Relatorio.objects.all().select_related('usuario').prefetch_related('imagens_relatorio')
-    
-    # Filtros
-    search = request.GET.get('search', '')
-    usuario_filtro = request.GET.get('usuario', '')
-    
+def filtrar_relatorios(relatorios, search, usuario_filtro):
+    """Aplica os filtros de busca e de usuário do painel administrativo"""
     if search:
-        relatorios = relatorios.filter(
-            Q(titulo__icontains=search) | 
-            Q(conteudo__icontains=search) |
-            Q(usuario__username__icontains=search) |
-            Q(nome_usuario__icontains=search) |
-            Q(email_usuario__icontains=search)
-        )
+        relatorios = busca.buscar(relatorios, search)
     
     if usuario_filtro:
         relatorios = relatorios.filter(
@@ -168,40 +229,259 @@ def admin_relatorios(request):
             Q(nome_usuario=usuario_filtro)
         )
     
-    # Paginação
-    paginator = Paginator(relatorios, 15)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    return relatorios
+
+@login_required
+@user_passes_test(is_admin)
+def admin_relatorios(request):
+    """View para admin visualizar todos os relatórios"""
+    relatorios = Relatorio.objects.all().select_related('usuario')
+    estatisticas = contadores.estatisticas()
+    
+    # Filtros
+    search = request.GET.get('search', '')
+    usuario_filtro = request.GET.get('usuario', '')
+    relatorios = filtrar_relatorios(relatorios, search, usuario_filtro)
     
-    # Lista de usuários para filtro (incluindo anônimos)
-    usuarios_logados = User.objects.filter(relatorio__isnull=False).distinct()
-    usuarios_anonimos = Relatorio.objects.filter(usuario__isnull=True).exclude(nome_usuario='').values_list('nome_usuario', flat=True).distinct()
+    # Paginação (sem filtros, o total vem das estatísticas desnormalizadas)
+    total = None if search or usuario_filtro else estatisticas.total_relatorios
+    page_obj, total_relatorios, total_aproximado = paginar(request, relatorios, 15, total=total)
     
-    # Contagem de relatórios com localização
-    relatorios_com_localizacao = Relatorio.objects.filter(
-        latitude__isnull=False, 
-        longitude__isnull=False
-    ).count()
+    # Autores mais frequentes para o filtro (do cache); os demais vêm do autocomplete
+    autores = facetas.autores()
     
     return render(request, 'core/admin_relatorios.html', {
         'relatorios': page_obj,
-        'usuarios_logados': usuarios_logados,
-        'usuarios_anonimos': usuarios_anonimos,
+        'autores': autores,
         'search': search,
         'usuario_filtro': usuario_filtro,
-        'total_relatorios': relatorios.count(),
-        'relatorios_com_localizacao': relatorios_com_localizacao
+        'total_relatorios': total_relatorios,
+        'total_aproximado': total_aproximado,
+        'relatorios_com_localizacao': estatisticas.total_com_localizacao
+    })
+
+@login_required
+@user_passes_test(is_admin)
+def exportar_relatorios(request):
+    """Exporta os relatórios filtrados em CSV, GeoJSON ou NDJSON (streaming)"""
+    formato = request.GET.get('formato', 'csv')
+    if formato not in exportacao.FORMATOS:
+        return HttpResponse('Formato de exportação inválido', status=400)
+    comprimir = request.GET.get('gzip', '').lower() in ('1', 'true', 'on')
+    
+    relatorios = filtrar_relatorios(
+        Relatorio.objects.all(), request.GET.get('search', ''), request.GET.get('usuario', '')
+    )
+    
+    content_type, extensao = exportacao.FORMATOS[formato]
+    nome_arquivo = f'relatorios-{timezone.localdate():%Y-%m-%d}.{extensao}'
+    if comprimir:
+        content_type = 'application/gzip'
+        nome_arquivo += '.gz'
+    
+    response = StreamingHttpResponse(
+        exportacao.exportar(relatorios, formato, request.build_absolute_uri('/'), comprimir),
+        content_type=content_type
+    )
+    response['Content-Disposition'] = f'attachment; filename="{nome_arquivo}"'
+    return response
+
+@login_required
+@user_passes_test(is_admin)
+def admin_autores(request):
+    """Autocomplete do filtro de autores do painel administrativo"""
+    return JsonResponse({'autores': facetas.buscar_autores(request.GET.get('q', ''))})
+
+def _ler_bbox(valor):
+    """Converte 'oeste,sul,leste,norte' (formato do Leaflet) em uma tupla normalizada"""
+    oeste, sul, leste, norte = (float(coordenada) for coordenada in valor.split(','))
+    if sul > norte or oeste > leste:
+        raise ValueError('bbox invertido')
+    if leste - oeste >= 360:
+        oeste, leste = -180.0, 180.0
+    else:
+        # O Leaflet devolve longitudes fora de [-180, 180] após dar a volta no mapa
+        oeste = (oeste + 180) % 360 - 180
+        leste = (leste + 180) % 360 - 180
+    return oeste, max(sul, -90.0), leste, min(norte, 90.0)
+
+def _casas_decimais(zoom):
+    """Precisão suficiente para posicionar o marcador no nível de zoom (~1 pixel)"""
+    if zoom is None:
+        return 6
+    graus_por_pixel = 360 / (256 * 2 ** zoom)
+    return max(1, min(6, math.ceil(-math.log10(graus_por_pixel))))
+
+def _feature_agrupamento(latitude, longitude, quantidade, casas):
+    return {
+        'type': 'Feature',
+        'geometry': {
+            'type': 'Point',
+            'coordinates': [round(longitude, casas), round(latitude, casas)],
+        },
+        'properties': {'quantidade': quantidade},
+    }
+
+@login_required
+@user_passes_test(is_admin)
+def admin_relatorios_mapa(request):
+    """GeoJSON com os relatórios (ou agrupamentos) visíveis no mapa do painel administrativo"""
+    try:
+        bbox = _ler_bbox(request.GET['bbox']) if request.GET.get('bbox') else None
+        zoom = min(max(int(request.GET['zoom']), 0), 22) if request.GET.get('zoom') else None
+    except ValueError:
+        return JsonResponse({'erro': 'Parâmetros bbox ou zoom inválidos.'}, status=400)
+    
+    search = request.GET.get('search', '')
+    usuario_filtro = request.GET.get('usuario', '')
+    relatorios = filtrar_relatorios(
+        Relatorio.objects.filter(latitude__isnull=False, longitude__isnull=False),
+        search,
+        usuario_filtro
+    )
+    
+    colecao = {'type': 'FeatureCollection'}
+    if not bbox or request.GET.get('extensao'):
+        # Extensão de todos os resultados para o enquadramento inicial; a primeira carga do
+        # mapa a pede junto com o viewport inicial para já receber os agrupamentos
+        extensao = relatorios.aggregate(
+            oeste=Min('longitude'), sul=Min('latitude'),
+            leste=Max('longitude'), norte=Max('latitude')
+        )
+        if extensao['oeste'] is not None:
+            colecao['bbox'] = [float(extensao[chave]) for chave in ('oeste', 'sul', 'leste', 'norte')]
+    if bbox:
+        oeste, sul, leste, norte = bbox
+        relatorios = relatorios.filter(latitude__range=(sul, norte))
+        if oeste <= leste:
+            relatorios = relatorios.filter(longitude__range=(oeste, leste))
+        else:
+            # Viewport atravessa o antimeridiano
+            relatorios = relatorios.filter(Q(longitude__gte=oeste) | Q(longitude__lte=leste))
+    
+    casas = _casas_decimais(zoom)
+    
+    # Com muitos relatórios no viewport, devolve agrupamentos em vez de marcadores
+    if zoom is not None and zoom <= settings.MAPA_ZOOM_MAXIMO_AGRUPAMENTO:
+        agrupamentos = None
+        if search or usuario_filtro:
+            # Filtros arbitrários não têm agregados pré-calculados
+            if relatorios.count() > settings.MAPA_AGRUPAR_ACIMA_DE:
+                agrupamentos = agrupamento.agrupar(relatorios, zoom)
+        else:
+            bbox_consulta = bbox or (-180.0, -90.0, 180.0, 90.0)
+            if agrupamento.total_no_bbox(bbox_consulta) > settings.MAPA_AGRUPAR_ACIMA_DE:
+                agrupamentos = agrupamento.agrupamentos(bbox_consulta, zoom)
+        
+        if agrupamentos is not None:
+            colecao['features'] = [
+                _feature_agrupamento(latitude, longitude, quantidade, casas)
+                for latitude, longitude, quantidade in agrupamentos
+            ]
+            colecao['truncado'] = False
+            return JsonResponse(colecao)
+    
+    limite = settings.MAPA_LIMITE_MARCADORES
+    linhas = list(relatorios.values_list(
+        'pk', 'titulo', 'latitude', 'longitude', 'endereco',
+        'usuario__username', 'nome_usuario', 'data_criacao', 'num_imagens'
+    )[:limite + 1])
+    
+    colecao['features'] = [
+        {
+            'type': 'Feature',
+            'id': pk,
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [round(float(longitude), casas), round(float(latitude), casas)],
+            },
+            'properties': {
+                'titulo': titulo,
+                'endereco': endereco,
+                'autor': username or nome_usuario or 'Anônimo',
+                'data': timezone.localtime(data_criacao).strftime('%d/%m/%Y %H:%M'),
+                'imagens': num_imagens,
+            },
+        }
+        for pk, titulo, latitude, longitude, endereco, username, nome_usuario, data_criacao, num_imagens
+        in linhas[:limite]
+    ]
+    colecao['truncado'] = len(linhas) > limite
+    
+    return JsonResponse(colecao)
+
+@login_required
+@user_passes_test(is_admin)
+def admin_relatorios_proximos(request):
+    """GeoJSON dos relatórios a até ``raio`` metros ou dos ``k`` mais próximos de um ponto (ver core/proximidade.py)"""
+    try:
+        latitude = float(request.GET['lat'])
+        longitude = float(request.GET['lng'])
+        raio = float(request.GET['raio']) if request.GET.get('raio') else None
+        k = int(request.GET['k']) if request.GET.get('k') else None
+    except (KeyError, ValueError):
+        return JsonResponse({'erro': 'Parâmetros lat, lng, raio ou k inválidos.'}, status=400)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return JsonResponse({'erro': 'Coordenadas fora do intervalo válido'}, status=400)
+    limite = settings.PROXIMIDADE_MAX_RESULTADOS
+    if raio is not None and not 0 < raio <= settings.PROXIMIDADE_RAIO_MAXIMO:
+        return JsonResponse({'erro': f'O raio deve estar entre 0 e {settings.PROXIMIDADE_RAIO_MAXIMO} metros.'}, status=400)
+    if k is not None and not 1 <= k <= limite:
+        return JsonResponse({'erro': f'k deve estar entre 1 e {limite}.'}, status=400)
+    
+    relatorios = filtrar_relatorios(
+        Relatorio.objects.all(),
+        request.GET.get('search', ''),
+        request.GET.get('usuario', '')
+    ).values(
+        'pk', 'titulo', 'latitude', 'longitude', 'endereco',
+        'usuario__username', 'nome_usuario', 'data_criacao', 'num_imagens'
+    )
+    
+    truncado = False
+    if raio is not None and k is None:
+        linhas = list(proximidade.no_raio(relatorios, latitude, longitude, raio)[:limite + 1])
+        truncado = len(linhas) > limite
+        linhas = linhas[:limite]
+    else:
+        # Com raio e k, os k mais próximos dentro do raio
+        linhas = proximidade.mais_proximos(relatorios, latitude, longitude, k or proximidade.K_PADRAO, raio)
+    
+    return JsonResponse({
+        'type': 'FeatureCollection',
+        'features': [
+            {
+                'type': 'Feature',
+                'id': linha['pk'],
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': [float(linha['longitude']), float(linha['latitude'])],
+                },
+                'properties': {
+                    'titulo': linha['titulo'],
+                    'endereco': linha['endereco'],
+                    'autor': linha['usuario__username'] or linha['nome_usuario'] or 'Anônimo',
+                    'data': timezone.localtime(linha['data_criacao']).strftime('%d/%m/%Y %H:%M'),
+                    'imagens': linha['num_imagens'],
+                    'distancia': round(linha['distancia'], 1),
+                },
+            }
+            for linha in linhas
+        ],
+        'truncado': truncado,
     })
 
 @login_required
 @user_passes_test(is_admin)
 def detalhes_relatorio(request, pk):
     """View para visualizar detalhes de um relatório específico - apenas para admins"""
-    relatorio = get_object_or_404(
-        Relatorio.objects.prefetch_related('imagens_relatorio'),
-        pk=pk
-    )
-    return render(request, 'core/detalhes_relatorio.html', {'relatorio': relatorio})
+    # As imagens só são consultadas se o corpo da página não estiver em cache
+    relatorio = get_object_or_404(Relatorio.objects.select_related('usuario'), pk=pk)
+    return render(request, 'core/detalhes_relatorio.html', {
+        'relatorio': relatorio,
+        'chave_cache': cache_respostas.chave_relatorio(relatorio),
+        'cache_timeout': settings.CACHE_FRAGMENTOS_TIMEOUT
+    })
 
 def register(request):
     """View para registro de novos usuários"""
@@ -0,0 +1,23 @@
+"""
+Configuração do gunicorn, lida automaticamente do diretório de trabalho.
+
+Com PROMETHEUS_MULTIPROC_DIR definida, os workers gravam as métricas nessa
+pasta (ver core/metricas.py): ela é esvaziada ao iniciar o servidor e os
+arquivos de cada worker que termina são consolidados.
+"""
+import os
+import shutil
+
+
+def on_starting(server):
+    pasta = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if pasta:
+        shutil.rmtree(pasta, ignore_errors=True)
+        os.makedirs(pasta, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
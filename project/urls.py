@@ -25,7 +25,7 @@ urlpatterns = [
     path('', include('core.urls')),
 ]
 
-# Configuração para servir arquivos estáticos e media durante desenvolvimento
+# Configuração para servir arquivos estáticos durante desenvolvimento; as imagens
+# dos relatórios são servidas pelo core em qualquer ambiente (ver core/midia.py)
 if settings.DEBUG:
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Carrega variáveis de ambiente do arquivo .env no diretório dotenv
@@ -19,10 +20,12 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'core',
 ]
 
 MIDDLEWARE = [
+    'core.metricas.MetricasMiddleware',  # primeiro, para medir toda a requisição (ver core/metricas.py)
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Para servir arquivos estáticos
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -30,6 +33,8 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'core.autoria.TokenAnonimoMiddleware',
+    'core.perfis.PerfilMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -102,13 +107,126 @@ STATICFILES_DIRS = [
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Entrega das imagens com as regras de acesso dos relatórios (ver core/midia.py)
+MIDIA_ENVIO = os.getenv('MIDIA_ENVIO', '')  # '', 'x-accel-redirect' (nginx) ou 'x-sendfile' (Apache)
+MIDIA_PREFIXO_INTERNO = os.getenv('MIDIA_PREFIXO_INTERNO', '/midia-interna/')  # location internal do nginx
+MIDIA_CACHE_IMUTAVEL = 365 * 24 * 60 * 60  # segundos; originais nomeados pelo hash do conteúdo
+MIDIA_CACHE_TIMEOUT = 24 * 60 * 60  # segundos; derivados podem ser gerados de novo
+
 # Configurações para upload de imagens
 MAX_UPLOAD_SIZE = 5242880  # 5MB em bytes
+UPLOAD_MAX_REQUISICAO = 10 * MAX_UPLOAD_SIZE  # envio inteiro de um relatório; acima disso o corpo não é lido
 ALLOWED_IMAGE_TYPES = ['image/jpeg', 'image/png', 'image/gif']
 
+# Versões reduzidas geradas uma única vez para cada imagem enviada
+IMAGEM_MINIATURA_LARGURA = 320  # pixels
+IMAGEM_MEDIA_LARGURA = 1280  # pixels
+IMAGEM_DERIVADOS_QUALIDADE = 82
+IMAGEM_GERAR_WEBP = os.getenv('IMAGEM_GERAR_WEBP', 'True').lower() in ('true', '1', 'yes', 'on')
+
+# Normalização das imagens enviadas antes do armazenamento (ver core/normalizacao.py)
+IMAGEM_DIMENSAO_MAXIMA = int(os.getenv('IMAGEM_DIMENSAO_MAXIMA', '2560'))  # pixels no maior lado
+IMAGEM_QUALIDADE = int(os.getenv('IMAGEM_QUALIDADE', '85'))  # JPEG recomprimido
+IMAGEM_MAX_PIXELS = 40000000  # acima disso o upload é recusado (decompression bomb)
+
+# Máximo de marcadores devolvidos por requisição ao mapa do painel administrativo
+MAPA_LIMITE_MARCADORES = 2000
+
+# Agrupamento de marcadores pré-calculado por nível de zoom (ver core/agrupamento.py)
+MAPA_ZOOM_MAXIMO_AGRUPAMENTO = 16  # acima deste zoom os marcadores são individuais
+MAPA_TAMANHO_CELULA = 64  # pixels; deve dividir 256
+MAPA_AGRUPAR_ACIMA_DE = 200  # até esta quantidade no viewport não há agrupamento
+
+# Relatórios num raio e mais próximos de um ponto (ver core/proximidade.py)
+PROXIMIDADE_RAIO_INICIAL = 500  # metros; dobra até encontrar os k mais próximos
+PROXIMIDADE_RAIO_MAXIMO = 50000  # metros
+PROXIMIDADE_MAX_RESULTADOS = 200
+
+# Paginação por cursor (keyset) das listagens de relatórios (ver core/paginacao.py)
+PAGINACAO_POR_CURSOR = os.getenv('PAGINACAO_POR_CURSOR', 'False').lower() in ('true', '1', 'yes', 'on')
+PAGINACAO_CONTAGEM_EXATA_ATE = 10000  # acima disso o total exibido é estimado
+
+# Cache compartilhado pelo web e pelo worker: as invalidações feitas pelos
+# sinais no worker precisam chegar ao web, e as travas e limites de taxa
+# (geocodificação, versões do cache) usam cache.add, que só é atômico entre
+# processos e servidores no Redis. Sem REDIS_URL, o cache em arquivos serve
+# apenas quando web e worker rodam na mesma máquina (CACHE_DIR compartilhada)
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.getenv('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'conservacao_cache')),
+            # Sessões, endereços, páginas e versões dividem o cache; o padrão
+            # (300) descartaria sessões a cada página nova guardada
+            'OPTIONS': {'MAX_ENTRIES': 20000},
+        }
+    }
+
+# Sessões lidas do cache e gravadas também no banco, que continua sendo a fonte
+# em caso de perda do cache; só mudam no login/logout, pois a autoria dos
+# relatórios anônimos fica no cookie assinado (ver core/autoria.py)
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Cookie assinado com o token dos visitantes anônimos que criaram relatórios
+ANONIMO_COOKIE_NOME = 'autor_anonimo'
+ANONIMO_COOKIE_IDADE = 365 * 24 * 60 * 60  # segundos
+
+# Token exigido pelo /metrics (cabeçalho "Authorization: Bearer <token>"); administradores
+# autenticados também têm acesso. Com vários workers do gunicorn, defina também
+# PROMETHEUS_MULTIPROC_DIR (ver core/metricas.py)
+METRICAS_TOKEN = os.getenv('METRICAS_TOKEN', '')
+
+# Perfis de requisições (ver core/perfis.py): fração das requisições perfiladas
+# (0 desativa a amostragem; administradores ainda podem pedir com X-Perfilar: 1)
+PERFIS_AMOSTRAGEM = float(os.getenv('PERFIS_AMOSTRAGEM', '0'))
+PERFIS_MAXIMO = 500  # perfis mantidos; os mais antigos são removidos
+PERFIS_FUNCOES = 25  # funções mais caras guardadas por critério (tempo próprio e acumulado)
+PERFIS_MAX_CONSULTAS = 1000  # consultas SQL guardadas por perfil
+
+# Facetas do filtro de autores do painel administrativo (ver core/facetas.py)
+FACETAS_LIMITE_AUTORES = 100  # autores exibidos no filtro; os demais via autocomplete
+FACETAS_CACHE_TIMEOUT = 60 * 60  # segundos; a lista também é invalidada ao criar/remover relatórios
+
+# Cache das páginas estáticas e das páginas de detalhes (ver core/cache_respostas.py)
+CACHE_PAGINAS_TIMEOUT = 10 * 60  # segundos; home, sobre e contato para visitantes anônimos
+CACHE_FRAGMENTOS_TIMEOUT = 24 * 60 * 60  # segundos; invalidados pelos sinais ao alterar o relatório
+
+# Fila de tarefas em segundo plano (ver core/tarefas.py e o comando processar_tarefas)
+TAREFAS_SINCRONAS = os.getenv('TAREFAS_SINCRONAS', 'False').lower() in ('true', '1', 'yes', 'on')  # executa no próprio processo, sem worker
+TAREFAS_PASTA_UPLOADS = os.getenv('TAREFAS_PASTA_UPLOADS', str(BASE_DIR / 'temp_uploads' / 'pendentes'))  # compartilhada com o worker
+TAREFAS_MAX_TENTATIVAS = 5
+TAREFAS_ESPERA_BASE = 30  # segundos até a 2ª tentativa; dobra a cada nova falha
+TAREFAS_TEMPO_LIMITE = 600  # segundos em execução até a tarefa voltar para a fila
+TAREFAS_INTERVALO = 5  # segundos entre verificações da fila pelo worker
+
+# Geocodificação reversa pelo servidor (ver core/geocodificacao.py)
+GEOCODIFICACAO_PROVEDOR = os.getenv('GEOCODIFICACAO_PROVEDOR', 'core.geocodificacao.ProvedorNominatim')
+GEOCODIFICACAO_URL = 'https://nominatim.openstreetmap.org/reverse'
+GEOCODIFICACAO_USER_AGENT = os.getenv('GEOCODIFICACAO_USER_AGENT', 'conservacao-prefeitura/1.0')
+GEOCODIFICACAO_FIXTURE = os.getenv('GEOCODIFICACAO_FIXTURE', '')  # JSON usado pelo ProvedorFixture
+GEOCODIFICACAO_CASAS_DECIMAIS = 4  # ~11 m; cliques mais próximos que isso compartilham o resultado
+GEOCODIFICACAO_INTERVALO = 1.0  # segundos entre chamadas ao provedor (todos os processos)
+GEOCODIFICACAO_TIMEOUT = 5  # segundos de espera pela resposta do provedor
+GEOCODIFICACAO_LIMITE_POR_CLIENTE = 20  # coordenadas novas levadas ao provedor por IP a cada minuto
+GEOCODIFICACAO_CACHE_TIMEOUT = 60 * 60 * 24  # segundos no cache; a tabela de endereços não expira
+
+# Proxies reversos confiáveis à frente do servidor (ex.: 1 no Render): o IP do
+# cliente é o que o proxy mais externo acrescentou ao X-Forwarded-For; com 0 é REMOTE_ADDR
+PROXIES_CONFIAVEIS = int(os.getenv('PROXIES_CONFIAVEIS', '0'))
+
 # Configurações de segurança para uploads
 FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5MB - arquivos maiores vão para disco
 FILE_UPLOAD_TEMP_DIR = BASE_DIR / 'temp_uploads'
+# O envio de relatórios (e só ele) usa o ImagemUploadHandler, que grava as imagens
+# direto em TAREFAS_PASTA_UPLOADS (ver core/uploads.py); a pasta deve estar no mesmo
+# sistema de arquivos que MEDIA_ROOT para que o arquivo seja movido, não copiado
 
 # Authentication
 LOGIN_URL = 'login'
@@ -6,6 +6,10 @@ DEBUG = os.getenv('DEBUG', 'True').lower() in ('true', '1', 'yes', 'on')
 # Hosts permitidos para desenvolvimento
 ALLOWED_HOSTS = ['*']
 
+# Em desenvolvimento as tarefas em segundo plano rodam no próprio servidor,
+# sem precisar do worker (defina TAREFAS_SINCRONAS=False para testá-lo)
+TAREFAS_SINCRONAS = os.getenv('TAREFAS_SINCRONAS', 'True').lower() in ('true', '1', 'yes', 'on')
+
 # Configurações específicas de desenvolvimento podem ser adicionadas aqui
 # Por exemplo:
 # INTERNAL_IPS = ['127.0.0.1']